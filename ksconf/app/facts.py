@@ -15,7 +15,7 @@ from typing import Any, ClassVar, Optional
 from ksconf.app.manifest import AppArchiveContentError
 from ksconf.archive import extract_archive, gaf_filter_name_like
 from ksconf.compat import Dict, List, Set, Tuple
-from ksconf.conf.merge import merge_conf_dicts
+from ksconf.conf.merge import MergedConfView
 from ksconf.conf.parser import (PARSECONF_LOOSE, ConfType, conf_attr_boolean,
                                 default_encoding, parse_conf, parse_conf_string)
 
@@ -131,10 +131,8 @@ class AppFacts:
             app_path / "default" / "app.conf",
             app_path / "local" / "app.conf"
         ]
-        conf = {}
-        for app_conf_path in app_conf_paths:
-            if app_conf_path.is_file():
-                conf = merge_conf_dicts(conf, parse_conf(app_conf_path, PARSECONF_LOOSE))
+        conf = MergedConfView(*[parse_conf(app_conf_path, PARSECONF_LOOSE)
+                                for app_conf_path in app_conf_paths if app_conf_path.is_file()])
         return cls.from_conf(app_path.name, conf)
 
     @classmethod
@@ -163,6 +161,6 @@ class AppFacts:
                 f"contains apps {', '.join(app_names)}")
 
         # Merge default and local (in the correct order)
-        conf = merge_conf_dicts(app_confs["default"], app_confs["local"])
+        conf = MergedConfView(app_confs["default"], app_confs["local"])
         app_name = app_names.pop()
         return cls.from_conf(app_name, conf)
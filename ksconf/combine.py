@@ -6,30 +6,87 @@ from __future__ import absolute_import, annotations, unicode_literals
 
 import os
 import re
+import stat
 import sys
+from copy import copy
+from dataclasses import replace
+from io import StringIO
 from os import fspath
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Dict, Optional, Sequence
 
 from ksconf.command import ConfFileProxy
 from ksconf.compat import List, Tuple
 from ksconf.conf.delta import show_text_diff
-from ksconf.conf.merge import merge_conf_files
-from ksconf.conf.parser import PARSECONF_MID, PARSECONF_STRICT
+from ksconf.conf.merge import merge_conf_dicts, merge_conf_files, write_merged_conf
+from ksconf.conf.parser import PARSECONF_MID, PARSECONF_STRICT, ConfType
 from ksconf.consts import SMART_CREATE, SMART_NOCHANGE, SMART_UPDATE
 from ksconf.hook import plugin_manager
 from ksconf.layer import (DotDLayerCollection, LayerCollectionBase,
                           LayerContext, LayerFile, LayerFilter,
-                          MultiDirLayerCollection)
+                          MultiDirLayerCollection, render_layer_files)
 from ksconf.types import StrPath
+from ksconf.util import process_pool
 from ksconf.util.compare import file_compare
-from ksconf.util.file import _is_binary_file, smart_copy
+from ksconf.util.file import (LINK_MODES, _is_binary_file, atomic_writer,
+                              smart_link, smart_write_bytes)
 
 
 class LayerCombinerException(Exception):
     pass
 
 
+class MergeCache:
+    """
+    In-memory cache of parsed and merged conf files, used to share work when the same layers are
+    combined into multiple targets.  Entries are keyed by physical path, so a cache must only be
+    shared between combine operations that use the same source files and template variables.
+
+    Merges done by worker processes (see :py:attr:`LayerCombiner.jobs`) use a separate cache,
+    which is sent back and added to the main cache with :py:meth:`update`.  Only merged results
+    are sent between processes.
+    """
+
+    def __init__(self):
+        self._parsed: Dict[Path, ConfType] = {}
+        self._merged: Dict[Tuple[Path, ...], ConfType] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_parsed"] = {}
+        return state
+
+    def has_merged(self, sources: List[LayerFile]) -> bool:
+        """ Return True if the merged content of ``sources`` is already known. """
+        return tuple(source.physical_path for source in sources) in self._merged
+
+    def update(self, other: MergeCache):
+        """ Add the merged results of ``other``, for example, a cache used by a worker process. """
+        self._merged.update(other._merged)
+
+    def parse(self, source: LayerFile, proxy: ConfFileProxy) -> ConfType:
+        """ Return the parsed content of ``source``, using ``proxy`` on a cache miss. """
+        key = source.physical_path
+        if key not in self._parsed:
+            self._parsed[key] = proxy.data
+        return self._parsed[key]
+
+    def merge(self, sources: List[LayerFile], proxies: List[ConfFileProxy]) -> ConfType:
+        """ Return the merged content of ``sources`` (in layer order).  The returned
+        object is shared and must not be modified. """
+        key = tuple(source.physical_path for source in sources)
+        try:
+            merged = self._merged[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            merged = self._merged[key] = merge_conf_dicts(
+                *[self.parse(source, proxy) for source, proxy in zip(sources, proxies)])
+        return merged
+
+
 class LayerCombiner:
     """
     Class to recursively combine layers (directories) into a single rendered output target directory.
@@ -61,8 +118,13 @@ class LayerCombiner:
             -> prepare()                Directory, layer prep
                 -> prepare_target_dir() Make dir; subclass handles marker here (combine CLI)
             -> pre_combine_inventory()  Hook for pre-processing (or alerting) the set of files to combine
+            -> render_files()           Render templates in parallel (when jobs > 1)
             -> combine_files()          Main worker function
+                -> is_output_current()  Hook to skip unchanged output files
+                -> post_combine_file()  Hook called after each output file is built
             -> post_combine()           Optional, cleanup leftover files
+
+        lc.combine_targets()            Alternate entry point; calls combine() once per target
     """
 
     # Note this is case sensitive.  Don't be lazy, name your files correctly  :-)
@@ -75,13 +137,23 @@ class LayerCombiner:
                  follow_symlink: bool = False,
                  banner: str = "",
                  dry_run: bool = False,
-                 quiet: bool = False):
+                 quiet: bool = False,
+                 jobs: int = 1,
+                 link_mode: str = "copy"):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {link_mode!r}.  Expected one of {', '.join(LINK_MODES)}")
         self.collection: LayerCollectionBase = None  # type: ignore
         self.context = LayerContext()
         self.layer_filter = LayerFilter()
         self.banner = banner
         self.dry_run = dry_run
         self.quiet = quiet
+        # Number of workers used to render templates and build output files
+        self.jobs = jobs
+        # How files from a single source are materialized in the target (see LINK_MODES)
+        self.link_mode = link_mode
+        # Shared parse/merge results; only set by combine_targets()
+        self.merge_cache: Optional[MergeCache] = None
 
         self.context.follow_symlink = follow_symlink
 
@@ -98,10 +170,12 @@ class LayerCombiner:
                               collection: LayerCollectionBase,
                               banner: str = "",
                               dry_run: bool = False,
-                              quiet: bool = False) -> LayerCombiner:
+                              quiet: bool = False,
+                              jobs: int = 1,
+                              link_mode: str = "copy") -> LayerCombiner:
         """ Alternate constructor for use when you already have a LayerCollectionBase object.
         """
-        obj = cls(collection.context.follow_symlink, banner, dry_run, quiet)
+        obj = cls(collection.context.follow_symlink, banner, dry_run, quiet, jobs, link_mode)
         obj.context = collection.context
         obj.collection = collection
         return obj
@@ -145,6 +219,14 @@ class LayerCombiner:
         collection.set_root(root)
         self.collection = collection
 
+    def __getstate__(self):
+        # Support for sending the combiner to worker processes.  Output is captured separately by
+        # each worker, and the layer collection and merge cache are only used by the main process
+        state = self.__dict__.copy()
+        state.update(stdout=None, stderr=None, collection=None, merge_cache=None,
+                     context=replace(self.context))
+        return state
+
     def add_layer_filter(self, action, pattern):
         self.layer_filter.add_rule(action, pattern)
 
@@ -162,11 +244,34 @@ class LayerCombiner:
         # Build a common tree of all src files.
         src_file_listing = collection.list_logical_files()
         src_file_listing = self.pre_combine_inventory(target, src_file_listing)
+        if self.jobs > 1:
+            self.render_files(target, src_file_listing)
         self.combine_files(target, src_file_listing)
         self.post_combine(target)
 
         plugin_manager.hook.post_combine(target=target, usage=hook_label)
 
+    def combine_targets(self, targets: Sequence[Tuple[StrPath, LayerFilter]], *, hook_label=""):
+        """
+        Combine layers into multiple targets, each with its own layer filter.  This is equivalent
+        to calling :py:meth:`combine` for each target, except that the source is only scanned once
+        and source conf files are only parsed once.  Merges with the same set of source files are
+        shared across targets.  Any filter set with :py:meth:`add_layer_filter` is ignored;
+        include those rules in each target's filter instead.
+        """
+        collection, layer_filter = self.collection, self.layer_filter
+        if collection is None:
+            raise TypeError("Call either set_source_dirs() or set_layer_root() before calling combine_targets()")
+        self.merge_cache = MergeCache()
+        try:
+            for target, target_filter in targets:
+                self.collection = collection.copy()
+                self.layer_filter = target_filter
+                self.combine(target, hook_label=hook_label)
+        finally:
+            self.collection, self.layer_filter = collection, layer_filter
+            self.merge_cache = None
+
     def prepare(self, target: Path):
         """ Start the combine process.  This includes directory checking,
         applying layer filtering, and marker file handling. """
@@ -192,10 +297,52 @@ class LayerCombiner:
         """ Hook point for post-processing after all copy/merge operations have been completed. """
         del target
 
+    def render_files(self, target: Path, src_files: List[Path]):
+        """ Render all templates needed to build ``src_files`` using :py:attr:`jobs` processes.
+        Without this, templates are rendered one at a time as they are needed. """
+        collection = self.collection
+        files = []
+        for src_file in sorted(src_files):
+            sources = collection.get_files(src_file)
+            if not sources:
+                continue
+            dest_fn = sources[0].logical_path
+            handler = self.get_handler(dest_fn, sources)
+            if self.is_output_current(target / dest_fn, sources, handler):
+                continue
+            if handler:
+                files.extend(sources)
+            else:
+                # Only the highest priority file is copied
+                files.extend(sources[-1:])
+        render_layer_files(files, self.jobs)
+
+    def get_handler(self, dest_fn: Path, sources: List[LayerFile]) -> Optional[Callable]:
+        """ Return the file type handler for ``dest_fn``, or None if the highest priority file
+        should simply be copied. """
+        # Handlers only run to address conflicts, so there must be more than 1 source file
+        if len(sources) > 1:
+            for matcher, handler in self.filetype_handlers:
+                if matcher(dest_fn):
+                    # Stop after first matching handler
+                    return handler
+        return None
+
+    def is_output_current(self, dest_path: Path, sources: List[LayerFile],
+                          handler: Optional[Callable]) -> bool:
+        """ Hook point to skip building ``dest_path`` if it's known to be up-to-date. """
+        del dest_path, sources, handler
+        return False
+
+    def post_combine_file(self, dest_path: Path, sources: List[LayerFile],
+                          handler: Optional[Callable]):
+        """ Hook point called after ``dest_path`` has been built. """
+        del dest_path, sources, handler
+
     def combine_files(self, target: Path, src_files: List[LayerFile]):
         collection = self.collection
+        tasks = []
         for src_file in sorted(src_files):
-            do_copy = True
             sources = collection.get_files(src_file)
             try:
                 dest_fn = sources[0].logical_path
@@ -204,45 +351,128 @@ class LayerCombiner:
 
             dest_path: Path = target / dest_fn
 
-            # Make missing destination folder, if missing
-            dest_dir: Path = dest_path.parent
-            if not dest_dir.is_dir() and not self.dry_run:
-                dest_dir.mkdir(parents=True)
-
             # Determine handling method based on source count and filename pattern
-            # Handlers only run to address conflicts, so there must be more than 1 source file
-            if len(sources) > 1:
-                for matcher, handler in self.filetype_handlers:
-                    if matcher(dest_fn):
-                        handler(self, dest_path, sources, self.dry_run)
-                        do_copy = False
-                        # Stop after first matching handler has run
-                        break
-
-            # If no specific handler has been run, copy highest priority file to target
-            if do_copy:
-                # self.debug((f"Considering {fspath(dest_fn):50}  NON-CONF Copy from source:  "
-                #             f"{sources[-1].physical_path!r}")
-                # Always use the last file in the list (since last directory always wins)
-                src_file = sources[-1].resource_path
-                if self.dry_run:
-                    if dest_path.is_file():
-                        if file_compare(src_file, dest_path):
-                            smart_rc = SMART_NOCHANGE
-                        else:
-                            if (_is_binary_file(src_file) or _is_binary_file(dest_path)):
-                                # Binary files.  Can't compare...
-                                smart_rc = "DRY-RUN (NO-DIFF=BIN)"
-                            else:
-                                show_text_diff(self.stdout, dest_path, src_file)
-                                smart_rc = "DRY-RUN (DIFF)"
-                    else:
-                        smart_rc = "DRY-RUN (NEW)"
+            handler = self.get_handler(dest_fn, sources)
+            if self.is_output_current(dest_path, sources, handler):
+                continue
+            if self.jobs > 1:
+                tasks.append((dest_path, sources, handler))
+            else:
+                self.combine_file(dest_path, sources, handler)
+                self.post_combine_file(dest_path, sources, handler)
+        if tasks:
+            self._combine_files_parallel(tasks)
+
+    def _combine_files_parallel(self, tasks: List[Tuple[Path, List[LayerFile], Optional[Callable]]]):
+        """
+        Build output files using :py:attr:`jobs` worker processes.  Handlers (like conf merging)
+        are CPU bound and run in a copy of this combiner in a worker process, while copies are made
+        by the main process as results are collected.  Therefore any combiner state should be
+        updated from :py:meth:`post_combine_file`, not :py:meth:`combine_file`.
+        When a :py:attr:`merge_cache` is in use, results merged by workers are added to it, and
+        files with an already merged set of sources are written by the main process.
+        Log messages and dry-run output are written in the same order as a serial run.
+        """
+        merge_cache = self.merge_cache
+        with process_pool(self.jobs, initializer=_init_combine_worker,
+                          initargs=(self,)) as executor:
+            futures = []
+            for dest_path, sources, handler in tasks:
+                if handler and not (merge_cache and merge_cache.has_merged(sources)):
+                    futures.append(executor.submit(_combine_file_task, dest_path, sources,
+                                                   handler, merge_cache is not None))
+                else:
+                    futures.append(None)
+            # Results are processed in order;  the first exception (in order) is raised
+            for (dest_path, sources, handler), future in zip(tasks, futures):
+                if future:
+                    stdout, stderr, worker_cache = future.result()
+                    self.stdout.write(stdout)
+                    self.stderr.write(stderr)
+                    if merge_cache is not None:
+                        merge_cache.update(worker_cache)
+                else:
+                    self.combine_file(dest_path, sources, handler)
+                self.post_combine_file(dest_path, sources, handler)
+
+    def combine_file(self, dest_path: Path, sources: List[LayerFile],
+                     handler: Optional[Callable]):
+        """ Build a single output file from one or more sources. """
+        # Make missing destination folder, if missing.  (Other workers may be doing the same)
+        if not self.dry_run:
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if handler:
+            handler(self, dest_path, sources, self.dry_run)
+            return
+        # If no specific handler applies, copy highest priority file to target
+        # self.debug((f"Considering {fspath(dest_fn):50}  NON-CONF Copy from source:  "
+        #             f"{sources[-1].physical_path!r}")
+        # Always use the last file in the list (since last directory always wins)
+        source = sources[-1]
+        if self.dry_run:
+            src_file = source.resource_path
+            if dest_path.is_file():
+                if file_compare(src_file, dest_path):
+                    smart_rc = SMART_NOCHANGE
                 else:
-                    smart_rc = smart_copy(src_file, dest_path)
-                if smart_rc != SMART_NOCHANGE:
-                    self.debug(f"Copy <{smart_rc}>   {fspath(dest_path):50}  from {src_file}")
-                del src_file
+                    if (_is_binary_file(src_file) or _is_binary_file(dest_path)):
+                        # Binary files.  Can't compare...
+                        smart_rc = "DRY-RUN (NO-DIFF=BIN)"
+                    else:
+                        show_text_diff(self.stdout, dest_path, src_file)
+                        smart_rc = "DRY-RUN (DIFF)"
+            else:
+                smart_rc = "DRY-RUN (NEW)"
+        elif source.resource_in_memory:
+            # Write rendered content directly; avoids the use of a temporary file
+            smart_rc = smart_write_bytes(source.read_bytes(), dest_path)
+        else:
+            smart_rc = smart_link(source.resource_path, dest_path, self.link_mode)
+        if smart_rc != SMART_NOCHANGE:
+            self.debug(f"Copy <{smart_rc}>   {fspath(dest_path):50}  "
+                       f"from {source.physical_path}")
+
+
+# Combiner used by a worker process;  set once per process by _init_combine_worker()
+_worker_combiner: Optional[LayerCombiner] = None
+
+
+def _init_combine_worker(combiner: LayerCombiner):
+    global _worker_combiner
+    _worker_combiner = combiner
+
+
+def _combine_file_task(dest_path: Path, sources: List[LayerFile], handler: Optional[Callable],
+                       use_merge_cache: bool) -> Tuple[str, str, Optional[MergeCache]]:
+    """ Build a single output file in a worker process.  Returns captured output and the merge
+    cache used by the worker, if requested. """
+    combiner = copy(_worker_combiner)
+    combiner.stdout = StringIO()
+    combiner.stderr = StringIO()
+    if use_merge_cache:
+        combiner.merge_cache = MergeCache()
+    combiner.combine_file(dest_path, sources, handler)
+    return combiner.stdout.getvalue(), combiner.stderr.getvalue(), combiner.merge_cache
+
+
+def _open_layer_conf(source: LayerFile) -> ConfFileProxy:
+    """ Return a read-only proxy for a conf file.  In-memory content is parsed directly. """
+    if source.resource_in_memory:
+        return ConfFileProxy(source.physical_path, "r", StringIO(source.read_text()),
+                             parse_profile=PARSECONF_STRICT)
+    return ConfFileProxy(source.resource_path, "r", parse_profile=PARSECONF_STRICT)
+
+
+def _break_link(dest_path: Path):
+    """ Remove ``dest_path`` if it's a symlink or hardlink, possibly left by a previous run with a
+    different link mode.  Writing through the link would otherwise modify a source file. """
+    try:
+        st = dest_path.lstat()
+    except OSError:
+        return
+    if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1:
+        dest_path.unlink()
 
 
 # registration decorator
@@ -266,13 +496,21 @@ def handle_merge_conf_files(combiner: LayerCombiner,
     dest = None
     srcs = []
     try:
+        if not dry_run:
+            _break_link(dest_path)
         # Handle merging conf files
         dest = ConfFileProxy(dest_path, "r+", parse_profile=PARSECONF_MID)
-        srcs = [ConfFileProxy(s.resource_path, "r", parse_profile=PARSECONF_STRICT) for s in sources]
+        srcs = [_open_layer_conf(s) for s in sources]
         # combiner.debug(f"Considering {dest_fn:50}  CONF MERGE from source:  "
         #                f"{1!sources[0].physical_path}")
-        smart_rc = merge_conf_files(dest, srcs, dry_run=dry_run,
-                                    banner_comment=combiner.banner)
+        if combiner.merge_cache is None:
+            smart_rc = merge_conf_files(dest, srcs, dry_run=dry_run,
+                                        banner_comment=combiner.banner, stdout=combiner.stdout)
+        else:
+            merged = combiner.merge_cache.merge(sources, srcs)
+            smart_rc = write_merged_conf(dest, merged, max(src.mtime for src in srcs),
+                                         dry_run=dry_run, banner_comment=combiner.banner,
+                                         stdout=combiner.stdout)
         if smart_rc != SMART_NOCHANGE:
             combiner.debug(f"Merge <{smart_rc}>   {fspath(dest_path):50}  from {sources_physical!r}")
         # return smart_rc  # ignored
@@ -297,7 +535,7 @@ def handle_spec_concatenate(combiner: LayerCombiner,
     last_mtime = max(src.mtime for src in sources)
     for src in sources:
         sources_physical.append(src.physical_path)
-        content = src.resource_path.read_text()
+        content = src.read_text()
         if not content.endswith("\n"):
             content += "\n"
         combined_content += content
@@ -310,9 +548,10 @@ def handle_spec_concatenate(combiner: LayerCombiner,
             smart_rc = SMART_UPDATE
 
     if not dry_run:
-        dest_path.write_text(combined_content)
-
-    os.utime(dest_path, (last_mtime, last_mtime))
+        _break_link(dest_path)
+        with atomic_writer(dest_path, ".tmp") as temp:
+            temp.write_text(combined_content)
+            os.utime(temp, (last_mtime, last_mtime))
     if smart_rc != SMART_NOCHANGE:
         combiner.debug(f"Concatenate <{smart_rc}>   {fspath(dest_path):50}  from {sources_physical!r}")
     # return smart_rc
@@ -15,6 +15,7 @@ import argparse
 import logging
 import os
 import re
+import stat
 import sys
 import textwrap
 import time
@@ -22,13 +23,14 @@ from argparse import ArgumentParser, ArgumentTypeError
 from collections import namedtuple
 from io import StringIO, open
 from textwrap import dedent
-from typing import Mapping, Optional, TextIO
+from typing import Dict, Mapping, Optional, TextIO, Union
 from warnings import warn
 
 from ksconf.compat import cache
-from ksconf.conf.parser import (ConfParserException, ParserConfig,
-                                detect_by_bom, parse_conf, smart_write_conf,
-                                write_conf)
+from ksconf.conf.cache import get_parse_cache
+from ksconf.conf.parser import (ConfParserException, ParserConfig, Token,
+                                _parse_conf_file, detect_by_bom, parse_conf,
+                                smart_write_conf, write_conf)
 from ksconf.consts import (EXIT_CODE_BAD_ARGS, EXIT_CODE_BAD_CONF_FILE,
                            EXIT_CODE_NO_SUCH_FILE, SMART_CREATE, SmartEnum)
 from ksconf.hook import plugin_manager
@@ -152,6 +154,16 @@ class ConfFileProxy:
         else:
             return time.time()
 
+    def _use_parse_cache(self) -> bool:
+        """ The persistent parse cache is only used for regular files (not pipes like /dev/fd/N),
+        even if a stream is already open. """
+        if not (self._is_file and get_parse_cache()):
+            return False
+        try:
+            return stat.S_ISREG(os.stat(self.name).st_mode)
+        except OSError:
+            return False
+
     def load(self, profile=None):
         if not self.readable():
             # Q: Should we mimic the exception caused by doing a read() on a write-only file object?
@@ -159,9 +171,22 @@ class ConfFileProxy:
         parse_profile = dict(self._parse_profile)
         if profile:
             parse_profile.update(profile)
+        if self._use_parse_cache():
+            # Load by name to allow use of the persistent parse cache.
+            return parse_conf(self.name, profile=parse_profile)
         data = parse_conf(self.stream, profile=parse_profile)
         return data
 
+    @property
+    def digests(self) -> Optional[Dict[Union[str, Token], bytes]]:
+        """ Cached stanza digests for :py:func:`~ksconf.conf.delta.compare_cfgs`, or None if the
+        persistent parse cache is not enabled.  If :py:attr:`data` is already loaded, digests are
+        calculated from it instead of loading the file again. """
+        if not (self.readable() and self._use_parse_cache()):
+            return None
+        return get_parse_cache().digests(self.name, self._parse_profile, None, _parse_conf_file,
+                                         conf=self._data)
+
     def dump(self, data, **kwargs) -> SmartEnum:
         if not self.writable():      # pragma: no cover
             raise ValueError(f"Unable to dump() to {self._type()} with mode '{self._mode}'")
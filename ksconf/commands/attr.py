@@ -27,10 +27,13 @@ from __future__ import absolute_import, unicode_literals
 import argparse
 import os
 from pathlib import Path
+from typing import Mapping
 
-from ksconf.command import KsconfCmd, dedent
-from ksconf.conf.parser import update_conf
-from ksconf.consts import (EXIT_CODE_CONF_NO_DATA_MATCH, EXIT_CODE_NO_SUCH_FILE,
+from ksconf.command import KsconfCmd, KsconfCmdReadConfException, dedent
+from ksconf.conf.lazy import LazyConf
+from ksconf.conf.parser import ConfParserException, update_conf
+from ksconf.consts import (EXIT_CODE_BAD_CONF_FILE,
+                           EXIT_CODE_CONF_NO_DATA_MATCH, EXIT_CODE_NO_SUCH_FILE,
                            EXIT_CODE_NOTHING_TO_DO, EXIT_CODE_SUCCESS)
 from ksconf.util.completers import conf_files_completer
 from ksconf.util.file import expand_glob_list
@@ -72,29 +75,50 @@ class AttrGetCmd(KsconfCmd):
         # For Windows users, expand any glob patterns as needed.
         args.conf = list(expand_glob_list(args.conf))
 
+    def load_conf(self, conf: str) -> Mapping[str, Mapping[str, str]]:
+        """ Use a lazy reader for regular files.  Only the requested stanza gets parsed. """
+        if conf == "-" or not os.path.isfile(conf) or conf.startswith("/dev/fd/"):
+            return self.parse_conf(conf).data
+        try:
+            return LazyConf(conf, profile=self.parse_profile)
+        except IOError as e:
+            self.stderr.write(f"can't open '{conf}': {e}\n")
+            raise KsconfCmdReadConfException(EXIT_CODE_NO_SUCH_FILE)
+        except ConfParserException as e:
+            self.stderr.write(f"Failed to parse '{conf}':  {e}\n")
+            raise KsconfCmdReadConfException(EXIT_CODE_BAD_CONF_FILE)
+
     def run(self, args):
         ''' For a given conf file, get the 'value' from [stanza] attribute = value '''
         for conf in args.conf:
             if len(args.conf) > 1:
                 args.output.write(f"---------------- [ {conf} ] ----------------\n\n")
-            data = self.parse_conf(conf).data
-            if args.missing_okay:
-                try:
-                    value = data[args.stanza][args.attribute]
-                except KeyError:
-                    value = ""
-            else:
-                try:
-                    stanza = data[args.stanza]
-                except KeyError:
-                    self.stderr.write(f"File {conf} does not have the stanza [{args.stanza}] \n")
-                    return EXIT_CODE_CONF_NO_DATA_MATCH
-                try:
-                    value = stanza[args.attribute]
-                except KeyError:
-                    self.stderr.write(f"File {conf} does not have {args.attribute} "
-                                      f"in stanza [{args.stanza}]\n")
-                    return EXIT_CODE_CONF_NO_DATA_MATCH
+            data = self.load_conf(conf)
+            try:
+                if args.missing_okay:
+                    try:
+                        value = data[args.stanza][args.attribute]
+                    except KeyError:
+                        value = ""
+                else:
+                    try:
+                        stanza = data[args.stanza]
+                    except KeyError:
+                        self.stderr.write(f"File {conf} does not have the stanza [{args.stanza}] \n")
+                        return EXIT_CODE_CONF_NO_DATA_MATCH
+                    try:
+                        value = stanza[args.attribute]
+                    except KeyError:
+                        self.stderr.write(f"File {conf} does not have {args.attribute} "
+                                          f"in stanza [{args.stanza}]\n")
+                        return EXIT_CODE_CONF_NO_DATA_MATCH
+            except ConfParserException as e:
+                # Lazy parsing may detect errors when the stanza is accessed
+                self.stderr.write(f"Failed to parse '{conf}':  {e}\n")
+                return EXIT_CODE_BAD_CONF_FILE
+            finally:
+                if isinstance(data, LazyConf):
+                    data.close()
             args.output.write(f"{value}\n")
             args.output.flush()
 
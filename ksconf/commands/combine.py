@@ -8,11 +8,33 @@ Usage example:
     cd MY_APP
     ksconf combine default.d/* --target=default
 
+Build multiple targets from a single scan of the source:
+
+.. code-block:: sh
+
+    ksconf combine MY_APP --layer-method dir.d --target-spec targets.json
+
+Where ``targets.json`` contains:
+
+.. code-block:: json
+
+    {
+        "targets": [
+            {"target": "build/dev/MY_APP", "exclude": ["*-prod"]},
+            {"target": "build/prod/MY_APP", "exclude": ["*-dev"]}
+        ]
+    }
+
 """
 from __future__ import absolute_import, unicode_literals
 
-from pathlib import Path
-from typing import Optional, Sequence
+import json
+import os
+from collections import defaultdict
+from itertools import chain
+from os import fspath
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
 
 from ksconf.combine import LayerCombiner, LayerCombinerException
 from ksconf.command import KsconfCmd, add_file_handler, dedent
@@ -20,11 +42,17 @@ from ksconf.compat import Set
 from ksconf.consts import (EXIT_CODE_BAD_ARGS, EXIT_CODE_COMBINE_MARKER_MISSING,
                            EXIT_CODE_NO_SUCH_FILE)
 from ksconf.filter import create_filtered_list
-from ksconf.layer import LayerFile, layer_file_factory
+from ksconf.layer import LayerFile, LayerFilter, LayerRenderedFile, layer_file_factory
 from ksconf.util.completers import DirectoriesCompleter
-from ksconf.util.file import expand_glob_list, relwalk, splglob_simple
+from ksconf.util.file import (LINK_MODES, atomic_writer, enable_file_hash_memo,
+                              expand_glob_list, relwalk, splglob_simple)
+from ksconf.version import version as ksconf_version
 
 CONTROLLED_DIR_MARKER = ".ksconf_controlled"
+CONTROLLED_DIR_STATE = ".ksconf_state.json"
+
+# Bump if the state file format changes in an incompatible way
+_STATE_FORMAT = 1
 
 
 class LayerCombinerExceptionCode(LayerCombinerException):
@@ -38,17 +66,173 @@ class RepeatableCombiner(LayerCombiner):
     Re-runable combiner class.  Beyond the reusable layer combining functionality,
     this class enables the use of a marker file for added safety.  Removed files
     will cleanup.
+
+    A state file in the target directory records the source files (and their
+    fingerprints) used to build each output file, as well as the modification time of
+    each target directory.  On subsequent runs, outputs with unchanged sources are
+    skipped and only changed target directories are listed when looking for unwanted
+    files.
     """
 
     def __init__(self, *args,
                  disable_marker: bool = False,
                  disable_cleanup: bool = False,
+                 disable_state: bool = False,
                  keep_existing: bool = False, **kwargs):
         super().__init__(*args, **kwargs)
         self.target_extra_files: Optional[set] = None
         self.disable_marker = disable_marker
         self.disable_cleanup = disable_cleanup
+        self.disable_state = disable_state
         self.keep_existing = keep_existing
+        self._target: Optional[Path] = None
+        # State from the previous run (None if unavailable), and outputs of the current run
+        self._state_prev: Optional[dict] = None
+        self._state: Dict[str, dict] = {}
+        self._target_dirs: Set[str] = set()
+        self._kept_files: Set[Path] = set()
+
+    def _state_settings(self) -> dict:
+        """ Settings that impact all output files.  Any change invalidates the saved state. """
+        return {
+            "format": _STATE_FORMAT,
+            "ksconf": ksconf_version,
+            "banner": self.banner,
+            "link_mode": self.link_mode,
+            "handlers": [handler.__name__ for _, handler in self.filetype_handlers],
+        }
+
+    def load_state(self, target: Path):
+        """ Load state from the previous run, unless disabled or invalid. """
+        self._target = target
+        self._state = {}
+        self._state_prev = None
+        self._target_dirs = set()
+        self._kept_files = set()
+        if self.disable_state:
+            return
+        try:
+            with open(target / CONTROLLED_DIR_STATE, encoding="utf-8") as f:
+                state = json.load(f)
+            if state["settings"] == self._state_settings():
+                self._state_prev = state
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save_state(self):
+        if self.disable_state or self.dry_run or self._target is None:
+            return
+        # Record all directories (including any newly created ones) after all changes are made
+        dirs = set(self._target_dirs)
+        for path in chain(map(PurePosixPath, self._state), self._kept_files):
+            dirs.update(p.as_posix() for p in path.parents)
+        # Writing the state file changes the target's own mtime, so the root is always listed
+        dirs.discard(".")
+        dir_mtimes = {}
+        for rel in dirs:
+            try:
+                dir_mtimes[rel] = (self._target / rel).stat().st_mtime_ns
+            except OSError:
+                pass
+        state = {
+            "settings": self._state_settings(),
+            "files": self._state,
+            "dirs": dir_mtimes,
+            "kept": sorted(p.as_posix() for p in self._kept_files),
+        }
+        if state == self._state_prev:
+            # No-op run.  Skipping the write also keeps the target directory unchanged
+            return
+        with atomic_writer(self._target / CONTROLLED_DIR_STATE, ".tmp") as temp:
+            temp.write_text(json.dumps(state, sort_keys=True), encoding="utf-8")
+
+    @staticmethod
+    def _file_fingerprint(lf: LayerFile):
+        if isinstance(lf, LayerRenderedFile):
+            # Rendered output may depend on more than just the physical file
+            return lf.calculate_signature()
+        st = lf.stat
+        return [st.st_mtime_ns, st.st_size]
+
+    def _inputs(self, sources: List[LayerFile], handler: Optional[Callable]) -> dict:
+        return {
+            "handler": handler.__name__ if handler else "copy",
+            "sources": [[fspath(lf.physical_path), self._file_fingerprint(lf)] for lf in sources],
+        }
+
+    def _state_key(self, dest_path: Path) -> str:
+        return dest_path.relative_to(self._target).as_posix()
+
+    def _find_target_files(self, target: Path) -> Iterator[Path]:
+        """ Return all files in ``target``.  Directories unchanged since the last run are not
+        listed;  their content is known from the previous state. """
+        follow_symlink = self.context.follow_symlink
+        prev = self._state_prev or {}
+        prev_dirs: Dict[str, int] = prev.get("dirs", {})
+        prev_files: Dict[str, List[str]] = defaultdict(list)
+        for rel in chain(prev.get("files", ()), prev.get("kept", ())):
+            prev_files[PurePosixPath(rel).parent.as_posix()].append(rel)
+        prev_children: Dict[str, List[str]] = defaultdict(list)
+        for rel in prev_dirs:
+            if rel != ".":
+                prev_children[PurePosixPath(rel).parent.as_posix()].append(rel)
+
+        pending = ["."]
+        while pending:
+            rel = pending.pop()
+            try:
+                mtime = (target / rel).stat().st_mtime_ns
+            except OSError:
+                continue
+            self._target_dirs.add(rel)
+            if prev_dirs.get(rel) == mtime:
+                for fn in prev_files.get(rel, ()):
+                    yield Path(fn)
+                pending.extend(prev_children.get(rel, ()))
+                continue
+            with os.scandir(target / rel) as entries:
+                for entry in entries:
+                    child = PurePosixPath(rel, entry.name).as_posix()
+                    if entry.is_dir():
+                        # Symlinked directories are never files, but only descend if following
+                        if follow_symlink or not entry.is_symlink():
+                            pending.append(child)
+                    elif rel != "." or entry.name not in (CONTROLLED_DIR_MARKER, CONTROLLED_DIR_STATE):
+                        yield Path(child)
+
+    def is_output_current(self, dest_path: Path, sources: List[LayerFile],
+                          handler: Optional[Callable]) -> bool:
+        """ Output is current if the inputs and output file are unchanged since the last run. """
+        if not self._state_prev:
+            return False
+        key = self._state_key(dest_path)
+        entry = self._state_prev["files"].get(key)
+        if entry is None or entry["inputs"] != self._inputs(sources, handler):
+            return False
+        try:
+            st = dest_path.stat()
+        except OSError:
+            return False
+        if entry["output"]["stat"] != [st.st_mtime_ns, st.st_size]:
+            # Modified outside of ksconf
+            return False
+        self._state[key] = entry
+        return True
+
+    def post_combine_file(self, dest_path: Path, sources: List[LayerFile],
+                          handler: Optional[Callable]):
+        if self.disable_state or self.dry_run:
+            return
+        try:
+            st = dest_path.stat()
+        except OSError:
+            return
+        self._state[self._state_key(dest_path)] = {
+            "inputs": self._inputs(sources, handler),
+            "output": {
+                "stat": [st.st_mtime_ns, st.st_size],
+            }
+        }
 
     def prepare_target_dir(self, target: Path):
         """
@@ -74,6 +258,7 @@ class RepeatableCombiner(LayerCombiner):
             self.log(f"Created destination directory {target}")
             if not self.disable_marker:
                 marker_file.write_text("This directory is managed by KSCONF.  Don't touch\n")
+        self.load_state(target)
 
     def pre_combine_inventory(self, target: Path, src_files: Sequence[LayerFile]) -> Set[LayerFile]:
         """
@@ -88,12 +273,18 @@ class RepeatableCombiner(LayerCombiner):
         # Convert src_files to a set to speed up
         src_files = set(src_files)
         self.target_extra_files = set()
+        if not self.disable_state:
+            for tgt_file in self._find_target_files(target):
+                if tgt_file not in src_files and not context.block_files.search(tgt_file.name):
+                    self.target_extra_files.add(tgt_file)
+            return src_files
         for (root, _, files) in relwalk(target, followlinks=context.follow_symlink):
             root = Path(root)
             for fn in files:
                 tgt_file = root / fn
                 if tgt_file not in src_files:
-                    if fn == CONTROLLED_DIR_MARKER or context.block_files.search(fn):
+                    if fn in (CONTROLLED_DIR_MARKER, CONTROLLED_DIR_STATE) or \
+                            context.block_files.search(fn):
                         continue  # pragma: no cover (peephole optimization)
                     self.target_extra_files.add(tgt_file)
         return src_files
@@ -116,12 +307,15 @@ class RepeatableCombiner(LayerCombiner):
             for dest_fn in target_extra_files:
                 if keep_existing.match_path(dest_fn):
                     self.log(f"Keep existing file {dest_fn}")
+                    self._kept_files.add(dest_fn)
                 elif self.disable_cleanup:
                     self.log(f"Skip cleanup of unwanted file {dest_fn}")
+                    self._kept_files.add(dest_fn)
                 else:
                     self.log(f"Remove unwanted file {dest_fn}")
                     f: Path = target / dest_fn
                     f.unlink()
+        self.save_state()
 
 
 class CombineCmd(KsconfCmd):
@@ -173,10 +367,17 @@ class CombineCmd(KsconfCmd):
             with the specific; later sources will override values from the earlier ones.
             Supports wildcards so a typical Unix ``conf.d/##-NAME`` directory structure works well.""")
                             ).completer = DirectoriesCompleter()
-        parser.add_argument("--target", "-t", required=True, help=dedent("""
+        parser.add_argument("--target", "-t", help=dedent("""
             Directory where the merged files will be stored.
             Typically either 'default' or 'local'""")
                             ).completer = DirectoriesCompleter()
+        parser.add_argument("--target-spec", metavar="FILE", help=dedent("""
+            JSON file listing multiple targets to build from SOURCE.  Each entry in ``targets``
+            must contain a ``target`` directory, and may contain ``include`` and ``exclude``
+            lists of layer patterns.  Any ``--include`` or ``--exclude`` rules are applied after
+            the target's rules.  Relative target paths are relative to the location of FILE.
+            SOURCE is scanned once, and conf files are only parsed (and merged) once for all
+            targets."""))
         parser.add_argument("-m", "--layer-method",
                             choices=["auto", "dir.d", "disable"],
                             default="auto",
@@ -203,6 +404,15 @@ class CombineCmd(KsconfCmd):
         parser.add_argument("--template-vars",
                             default=None, action="store",
                             help="Set template variables as key=value or YAML/JSON, if filename prepend with @")
+        parser.add_argument("--jobs", "-j", metavar="N", type=int, default=1,
+                            help="Number of workers used to render templates and build output "
+                            "files.  Conf files are merged in worker processes.")
+        parser.add_argument("--link-mode", choices=LINK_MODES, default="copy", help=dedent("""
+            Method used to place files that come from a single source (and are therefore not merged)
+            into TARGET.  'hardlink' and 'symlink' reference the source file directly, so any
+            modifications made in TARGET will impact the source.  'reflink' creates a copy-on-write
+            clone on filesystems that support it (e.g., btrfs or XFS).
+            A regular copy is made whenever the selected method is unavailable."""))
 
         parser.add_argument("--dry-run", "-D", default=False, action="store_true", help=dedent("""
             Enable dry-run mode.
@@ -228,13 +438,43 @@ class CombineCmd(KsconfCmd):
         parser.add_argument("--disable-cleanup", action="store_true", default=False,
                             help="Disable all file removal operations.  Skip the cleanup phase "
                             "that typically removes files in TARGET that no longer exist in SOURCE")
+        parser.add_argument("--disable-state", action="store_true", default=False, help=dedent(f"""
+            Don't use or update the ``{CONTROLLED_DIR_STATE}`` state file.
+            By default, output files whose sources are unchanged since the last run are skipped,
+            and only previously combined files are considered for cleanup.
+            Use this option to rebuild every file and scan TARGET for unwanted files.
+            """))
+
+    @staticmethod
+    def load_target_spec(path: str, layer_filter: List[tuple]) -> List[tuple]:
+        """ Return a list of (target, LayerFilter) from a target spec file.  The rules given by
+        ``layer_filter`` are added to each target's filter. """
+        with open(path, encoding="utf-8") as f:
+            spec = json.load(f)
+        spec_dir = Path(path).parent
+        targets = []
+        for entry in spec["targets"]:
+            rules = [("include", pattern) for pattern in entry.get("include", [])]
+            rules.extend(("exclude", pattern) for pattern in entry.get("exclude", []))
+            rules.extend(layer_filter)
+            targets.append((spec_dir / entry["target"], LayerFilter().add_rules(rules)))
+        if not targets:
+            raise ValueError("No targets given")
+        return targets
 
     def run(self, args):
+        if not args.target and not args.target_spec:
+            self.parser.error("the following arguments are required: --target")
+        elif args.target and args.target_spec:
+            self.parser.error("argument --target-spec: not allowed with argument --target")
         combiner = RepeatableCombiner(follow_symlink=args.follow_symlink, banner=args.banner,
                                       dry_run=args.dry_run, quiet=args.quiet,
                                       keep_existing=args.keep_existing,
                                       disable_cleanup=args.disable_cleanup,
-                                      disable_marker=args.disable_marker)
+                                      disable_marker=args.disable_marker,
+                                      disable_state=args.disable_state,
+                                      jobs=args.jobs,
+                                      link_mode=args.link_mode)
 
         # For now, just copy all settings from 'args' to class instance... needs work
         combiner.stdout = self.stdout
@@ -246,8 +486,16 @@ class CombineCmd(KsconfCmd):
         if args.template_vars:
             combiner.context.template_variables = self.parse_extra_vars(args.template_vars, "template-vars")
 
-        for (action, pattern) in args.layer_filter:
-            combiner.add_layer_filter(action, pattern)
+        if args.target_spec:
+            try:
+                targets = self.load_target_spec(args.target_spec, args.layer_filter)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.stderr.write(f"Unable to load target spec {args.target_spec}:  {e}\n")
+                return EXIT_CODE_BAD_ARGS
+        else:
+            targets = []
+            for (action, pattern) in args.layer_filter:
+                combiner.add_layer_filter(action, pattern)
 
         # Expand any globs in the CLI to individual directories
         args.source = list(expand_glob_list(args.source, do_sort=True))
@@ -282,9 +530,17 @@ class CombineCmd(KsconfCmd):
                 self.stderr.write(f"Reading conf files from directory {src}\n")
             combiner.set_source_dirs(args.source)
 
-        self.stderr.write(f"Combining files into directory {args.target}\n")
-
+        # Avoid reading unchanged files more than once while comparing sources and outputs
+        enable_file_hash_memo()
         try:
-            combiner.combine(args.target, hook_label="combine")
+            if targets:
+                for target, _ in targets:
+                    self.stderr.write(f"Combining files into directory {target}\n")
+                combiner.combine_targets(targets, hook_label="combine")
+            else:
+                self.stderr.write(f"Combining files into directory {args.target}\n")
+                combiner.combine(args.target, hook_label="combine")
         except LayerCombinerExceptionCode as e:
             return e.return_code
+        finally:
+            enable_file_hash_memo(False)
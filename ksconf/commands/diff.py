@@ -6,17 +6,109 @@ Usage example:
 
     ksconf diff default/props.conf default/props.conf
 
+    ksconf diff build/my_app-1.0.spl build/my_app-1.1.spl
+
 """
 from __future__ import absolute_import, unicode_literals
 
 import argparse
+import os
+import tempfile
+from io import StringIO
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional, Tuple
 
+from ksconf.app.manifest import AppArchiveContentError, AppManifest, AppManifestFile
+from ksconf.archive import extract_archive
 from ksconf.command import ConfFileType, KsconfCmd, dedent
-from ksconf.conf.delta import compare_cfgs, show_diff, write_diff_as_json
-from ksconf.conf.parser import PARSECONF_MID_NC
-from ksconf.consts import EXIT_CODE_DIFF_EQUAL, EXIT_CODE_DIFF_NO_COMMON
+from ksconf.conf.delta import DiffHeader, compare_cfgs, show_diff, write_diff_as_json
+from ksconf.conf.parser import PARSECONF_MID_NC, ConfParserException, parse_conf
+from ksconf.consts import (EXIT_CODE_BAD_ARCHIVE_FILE, EXIT_CODE_BAD_ARGS,
+                           EXIT_CODE_BAD_CONF_FILE, EXIT_CODE_DIFF_CHANGE,
+                           EXIT_CODE_DIFF_EQUAL, EXIT_CODE_DIFF_NO_COMMON)
+from ksconf.util import process_pool
 from ksconf.util.completers import conf_files_completer
 
+ARCHIVE_EXTENSIONS = (".spl", ".tgz", ".tar.gz", ".zip")
+CONF_EXTENSIONS = (".conf", ".meta")
+
+
+class ConfTreeType(ConfFileType):
+    """ Like :py:class:`ConfFileType`, except that directories and app archives are returned as a
+    :py:class:`~pathlib.Path` for recursive comparison. """
+
+    def __call__(self, string):
+        if os.path.isdir(string) or \
+                (os.path.isfile(string) and string.lower().endswith(ARCHIVE_EXTENSIONS)):
+            return Path(string)
+        return super().__call__(string)
+
+
+class _OutputBuffer(StringIO):
+    """ Capture output in a worker process, while keeping the terminal color behavior of the
+    final output stream. """
+
+    def __init__(self, tty: bool):
+        super().__init__()
+        self._tty = tty
+
+    def isatty(self):
+        return self._tty
+
+
+def _diff_file_pair(job: Tuple[str, str, str, str, str, bool, bool]) -> Tuple[int, str]:
+    """ Parse and compare a single pair of conf files.  Runs in a worker process. """
+    path1, path2, name1, name2, replace_level, comments, tty = job
+    profile = dict(PARSECONF_MID_NC, keep_comments=comments)
+    try:
+        cfg1 = parse_conf(path1, profile=profile)
+        cfg2 = parse_conf(path2, profile=profile)
+    except ConfParserException as e:
+        return EXIT_CODE_BAD_CONF_FILE, f"Failed to parse {name1} or {name2}:  {e}\n"
+    diffs = compare_cfgs(cfg1, cfg2, replace_level=replace_level)
+    headers = (DiffHeader(name1, os.stat(path1).st_mtime),
+               DiffHeader(name2, os.stat(path2).st_mtime))
+    stream = _OutputBuffer(tty)
+    rc = show_diff(stream, diffs, headers=headers)
+    return rc, stream.getvalue()
+
+
+class _DiffSource:
+    """ One side of a recursive comparison:  either a directory or an app archive. """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.is_archive = not path.is_dir()
+        self._extracted: Dict[PurePosixPath, str] = {}
+        if self.is_archive:
+            self.manifest = AppManifest.from_archive(path)
+        else:
+            self.manifest = AppManifest.from_filesystem(path)
+        self.files: Dict[PurePosixPath, AppManifestFile] = {f.path: f for f in self.manifest.files}
+
+    def extract(self, relpaths: List[PurePosixPath], temp_dir: str):
+        """ Extract only the requested files from an archive into ``temp_dir``. """
+        if not self.is_archive or not relpaths:
+            return
+        wanted = {f"{self.manifest.name}/{relpath}": relpath for relpath in relpaths}
+        for gaf in extract_archive(self.path, lambda gaf: gaf.path in wanted):
+            relpath = wanted.get(gaf.path)
+            if relpath is None:
+                continue
+            dest = os.path.join(temp_dir, *relpath.parts)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as f:
+                f.write(gaf.payload)
+            self._extracted[relpath] = dest
+
+    def local_path(self, relpath: PurePosixPath) -> str:
+        if self.is_archive:
+            return self._extracted[relpath]
+        return os.fspath(self.path.joinpath(*relpath.parts))
+
+    def display_name(self, relpath: PurePosixPath) -> str:
+        return f"{self.path}/{relpath}"
+
 
 class DiffCmd(KsconfCmd):
     help = "Compare settings differences between two .conf files ignoring spacing and sort order"
@@ -27,16 +119,20 @@ class DiffCmd(KsconfCmd):
     focuses strictly on comparing stanzas, keys, and values.  Note that spaces within
     any given value, will be compared. Multi-line fields are compared in a more traditional
     'diff' output so that long saved searches and macros can be compared more easily.
+
+    Two directories or two app archives (.spl, .tgz, .tar.gz, or .zip) can also be compared.
+    Files are paired by relative path, and only .conf and .meta files with different content
+    are parsed and compared.  Comparisons run in parallel.
     """)
     format = "manual"
     maturity = "stable"
 
     def register_args(self, parser):
         parser.add_argument("conf1", metavar="CONF1", help="Left side of the comparison",
-                            type=ConfFileType("r", "load", parse_profile=PARSECONF_MID_NC)
+                            type=ConfTreeType("r", "load", parse_profile=PARSECONF_MID_NC)
                             ).completer = conf_files_completer
         parser.add_argument("conf2", metavar="CONF2", help="Right side of the comparison",
-                            type=ConfFileType("r", "load", parse_profile=PARSECONF_MID_NC)
+                            type=ConfTreeType("r", "load", parse_profile=PARSECONF_MID_NC)
                             ).completer = conf_files_completer
         parser.add_argument("-o", "--output", metavar="FILE",
                             type=argparse.FileType('w'), default=self.stdout,
@@ -51,16 +147,24 @@ class DiffCmd(KsconfCmd):
                             choices=["diff", "json"], default="diff",
                             help="Output file format to produce.  'diff' the the classic format used by default. "
                             "'json' is helpful when trying to review changes programmatically.")
+        parser.add_argument("--jobs", "-j", metavar="N", type=int, default=None,
+                            help="Number of worker processes used when comparing directories "
+                            "or archives.  Defaults to the number of CPUs.")
 
     def run(self, args):
         ''' Compare two configuration files. '''
+        if isinstance(args.conf1, Path) or isinstance(args.conf2, Path):
+            return self.run_tree(args)
+
         args.conf1.set_parser_option(keep_comments=args.comments)
         args.conf2.set_parser_option(keep_comments=args.comments)
 
         cfg1 = args.conf1.data
         cfg2 = args.conf2.data
 
-        diffs = compare_cfgs(cfg1, cfg2, replace_level=args.detail)
+        # Stanza digests are only available from the persistent parse cache
+        diffs = compare_cfgs(cfg1, cfg2, replace_level=args.detail,
+                             a_digests=args.conf1.digests, b_digests=args.conf2.digests)
 
         if args.format == "diff":
             rc = show_diff(args.output, diffs, headers=(args.conf1.name, args.conf2.name))
@@ -72,3 +176,78 @@ class DiffCmd(KsconfCmd):
         elif args.format == "json":
             # XXX: Refactor show_diff() to separate the do-we-have-a-change logic
             write_diff_as_json(diffs, args.output, indent=4)
+
+    def run_tree(self, args):
+        ''' Compare two directories or app archives. '''
+        if not (isinstance(args.conf1, Path) and isinstance(args.conf2, Path)):
+            self.stderr.write("Both sides of the comparison must be a directory or an archive.\n")
+            return EXIT_CODE_BAD_ARGS
+        if args.format != "diff":
+            self.stderr.write("Only the 'diff' output format is supported when comparing "
+                              "directories or archives.\n")
+            return EXIT_CODE_BAD_ARGS
+        try:
+            source1 = _DiffSource(args.conf1)
+            source2 = _DiffSource(args.conf2)
+        except AppArchiveContentError as e:
+            self.stderr.write(f"{e}\n")
+            return EXIT_CODE_BAD_ARCHIVE_FILE
+
+        only1 = sorted(set(source1.files) - set(source2.files))
+        only2 = sorted(set(source2.files) - set(source1.files))
+        changed = []
+        for relpath in sorted(set(source1.files) & set(source2.files)):
+            file1 = source1.files[relpath]
+            file2 = source2.files[relpath]
+            # Fast path:  Identical content is skipped without parsing
+            if file1.size != file2.size or not file1.content_match(file2):
+                changed.append(relpath)
+        changed_confs = [p for p in changed if p.name.endswith(CONF_EXTENSIONS)]
+
+        tty = bool(getattr(args.output, "isatty", None) and args.output.isatty())
+        with tempfile.TemporaryDirectory(prefix="ksconf-diff-") as temp_dir:
+            source1.extract(changed_confs, os.path.join(temp_dir, "1"))
+            source2.extract(changed_confs, os.path.join(temp_dir, "2"))
+            jobs = [(source1.local_path(p), source2.local_path(p),
+                     source1.display_name(p), source2.display_name(p),
+                     args.detail, args.comments, tty) for p in changed_confs]
+            results = self._run_jobs(jobs, args.jobs)
+
+        rc = EXIT_CODE_DIFF_EQUAL
+        conf_results = dict(zip(changed_confs, results))
+        modified = []
+        for relpath in sorted(only1 + only2 + changed):
+            if relpath in conf_results:
+                file_rc, output = conf_results[relpath]
+                args.output.write(output)
+                if file_rc == EXIT_CODE_BAD_CONF_FILE:
+                    rc = EXIT_CODE_BAD_CONF_FILE
+                elif file_rc == EXIT_CODE_DIFF_EQUAL:
+                    continue
+            elif relpath in source1.files and relpath in source2.files:
+                args.output.write(f"Files {source1.display_name(relpath)} and "
+                                  f"{source2.display_name(relpath)} differ\n")
+            else:
+                source = source1 if relpath in source1.files else source2
+                args.output.write(f"Only in {source.path}: {relpath}\n")
+            modified.append(relpath)
+            if rc == EXIT_CODE_DIFF_EQUAL:
+                rc = EXIT_CODE_DIFF_CHANGE
+        args.output.flush()
+
+        total = len(set(source1.files) | set(source2.files))
+        self.stderr.write(f"Compared {total} files:  {total - len(modified)} same, "
+                          f"{len(modified) - len(only1) - len(only2)} changed, "
+                          f"{len(only1)} only in {source1.path}, "
+                          f"{len(only2)} only in {source2.path}\n")
+        return rc
+
+    @staticmethod
+    def _run_jobs(jobs: List[tuple], workers: Optional[int]) -> List[Tuple[int, str]]:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(jobs))
+        if workers <= 1:
+            return [_diff_file_pair(job) for job in jobs]
+        with process_pool(workers) as executor:
+            return list(executor.map(_diff_file_pair, jobs, chunksize=4))
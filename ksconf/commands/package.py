@@ -45,6 +45,10 @@ class PackageCmd(KsconfCmd):
     If both layering and templating are in use at the same time, be aware that templates are
     rendered prior to layering operations.  This allows, for example, one layer to include a simple
     ``indexes.conf`` file and another layer to include an ``indexes.conf.j2`` template.
+
+    When the ``KSCONF_CACHE_DIR`` environment variable is set, the most recent archive of each app
+    is kept in a build cache.  If neither the source files nor any packaging options have changed
+    since then, the cached archive is reused instead of building the app again.
     """)
     # format = "manual"
     maturity = "beta"
@@ -149,6 +153,11 @@ class PackageCmd(KsconfCmd):
                                  "the archive is written.  "
                                  "This is useful in build scripts when the SPL contains variables "
                                  "so the final name may not be known ahead of time.")
+        pbuild.add_argument("--compress-level", metavar="LEVEL", type=int, default=9,
+                            choices=range(10),
+                            help="Gzip compression level, from 0 (no compression) to 9 (best "
+                                 "compression).  Compression runs on all available CPUs.  "
+                                 "Defaults to %(default)s.")
 
     @staticmethod
     def load_blocklist(path: str) -> Iterable[str]:
@@ -210,33 +219,24 @@ class PackageCmd(KsconfCmd):
                                template_variables=template_vars)
 
         with packager:
-            packager.combine(args.source, args.layer_filter,
-                             layer_method=args.layer_method,
-                             allow_symlink=args.follow_symlink)
-            # Handle local files
-            if args.local == "merge":
-                packager.merge_local()
-            elif args.local == "block":
-                packager.block_local()
-            elif args.local == "preserve":
-                pass
-            else:   # pragma: no cover
-                raise ValueError(f"Unknown value for 'local': {args.local}")
-
-            if args.blocklist:
-                self.stderr.write(f"Applying blocklist:  {args.blocklist!r}\n")
-                packager.blocklist(args.blocklist)
-
-            if args.set_build or args.set_version:
-                packager.update_app_conf(
-                    version=args.set_version,
-                    build=args.set_build)
-
-            packager.check()
-            # os.system(f"ls -lR {packager.app_dir}")
-
-            dest = args.file or "{}-{{{{version}}}}.tgz".format(packager.app_name.lower().replace("-", "_"))
-            archive_path = packager.make_archive(dest)
+            cache_key = packager.build_cache_key(
+                args.source, args.layer_filter,
+                layer_method=args.layer_method,
+                allow_symlink=args.follow_symlink,
+                blocklist=args.blocklist,
+                options={
+                    "file": os.path.abspath(args.file) if args.file else None,
+                    "local": args.local,
+                    "set_version": args.set_version,
+                    "set_build": args.set_build,
+                    "enable_handler": args.enable_handler,
+                    "compress_level": args.compress_level,
+                })
+            archive_path = packager.load_cached_archive(cache_key) if cache_key else None
+            if not archive_path:
+                archive_path = self.build_archive(packager, args)
+                if cache_key:
+                    packager.store_cached_archive(cache_key, archive_path)
             self.stderr.write("Archive created:  file={} size={:.2f}Kb\n".format(
                 os.path.basename(archive_path), os.stat(archive_path).st_size / 1024.0))
 
@@ -246,3 +246,31 @@ class PackageCmd(KsconfCmd):
                     f.write(archive_path)
 
         return EXIT_CODE_SUCCESS
+
+    def build_archive(self, packager: AppPackager, args) -> str:
+        if args.blocklist:
+            self.stderr.write(f"Applying blocklist:  {args.blocklist!r}\n")
+        packager.combine(args.source, args.layer_filter,
+                         layer_method=args.layer_method,
+                         allow_symlink=args.follow_symlink,
+                         blocklist=args.blocklist)
+        # Handle local files
+        if args.local == "merge":
+            packager.merge_local()
+        elif args.local == "block":
+            packager.block_local()
+        elif args.local == "preserve":
+            pass
+        else:   # pragma: no cover
+            raise ValueError(f"Unknown value for 'local': {args.local}")
+
+        if args.set_build or args.set_version:
+            packager.update_app_conf(
+                version=args.set_version,
+                build=args.set_build)
+
+        packager.check()
+        # os.system(f"ls -lR {packager.app_dir}")
+
+        dest = args.file or "{}-{{{{version}}}}.tgz".format(packager.app_name.lower().replace("-", "_"))
+        return packager.make_archive(dest, compress_level=args.compress_level)
@@ -16,6 +16,7 @@ import sys
 from argparse import FileType
 
 from ksconf.command import KsconfCmd, dedent
+from ksconf.conf.compact import CompactStanza
 from ksconf.conf.parser import GLOBAL_STANZA, PARSECONF_MID_NC, ConfParserException, parse_conf
 from ksconf.consts import EXIT_CODE_NO_SUCH_FILE, EXIT_CODE_SUCCESS
 from ksconf.util.completers import DirectoriesCompleter, FilesCompleter
@@ -73,7 +74,8 @@ class ConfSnapshot:
         record["meta"] = self._decode_path_meta(path)
         record["file"] = self._get_file_info(path)
         try:
-            data = parse_conf(path, profile=PARSECONF_MID_NC)
+            # Compact stanzas keep memory use down when snapshotting an entire etc tree
+            data = parse_conf(path, profile=dict(PARSECONF_MID_NC, compact=True))
             # May need to format this differently.   Specifically need some way to textually
             # indicate the global stanza
             conf = record["conf"] = []
@@ -111,9 +113,16 @@ class ConfSnapshot:
             },
         }
         record["records"] = self._data
+        kwargs.setdefault("default", _json_default)
         json.dump(record, stream, **kwargs)
 
 
+def _json_default(obj):
+    if isinstance(obj, CompactStanza):
+        return dict(obj.items())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 class SnapshotCmd(KsconfCmd):
     help = "Snapshot .conf file directories into a JSON dump format"
     description = dedent("""\
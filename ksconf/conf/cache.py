@@ -0,0 +1,228 @@
+""" ksconf.conf.cache:  Persistent on-disk cache of parsed ``.conf`` files
+
+The cache is opt-in.  It's enabled by setting the ``KSCONF_CACHE_DIR`` environmental variable to a
+writable directory.  Parsed files are stored under the ``parse`` subdirectory, keyed by the file's
+identity (path, device, inode, size, mtime, ctime) and the parser profile used.  Any change to the
+file results in a new key, so stale entries are never returned; they simply age out via LRU
+eviction once the cache exceeds its size limit (``KSCONF_PARSE_CACHE_MB``, default 256 MB).
+
+Entries are written to a temporary file and atomically renamed into place, so multiple processes
+can safely share the same cache directory without locking.  Any unreadable entry is treated as a
+cache miss.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import marshal
+import os
+import sys
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+from warnings import warn
+
+from ksconf.conf.compact import CompactStanza
+from ksconf.conf.delta import conf_digests
+from ksconf.conf.parser import GLOBAL_STANZA, ConfType, ParserConfig, Token
+from ksconf.consts import KSCONF_CACHE_DIR
+from ksconf.types import StrPath
+from ksconf.util.file import get_cache_dir
+
+__all__ = [
+    "ParseCache",
+    "get_parse_cache",
+]
+
+KSCONF_PARSE_CACHE_MB = "KSCONF_PARSE_CACHE_MB"
+
+# Bump if the serialized format or the parser's output changes in an incompatible way
+_CACHE_FORMAT = 1
+
+
+def _profile_key(profile: ParserConfig) -> Tuple[Tuple[str, str], ...]:
+    """ Return a stable, hashable representation of a parser profile. """
+    return tuple(sorted((k, str(getattr(v, "value", v))) for k, v in profile.items()))
+
+
+class ParseCache:
+    """ Size-bounded, multi-process safe, persistent cache of parsed conf files.
+
+    :param cache_dir: Directory where cache entries are stored.  Created if missing.
+    :param max_size: Maximum total size, in bytes, of all cache entries.  When exceeded, the least
+                     recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir: StrPath, max_size: int = 256 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._bytes_written = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _file_identity(path: Path) -> Tuple:
+        st = os.stat(path)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def _entry_path(self, key: tuple) -> Path:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest[2:]}.bin"
+
+    def make_key(self, path: StrPath, profile: ParserConfig, encoding: Optional[str] = None) -> tuple:
+        path = Path(os.path.abspath(path))
+        return (_CACHE_FORMAT, sys.version_info[:2], os.fspath(path), self._file_identity(path),
+                _profile_key(profile), encoding)
+
+    @staticmethod
+    def _dump(key: tuple, conf: ConfType) -> bytes:
+        stanzas = [(None if name is GLOBAL_STANZA else name,
+                    stanza if type(stanza) in (dict, bytes) else dict(stanza.items()))
+                   for name, stanza in conf.items()]
+        return marshal.dumps((key, stanzas))
+
+    @staticmethod
+    def _load(key: tuple, data: bytes) -> Optional[ConfType]:
+        stored_key, stanzas = marshal.loads(data)
+        if stored_key != key:
+            # Hash collision, or entry written by an incompatible version
+            return None
+        return {GLOBAL_STANZA if name is None else name: stanza
+                for name, stanza in stanzas}
+
+    def get(self, key: tuple) -> Optional[ConfType]:
+        entry = self._entry_path(key)
+        try:
+            data = entry.read_bytes()
+            conf = self._load(key, data)
+        except (OSError, EOFError, ValueError, TypeError):
+            conf = None
+        if conf is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            # Record access time for LRU eviction
+            os.utime(entry)
+        except OSError:
+            pass
+        return conf
+
+    def put(self, key: tuple, conf: ConfType):
+        entry = self._entry_path(key)
+        data = self._dump(key, conf)
+        entry.parent.mkdir(exist_ok=True)
+        temp = entry.with_name(f"{entry.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp")
+        try:
+            temp.write_bytes(data)
+            os.replace(temp, entry)
+        except OSError:
+            # Caching is best-effort.  Never fail a parse because the cache is unwritable
+            if temp.is_file():
+                temp.unlink()
+            return
+        self._bytes_written += len(data)
+        if self._bytes_written > self.max_size // 10:
+            self.prune()
+
+    def parse_conf(self,
+                   path: StrPath,
+                   profile: ParserConfig,
+                   encoding: Optional[str],
+                   parse: Callable[[StrPath, ParserConfig, Optional[str]], ConfType]
+                   ) -> ConfType:
+        """ Return the parsed content of ``path`` from the cache, or call ``parse`` on a cache miss
+        and store the result. """
+        try:
+            key = self.make_key(path, profile, encoding)
+        except OSError:
+            # Let the parser report missing files and such
+            return parse(path, profile, encoding)
+        conf = self.get(key)
+        if conf is None:
+            conf = parse(path, profile, encoding)
+            self.put(key, conf)
+        elif profile.get("compact"):
+            conf = {name: CompactStanza(stanza) for name, stanza in conf.items()}
+        return conf
+
+    def digests(self,
+                path: StrPath,
+                profile: ParserConfig,
+                encoding: Optional[str],
+                parse: Callable[[StrPath, ParserConfig, Optional[str]], ConfType],
+                conf: Optional[ConfType] = None
+                ) -> Dict[Union[str, Token], bytes]:
+        """ Return the stanza digests (see :py:func:`~ksconf.conf.delta.conf_digests`) of ``path``.
+        Digests are cached separately from the parsed content, so they are only computed once for
+        any given version of a file.  If the caller already has the parsed content of ``path``,
+        pass it as ``conf`` to avoid loading it again on a cache miss. """
+        try:
+            key = self.make_key(path, profile, encoding) + ("digests",)
+        except OSError:
+            if conf is None:
+                conf = parse(path, profile, encoding)
+            return conf_digests(conf)
+        digests = self.get(key)
+        if digests is None:
+            if conf is None:
+                conf = self.parse_conf(path, profile, encoding, parse)
+            digests = conf_digests(conf)
+            self.put(key, digests)
+        return digests
+
+    def prune(self):
+        """ Remove least recently used entries until the cache fits within ``max_size``. """
+        self._bytes_written = 0
+        entries = []
+        total = 0
+        for entry in self.cache_dir.glob("*/*.bin"):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry))
+            total += st.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, entry in entries:
+            try:
+                entry.unlink()
+            except OSError:
+                # Already removed by a concurrent process
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self):
+        """ Remove all cache entries. """
+        for entry in self.cache_dir.glob("*/*.bin"):
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+
+
+_parse_cache: Tuple[Optional[str], Optional[ParseCache]] = (None, None)
+
+
+def get_parse_cache() -> Optional[ParseCache]:
+    """ Return the process-wide :py:class:`ParseCache` if caching is enabled via the
+    ``KSCONF_CACHE_DIR`` environmental variable, otherwise None.
+
+    The cache is best-effort.  If it can't be set up, a warning is issued (once) and None is
+    returned, so parsing simply proceeds without the cache. """
+    global _parse_cache
+    cache_dir = os.environ.get(KSCONF_CACHE_DIR)
+    if _parse_cache[0] != cache_dir:
+        cache = None
+        if cache_dir:
+            try:
+                max_mb = int(os.environ.get(KSCONF_PARSE_CACHE_MB, 256))
+                cache = ParseCache(get_cache_dir("parse"), max_size=max_mb * 1024 * 1024)
+            except (ValueError, OSError) as e:
+                warn(f"Parse cache disabled due to {e}", RuntimeWarning)
+        _parse_cache = (cache_dir, cache)
+    return _parse_cache[1]
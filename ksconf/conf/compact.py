@@ -0,0 +1,162 @@
+""" ksconf.conf.compact:  Memory efficient stanza representation
+
+Parsed conf files are normally nested ``dict`` objects.  When many stanzas share the same set of
+attribute names (think ``savedsearches.conf`` or ``props.conf`` across an entire ``etc/apps``
+tree), most of that memory is spent on per-stanza hash tables and duplicate key strings.
+
+:py:class:`CompactStanza` is a drop-in ``MutableMapping`` replacement for a stanza ``dict``.
+Attribute names are interned and stored in shared, immutable *layouts* (similar to the hidden
+classes used by JavaScript engines), so each stanza only holds a list of values.  Short values
+are interned too, allowing identical values to be shared across stanzas, files, and layers.
+
+Enable by adding ``compact=True`` to the parser profile::
+
+    conf = parse_conf(path, profile=dict(PARSECONF_MID_NC, compact=True))
+
+See ``tests/benchmark_compact.py`` for measurements.
+"""
+
+from __future__ import annotations
+
+from collections.abc import ItemsView, Mapping, MutableMapping, ValuesView
+from sys import intern
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from weakref import WeakValueDictionary
+
+__all__ = [
+    "CompactStanza",
+    "intern_value",
+]
+
+# Values longer than this are rarely repeated; interning them would only bloat the intern table
+INTERN_VALUE_MAX = 128
+
+
+def intern_value(value: str) -> str:
+    """ Intern short string values so that identical values share a single object. """
+    if type(value) is str and len(value) <= INTERN_VALUE_MAX:
+        return intern(value)
+    return value
+
+
+class _Layout:
+    """ Immutable, shared, ordered set of attribute names.  Layouts form a tree rooted at an
+    empty layout where each child adds one key.  Stanzas built by adding the same keys in the
+    same order end up sharing the same layout object.
+
+    Children are only weakly referenced by their parent (while each child keeps its parent
+    alive), so layouts no longer used by any stanza are freed. """
+    __slots__ = ("keys", "index", "_parent", "_children", "__weakref__")
+
+    def __init__(self, keys: Tuple[str, ...], parent: Optional[_Layout] = None):
+        self.keys = keys
+        self.index: Dict[str, int] = {key: i for i, key in enumerate(keys)}
+        self._parent = parent
+        self._children: WeakValueDictionary[str, _Layout] = WeakValueDictionary()
+
+    def add(self, key: str) -> _Layout:
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = _Layout(self.keys + (key,), self)
+        return child
+
+    @classmethod
+    def from_keys(cls, keys: Iterable[str]) -> _Layout:
+        layout = _root_layout
+        for key in keys:
+            layout = layout.add(key)
+        return layout
+
+
+_root_layout = _Layout(())
+
+
+class _CompactItemsView(ItemsView):
+    def __iter__(self):
+        return zip(self._mapping._layout.keys, self._mapping._values)
+
+
+class _CompactValuesView(ValuesView):
+    def __iter__(self):
+        return iter(self._mapping._values)
+
+
+class CompactStanza(MutableMapping):
+    """ A stanza (attribute to value mapping) that uses shared key layouts and interned strings.
+    Behaves like a ``dict``, including insertion ordering and equality with regular dicts. """
+    __slots__ = ("_layout", "_values")
+
+    def __init__(self, data: Optional[Mapping] = None, **kwargs):
+        self._layout = _root_layout
+        self._values: List[str] = []
+        if data is not None:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    def __getitem__(self, key: str) -> str:
+        return self._values[self._layout.index[key]]
+
+    def __setitem__(self, key: str, value: str):
+        value = intern_value(value)
+        try:
+            self._values[self._layout.index[key]] = value
+        except KeyError:
+            self._layout = self._layout.add(intern(key) if type(key) is str else key)
+            self._values.append(value)
+
+    def __delitem__(self, key: str):
+        i = self._layout.index[key]
+        keys = self._layout.keys
+        del self._values[i]
+        self._layout = _Layout.from_keys(keys[:i] + keys[i + 1:])
+
+    def __contains__(self, key) -> bool:
+        return key in self._layout.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._layout.keys)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, CompactStanza) and self._layout is other._layout:
+            return self._values == other._values
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __copy__(self) -> CompactStanza:
+        new = CompactStanza()
+        new._layout = self._layout
+        new._values = list(self._values)
+        return new
+
+    copy = __copy__
+
+    def __deepcopy__(self, memo) -> CompactStanza:
+        # Values are immutable strings; a shallow copy is sufficient
+        new = memo[id(self)] = self.__copy__()
+        return new
+
+    def __reduce__(self):
+        return (type(self), (dict(self.items()),))
+
+    def items(self) -> ItemsView:
+        return _CompactItemsView(self)
+
+    def values(self) -> ValuesView:
+        return _CompactValuesView(self)
+
+    def update(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and not self._values and type(args[0]) is dict:
+            # Fast path for building a new stanza from a dict
+            data = args[0]
+            self._layout = _Layout.from_keys(intern(k) if type(k) is str else k for k in data)
+            self._values = [intern_value(v) for v in data.values()]
+        else:
+            super().update(*args, **kwargs)
@@ -1,14 +1,17 @@
 import datetime
 import difflib
+import hashlib
 import os
 from collections import Counter, defaultdict
+from collections.abc import Mapping
 from dataclasses import dataclass
 from enum import Enum
 from io import open
 from os import PathLike, fspath
-from typing import List, NamedTuple, Optional, Sequence, TextIO, Union
+from typing import Dict, List, NamedTuple, Optional, Sequence, TextIO, Union
 
-from ksconf.conf.parser import GLOBAL_STANZA, ConfType, StanzaType, _format_stanza, default_encoding
+from ksconf.conf.parser import (GLOBAL_STANZA, ConfType, StanzaType, Token,
+                                _format_stanza, default_encoding)
 from ksconf.consts import EXIT_CODE_DIFF_CHANGE, EXIT_CODE_DIFF_EQUAL, EXIT_CODE_DIFF_NO_COMMON
 from ksconf.util.compare import cmp_sets
 from ksconf.util.terminal import ANSI_BOLD, ANSI_GREEN, ANSI_RED, ANSI_RESET, ANSI_YELLOW, TermColor
@@ -137,8 +140,23 @@ def _compare_stanzas(a: StanzaType, b: StanzaType,
             yield DiffOp(DiffVerb.REPLACE, DiffStzKey(DiffLevel.KEY, stanza_name, key), a_, b_)
 
 
+def stanza_digest(stanza: StanzaType) -> bytes:
+    """ Return a stable digest of a stanza's content.  Like ``dict`` equality, key order is
+    ignored.  Two stanzas with the same digest are considered equal by :py:func:`compare_cfgs`.
+    """
+    return hashlib.blake2b(repr(sorted(stanza.items())).encode("utf-8", "surrogatepass"),
+                           digest_size=16).digest()
+
+
+def conf_digests(conf: ConfType) -> Dict[Union[str, Token], bytes]:
+    """ Return a mapping of stanza name to :py:func:`stanza_digest` for an entire conf. """
+    return {name: stanza_digest(stanza) for name, stanza in conf.items()}
+
+
 def compare_cfgs(a: ConfType, b: ConfType,
-                 replace_level: DiffLevel = DiffLevel.GLOBAL
+                 replace_level: DiffLevel = DiffLevel.GLOBAL,
+                 a_digests: Optional[Mapping[Union[str, Token], bytes]] = None,
+                 b_digests: Optional[Mapping[Union[str, Token], bytes]] = None,
                  ) -> List[DiffOp]:
     """
     Calculate a set of deltas which describes how to transform a into b.
@@ -157,6 +175,11 @@ def compare_cfgs(a: ConfType, b: ConfType,
                 terms of key changes.  Whereas 'global' or 'stanza' would result in a single giant replace op.
 
     :type replace_level: str: ``global``, ``stanza``, or ``key``
+    :param a_digests: Optional stanza digests of ``a``, as returned by :py:func:`conf_digests`.
+    :param b_digests: Optional stanza digests of ``b``.  When digests are given for both sides,
+        stanzas with matching digests are reported as equal without comparing their content.
+        This is most useful when the digests are cached, see
+        :py:meth:`~ksconf.conf.cache.ParseCache.digests`.
     :return: a sequence of differences in tuples
     :rtype: [DiffOp]
 
@@ -215,13 +238,14 @@ def compare_cfgs(a: ConfType, b: ConfType,
                             f"replace_level.  Choose 'global', 'stanza', or 'key'")
 
     delta = []
+    if a_digests is None or b_digests is None:
+        a_digests = b_digests = None
 
     # Level 0 - Compare entire file
     if replace_level == DiffLevel.GLOBAL:
-        stanza_a, stanza_common, stanza_b = cmp_sets(list(a.keys()), list(b.keys()))
-        if a == b:
+        if (a == b) if a_digests is None else (a_digests == b_digests):
             return [DiffOp(DiffVerb.EQUAL, DiffGlobal(DiffLevel.GLOBAL), a, b)]
-        if not stanza_common:
+        if not (a.keys() & b.keys()):
             # Q:  Does this specific output make the consumer's job more difficult?
             # Nothing in common between these two files
             # Note:  Stanza renames are not detected and are out of scope.
@@ -238,7 +262,16 @@ def compare_cfgs(a: ConfType, b: ConfType,
         all_stanzas = list(all_stanzas)
     all_stanzas = sorted(all_stanzas)
     for stanza in all_stanzas:
-        delta.extend(compare_stanzas(a.get(stanza), b.get(stanza), stanza, replace_level))
+        stanza_a = a.get(stanza)
+        stanza_b = b.get(stanza)
+        digest = a_digests.get(stanza) if a_digests is not None else None
+        same_digest = digest is not None and digest == b_digests.get(stanza)
+        if stanza_a is not None and stanza_b is not None and (stanza_a is stanza_b or same_digest):
+            # Fast path:  Skip the content comparison
+            delta.append(DiffOp(DiffVerb.EQUAL, DiffStanza(DiffLevel.STANZA, stanza),
+                                stanza_a, stanza_b))
+        else:
+            delta.extend(compare_stanzas(stanza_a, stanza_b, stanza, replace_level))
     return delta
 
 
@@ -330,7 +363,7 @@ def show_diff(stream: TextIO, diffs: List[DiffOp], headers=None) -> int:
     def show_value(value, stanza_, key, prefix_=""):
         with tc:
             tc.color(_diff_color_mapping.get(prefix_))
-            if isinstance(value, dict):
+            if isinstance(value, Mapping):
                 if stanza_ is not GLOBAL_STANZA:
                     stream.write(f"{prefix_}[{stanza_}]\n")
                 for x, y in sorted(value.items()):
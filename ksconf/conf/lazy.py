@@ -0,0 +1,242 @@
+""" ksconf.conf.lazy:  Memory-mapped, on-demand conf file reader
+
+:py:class:`LazyConf` provides read-only access to a ``.conf`` file without parsing the entire file
+up front.  When opened, the file is memory-mapped and scanned once to build an index of stanza
+header byte offsets.  Each stanza body is decoded and parsed only when first accessed.
+
+This is ideal for point lookups (like ``ksconf attr-get``) against very large files.  Note that,
+because stanzas are parsed on demand, a syntax error in one stanza is only reported when that
+stanza is accessed.  Duplicate stanzas are detected while building the index.
+"""
+
+from __future__ import annotations
+
+import mmap
+import re
+from io import StringIO
+from itertools import chain
+from os import fspath
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+from ksconf.conf.parser import (DUP_EXCEPTION, DUP_MERGE, DUP_OVERWRITE,
+                                GLOBAL_STANZA, PARSECONF_MID,
+                                ConfParserException, DuplicateStanzaException,
+                                ParserConfig, StanzaType, Token, _detect_lite,
+                                _format_stanza, _section_re, parse_conf,
+                                parse_conf_stream)
+from ksconf.types import StrPath
+
+__all__ = [
+    "LazyConf",
+]
+
+# Lines where '[' is preceded only by spaces, control characters, or non-ASCII bytes.  This is a
+# cheap superset of possible stanza headers (which allow any leading whitespace).  Headers are
+# confirmed using the parser's own regex once line continuations are accounted for.
+_header_candidate_re = re.compile(rb"\n[^\x21-\x5a\x5c-\x7e\n]*\[")
+
+_Span = Tuple[int, int]
+
+
+class LazyConf(Mapping[Union[str, Token], Mapping[str, str]]):
+    """ Read-only mapping of stanza name to stanza content, parsed on demand.
+
+    :param path: Path to the ``.conf`` file.
+    :param profile: Parser profile.  Same as :py:func:`~ksconf.conf.parser.parse_conf`.
+    :param encoding: Encoding of the file.  Detected from the BOM when not given.
+
+    Use as a context manager, or call :py:meth:`close`, to release the memory mapping.
+    Files that are not UTF-8 encoded are parsed in full up front.
+    """
+
+    def __init__(self, path: StrPath,
+                 profile: ParserConfig = PARSECONF_MID,
+                 encoding: Optional[str] = None):
+        self.path = fspath(path)
+        self.profile = profile
+        self._handle_conts = profile.get("handle_conts", True)
+        self._cache: Dict[Union[str, Token], Mapping[str, str]] = {}
+        self._index: Dict[Union[str, Token], List[_Span]] = {}
+        self._stream = None
+        self._mm: Union[bytes, mmap.mmap] = b""
+        self._base = 0
+
+        if encoding is None:
+            with open(self.path, "rb") as f:
+                encoding = _detect_lite(f.read(4))["encoding"]
+        self.encoding = encoding
+        if encoding.replace("_", "-").lower() not in ("utf-8", "utf8", "utf-8-sig"):
+            # Byte offset scanning requires an ASCII compatible encoding.  Parse eagerly.
+            conf = parse_conf(self.path, profile, encoding)
+            self._index = {name: [] for name in conf}
+            self._cache = {name: MappingProxyType(stanza) for name, stanza in conf.items()}
+            return
+
+        self._stream = open(self.path, "rb")
+        try:
+            self._mm = mmap.mmap(self._stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._mm = b""
+        if self._mm[:3] == b"\xef\xbb\xbf":
+            self._base = 3
+            self.encoding = "utf-8"
+        self._build_index()
+
+    def __enter__(self) -> LazyConf:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Release the memory map and file handle.  Already parsed stanzas remain available. """
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._mm = b""
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+
+    def _decode(self, start: int, end: int) -> str:
+        try:
+            text = self._mm[start:end].decode(self.encoding)
+        except UnicodeDecodeError as e:
+            raise ConfParserException(f"Encoding error encountered: {e}")
+        # Match the universal newline handling of a text mode file
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    def _is_continued(self, line_end: int) -> bool:
+        """ Does the physical line ending at ``line_end`` (exclusive of newline) end with a
+        line continuation character? """
+        mm = self._mm
+        if line_end > 0 and mm[line_end - 1:line_end] == b"\r":
+            line_end -= 1
+        return line_end > 0 and mm[line_end - 1:line_end] == b"\\"
+
+    def _logical_line(self, line_start: int) -> Tuple[int, int]:
+        """ Return the (start, end) byte offsets of the logical line (after joining continuations)
+        that contains the physical line beginning at ``line_start``.  End includes the newline. """
+        mm = self._mm
+        start = line_start
+        size = len(mm)
+        if self._handle_conts:
+            while start > self._base and self._is_continued(start - 1):
+                start = mm.rfind(b"\n", self._base, start - 1) + 1 or self._base
+        end = line_start
+        while True:
+            nl = mm.find(b"\n", end)
+            if nl == -1:
+                return start, size
+            if not (self._handle_conts and self._is_continued(nl)):
+                return start, nl + 1
+            end = nl + 1
+
+    def _header_name(self, start: int, end: int) -> Optional[str]:
+        text = self._decode(start, end)
+        if self._handle_conts:
+            # Join continuation lines exactly like the parser does
+            lines = text.split("\n")
+            if not lines[-1]:
+                lines.pop()
+            text = "\n".join(line[:-1] if line.endswith("\\") else line for line in lines)
+        mo = _section_re.match(text.rstrip("\r\n"))
+        if mo:
+            return mo.group(1)
+        return None
+
+    def _build_index(self):
+        dup_stanza = self.profile.get("dup_stanza", DUP_EXCEPTION)
+        handle_conts = self._handle_conts
+        mm = self._mm
+        base = self._base
+        size = len(mm)
+        headers: List[Tuple[str, int, int]] = []
+        consumed = base
+        candidates = chain((base,), (m.start() + 1 for m in _header_candidate_re.finditer(mm, base)))
+        for line_start in candidates:
+            if line_start < consumed:
+                # Already handled as part of a multi-line logical line
+                continue
+            nl = mm.find(b"\n", line_start)
+            end = size if nl == -1 else nl + 1
+            start = line_start
+            # A continuation, either of this line or from the previous line
+            continues = mm[line_start:end].rstrip(b"\r\n").endswith(b"\\")
+            continued = mm[max(line_start - 3, base):line_start - 1].endswith((b"\\", b"\\\r"))
+            if handle_conts and (continues or continued):
+                start, end = self._logical_line(line_start)
+                name = self._header_name(start, end)
+            else:
+                # Fast path:  A simple one line header
+                mo = _section_re.match(self._decode(start, end).rstrip("\r\n"))
+                name = mo.group(1) if mo else None
+            consumed = end
+            if name is not None:
+                headers.append((name, start, end))
+
+        index = self._index
+        index[GLOBAL_STANZA] = [(self._base, headers[0][1] if headers else len(self._mm))]
+        for i, (name, start, end) in enumerate(headers):
+            try:
+                block_end = headers[i + 1][1]
+            except IndexError:
+                block_end = len(self._mm)
+                if not name and end >= block_end:
+                    # An empty stanza name '[]' is dropped if it's the last line of the file
+                    continue
+            if name in index:
+                if dup_stanza == DUP_EXCEPTION:
+                    raise DuplicateStanzaException(
+                        f"Stanza [{_format_stanza(name)}] found more than once "
+                        f"in config file {self.path}")
+                elif dup_stanza == DUP_OVERWRITE:
+                    index[name] = [(start, block_end)]
+                elif dup_stanza == DUP_MERGE:
+                    index[name].append((start, block_end))
+                else:
+                    raise TypeError(f"Unknown value '{dup_stanza}' for dup_stanza")
+            else:
+                index[name] = [(start, block_end)]
+
+    def _parse_stanza(self, name: Union[str, Token]) -> Mapping[str, str]:
+        stanza: StanzaType = {}
+        for start, end in self._index[name]:
+            stream = StringIO(self._decode(start, end))
+            stream.name = self.path
+            conf = parse_conf_stream(stream, **self.profile)
+            stanza.update(conf.get(name, {}))
+        return MappingProxyType(stanza)
+
+    def __getitem__(self, name: Union[str, Token]) -> Mapping[str, str]:
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if name not in self._index:
+            raise KeyError(name)
+        stanza = self._parse_stanza(name)
+        if name is GLOBAL_STANZA and not stanza:
+            # Match parse_conf():  An empty global stanza is dropped
+            del self._index[GLOBAL_STANZA]
+            raise KeyError(name)
+        self._cache[name] = stanza
+        return stanza
+
+    def __contains__(self, name) -> bool:
+        if name is GLOBAL_STANZA and name in self._index:
+            try:
+                self[name]
+            except KeyError:
+                return False
+        return name in self._index
+
+    def __iter__(self) -> Iterator[Union[str, Token]]:
+        # Resolve whether or not the global stanza exists before iteration
+        GLOBAL_STANZA in self
+        return iter(list(self._index))
+
+    def __len__(self) -> int:
+        GLOBAL_STANZA in self
+        return len(self._index)
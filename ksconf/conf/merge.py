@@ -3,13 +3,14 @@ from __future__ import absolute_import, unicode_literals
 import os
 import shutil
 import sys
-from copy import deepcopy
-from typing import List, Optional
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, TextIO, Union
 
 from ksconf.command import ConfFileProxy
 from ksconf.conf.delta import compare_cfgs, show_diff
-from ksconf.conf.parser import (GLOBAL_STANZA, ConfType, _extract_comments,
-                                inject_section_comments, parse_conf, write_conf)
+from ksconf.conf.parser import (GLOBAL_STANZA, ConfType, StanzaType, Token,
+                                _extract_comments, inject_section_comments,
+                                parse_conf, write_conf)
 from ksconf.consts import SMART_UPDATE, SmartEnum
 from ksconf.util.file import relwalk
 
@@ -22,9 +23,13 @@ STANZA_MAGIC_KEY = "_stanza"
 STANZA_OP_DROP = "<<DROP>>"
 
 
-def _merge_conf_dicts(base, new_layer):
+def _merge_conf_dicts(base, new_layer, owned=None):
     """ Merge new_layer on top of base.  It's up to the caller to deal with any necessary object
-    copying to avoid odd referencing between the base and new_layer"""
+    copying to avoid odd referencing between the base and new_layer.
+
+    If ``owned`` is given, copy-on-write mode is used:  ``new_layer`` is never modified and any
+    stanza in ``base`` whose name is not in the ``owned`` set is copied before being updated.
+    ``owned`` is updated with the names of stanzas that were copied. """
     for (section, items) in new_layer.items():
         if STANZA_MAGIC_KEY in items:
             magic_op = items[STANZA_MAGIC_KEY]
@@ -32,11 +37,24 @@ def _merge_conf_dicts(base, new_layer):
                 # If this section exist in a parent (base), then drop it now
                 if section in base:
                     del base[section]
+                    if owned is not None:
+                        owned.discard(section)
                 continue  # pragma: no cover  (peephole optimization)
         if section in base:
+            if not items:
+                continue
             # TODO:  Support other magic here...
             # Rip all the comments out of the new_layer, and prepend them (sequentially) to base
-            comments = _extract_comments(items)
+            if owned is None:
+                comments = _extract_comments(items)
+            else:
+                comments = [value for key, value in sorted(items.items()) if key.startswith("#-")]
+                if comments:
+                    items = {key: value for key, value in items.items()
+                             if not key.startswith("#-")}
+                if section not in owned:
+                    base[section] = base[section].copy()
+                    owned.add(section)
             if comments:
                 inject_section_comments(base[section], prepend=comments)
             base[section].update(items)
@@ -47,30 +65,124 @@ def _merge_conf_dicts(base, new_layer):
 
 
 def merge_conf_dicts(*dicts: ConfType) -> ConfType:
+    """ Merge conf layers, where later layers take priority.  Input layers are not modified.
+
+    Stanzas are copied only when a later layer modifies them, so the returned object may share
+    stanza objects with the inputs.  Copy a stanza before modifying it in place.
+    """
     result = {}
+    owned = set()
     for d in dicts:
-        d = deepcopy(d)
         if not result:
-            result = d
+            result = dict(d)
         else:
             # Merge each subsequent layer on one at a time
-            _merge_conf_dicts(result, d)
+            _merge_conf_dicts(result, d, owned)
     return result
 
 
+class MergedConfView(Mapping):
+    """ Read-only view of multiple conf layers that merges each stanza on first access.
+
+    The content matches :py:func:`merge_conf_dicts` called with the same layers, including
+    ``_stanza = <<DROP>>`` handling and comment injection, but only the requested stanzas are
+    merged.  This is ideal for callers that need to read a few values from ``app.conf``, for
+    example.  Layers can be any mapping, including :py:class:`~ksconf.conf.lazy.LazyConf`.
+
+    There is one difference.  If ``<<DROP>>`` removes every stanza merged so far,
+    :py:func:`merge_conf_dicts` takes the next layer as-is, so that layer's own ``<<DROP>>``
+    stanzas are kept in the output.  This view always drops them, because finding the point
+    where the result becomes empty would mean scanning every layer up front.
+
+    Use :py:meth:`materialize` to get a regular ``dict``, such as when writing the result out.
+    """
+
+    def __init__(self, *layers: ConfType):
+        layers = list(layers)
+        # Like merge_conf_dicts(), the first non-empty layer is used as-is
+        while layers and not layers[0]:
+            layers.pop(0)
+        self.layers = layers
+        self._cache: Dict[Union[str, Token], Optional[StanzaType]] = {}
+        self._order: Optional[List[Union[str, Token]]] = None
+
+    def _resolve(self, name: Union[str, Token]) -> Optional[StanzaType]:
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        merged = {}
+        if self.layers:
+            first = self.layers[0]
+            if name in first:
+                merged[name] = first[name]
+            owned = set()
+            for layer in self.layers[1:]:
+                if name in layer:
+                    _merge_conf_dicts(merged, {name: layer[name]}, owned)
+        stanza = self._cache[name] = merged.get(name)
+        return stanza
+
+    def __getitem__(self, name: Union[str, Token]) -> StanzaType:
+        stanza = self._resolve(name)
+        if stanza is None:
+            raise KeyError(name)
+        return stanza
+
+    def __contains__(self, name) -> bool:
+        return self._resolve(name) is not None
+
+    def __iter__(self) -> Iterator[Union[str, Token]]:
+        if self._order is None:
+            order = dict.fromkeys(self.layers[0]) if self.layers else {}
+            for layer in self.layers[1:]:
+                for name, items in layer.items():
+                    if STANZA_MAGIC_KEY in items and STANZA_OP_DROP in items[STANZA_MAGIC_KEY]:
+                        order.pop(name, None)
+                    elif name not in order:
+                        order[name] = None
+            self._order = list(order)
+        return iter(self._order)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def materialize(self) -> ConfType:
+        """ Return the fully merged content as a ``dict``.  Like :py:func:`merge_conf_dicts`,
+        stanzas may be shared with the input layers. """
+        return {name: self[name] for name in self}
+
+
 def merge_conf_files(dest: ConfFileProxy,
                      configs: List[ConfFileProxy],
                      dry_run: bool = False,
-                     banner_comment: Optional[str] = None) -> SmartEnum:
+                     banner_comment: Optional[str] = None,
+                     stdout: Optional[TextIO] = None) -> SmartEnum:
     # Parse all config files
     cfgs = [conf.data for conf in configs]
     newest_mtime = max(conf.mtime for conf in configs) if configs else None
     # Merge all config files:
     merged_cfg = merge_conf_dicts(*cfgs)
+    return write_merged_conf(dest, merged_cfg, newest_mtime, dry_run=dry_run,
+                             banner_comment=banner_comment, stdout=stdout)
+
+
+def write_merged_conf(dest: ConfFileProxy,
+                      merged_cfg: ConfType,
+                      mtime: Optional[float] = None,
+                      dry_run: bool = False,
+                      banner_comment: Optional[str] = None,
+                      stdout: Optional[TextIO] = None) -> SmartEnum:
+    """ Write the output of :py:func:`merge_conf_dicts` to ``dest``, as done by
+    :py:func:`merge_conf_files`.  ``merged_cfg`` is not modified, so the same merged content can
+    be written to multiple destinations. """
     if banner_comment:
         if not banner_comment.startswith("#"):
             banner_comment = "#" + banner_comment
-        inject_section_comments(merged_cfg.setdefault(GLOBAL_STANZA, {}), prepend=[banner_comment])
+        # The global stanza may be shared with an input layer (or another destination)
+        merged_cfg = dict(merged_cfg)
+        global_stanza = merged_cfg[GLOBAL_STANZA] = dict(merged_cfg.get(GLOBAL_STANZA, {}))
+        inject_section_comments(global_stanza, prepend=[banner_comment])
 
     # Either show the diff (dry-run mode) or write to the destination file
     if dry_run and dest.is_file():
@@ -78,10 +190,10 @@ def merge_conf_files(dest: ConfFileProxy,
             dest_cfg = dest.data
         else:
             dest_cfg = {}
-        show_diff(sys.stdout, compare_cfgs(dest_cfg, merged_cfg),
+        show_diff(stdout or sys.stdout, compare_cfgs(dest_cfg, merged_cfg),
                   headers=(dest.name, dest.name + "-new"))
         return SMART_UPDATE
-    return dest.dump(merged_cfg, mtime=newest_mtime)
+    return dest.dump(merged_cfg, mtime=mtime)
 
 
 def merge_update_conf_file(dest: str,
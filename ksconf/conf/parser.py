@@ -18,6 +18,7 @@ import os
 import re
 from enum import Enum
 from io import StringIO, open
+from itertools import chain
 from pathlib import Path
 from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
 
@@ -25,6 +26,7 @@ from ..consts import SmartEnum
 from ..types import StrPath
 from ..util.compare import fileobj_compare
 from ..util.file import atomic_open, atomic_writer
+from .compact import CompactStanza
 
 default_encoding = "utf-8"
 
@@ -116,8 +118,12 @@ class DuplicateStanzaException(ConfParserException):
 # Core parsing / conf file writing logic
 
 
+_section_re = re.compile(r'^[\s\t]*\[(.*)\]\s*$')
+_dangling_re = re.compile(r'^\s*\[|\]\s*$')
+
+
 def section_reader(stream: _StreamIterable,
-                   section_re: re.Pattern = re.compile(r'^[\s\t]*\[(.*)\]\s*$')
+                   section_re: re.Pattern = _section_re
                    ) -> Iterator[Tuple[Optional[str], List[str]]]:
     """
     This generator break a configuration file stream into sections.  Each section contains a name
@@ -242,7 +248,7 @@ def splitup_kvpairs(lines: Iterable[str],
         elif "=" in entry:
             k, v = entry.split("=", 1)
             yield k.rstrip(), v.lstrip()
-        elif re.search(r'^\s*\[|\]\s*$', entry):
+        elif _dangling_re.search(entry):
             # ToDo:  There should be a 'loose' mode that allows this to be ignored...
             raise ConfParserException(f"Dangling stanza header:  {entry}")
         elif strict and entry.strip():
@@ -274,15 +280,25 @@ def parse_conf(stream: Union[StrPath, _StreamIterable],
         if hasattr(stream, "read"):
             return parse_conf_stream(stream, **profile)  # type: ignore
         else:
-            if not encoding:
-                encoding = detect_by_bom(stream)  # type: ignore
             # Assume it's a filename
-            with open(stream, "r", encoding=encoding) as stream:
-                return parse_conf_stream(stream, **profile)  # type: ignore
+            from ksconf.conf.cache import get_parse_cache
+            parse_cache = get_parse_cache()
+            if parse_cache:
+                return parse_cache.parse_conf(stream, profile, encoding, _parse_conf_file)  # type: ignore
+            return _parse_conf_file(stream, profile, encoding)  # type: ignore
     except UnicodeDecodeError as e:
         raise ConfParserException(f"Encoding error encountered: {e}")
 
 
+def _parse_conf_file(path: StrPath,
+                     profile: ParserConfig,
+                     encoding: Optional[str] = None) -> ConfType:
+    if not encoding:
+        encoding = detect_by_bom(path)
+    with open(path, "r", encoding=encoding) as stream:
+        return parse_conf_stream(stream, **profile)
+
+
 def parse_conf_string(s: str,
                       name: Optional[str] = None,
                       profile: ParserConfig = PARSECONF_MID) -> ConfType:
@@ -311,59 +327,136 @@ def parse_conf_stream(stream: _StreamIterable,
                       keep_comments: bool = False,
                       dup_stanza: DuplicateEnum = DUP_EXCEPTION,
                       dup_key: DuplicateEnum = DUP_OVERWRITE,
-                      strict: bool = False) -> ConfType:
+                      strict: bool = False,
+                      compact: bool = False) -> ConfType:
     """
     Low-level conf parsing functionality.
 
     Most often, either :func:`parse_conf` or :func:`parse_conf_string` are better options.
+
+    The entire stream is read up front and tokenized in a single loop that handles line
+    continuations, stanza headers, comments, and attribute/value splitting.  The output is the
+    same as chaining :func:`cont_handler`, :func:`section_reader`, and :func:`splitup_kvpairs`.
+
+    If ``compact`` is enabled, each stanza is returned as a memory efficient
+    :py:class:`~ksconf.conf.compact.CompactStanza` instead of a ``dict``.
     """
     if hasattr(stream, "name"):
         stream_name = stream.name
     else:
         stream_name = repr(stream)
 
-    sections = {}
-    # Q: What's the value of allowing line continuations to be disabled?
+    if hasattr(stream, "read"):
+        lines: Iterable[Optional[str]] = stream.read().split("\n")
+        if not lines[-1]:   # type: ignore
+            # Drop the empty string following the final newline
+            lines.pop()     # type: ignore
+    else:
+        lines = [line[:-1] if line.endswith("\n") else line for line in stream]
     if handle_conts:
-        stream = cont_handler(stream)
-    for section, entry in section_reader(stream):
-        if section is None:
-            section = GLOBAL_STANZA
+        # A trailing None flushes any pending continuation at end of file
+        lines = chain(lines, (None,))
+
+    section_match = _section_re.match
+    dangling_search = _dangling_re.search
+    dup_key_exception = dup_key == DUP_EXCEPTION
+    dup_key_skip = not dup_key_exception and dup_key not in (DUP_OVERWRITE, DUP_MERGE)
+
+    sections: ConfType = {}
+
+    def open_section(section) -> Tuple[StanzaType, StanzaType]:
+        """ Return the stanza dict to populate, and a dict of keys seen in this block. """
         if section in sections:
             if dup_stanza == DUP_OVERWRITE:
                 s = sections[section] = {}
+                return s, s
             elif dup_stanza == DUP_EXCEPTION:
                 raise DuplicateStanzaException(
                     f"Stanza [{_format_stanza(section)}] found more than once "
                     f"in config file {stream_name}")
             elif dup_stanza == DUP_MERGE:
-                s = sections[section]
+                return sections[section], {}
             else:
                 raise TypeError(f"Unknown value '{dup_stanza}' for dup_stanza")
-        else:
-            s = sections[section] = {}
-        local_stanza = {}
-        for key, value in splitup_kvpairs(entry, keep_comments=keep_comments, strict=strict):
+        s = sections[section] = {}
+        return s, s
+
+    section: Union[str, Token] = GLOBAL_STANZA
+    s: Optional[StanzaType]
+    s, seen = open_section(section)
+    comment = 0
+    cont_buf: List[str] = []
+
+    for line in lines:
+        if handle_conts:
+            if line is None:
+                if not cont_buf:
+                    break
+                # Weird this generally shouldn't happen.
+                line = "\n".join(cont_buf)
+            elif line.endswith("\\"):
+                cont_buf.append(line[:-1])
+                continue
+            elif cont_buf:
+                cont_buf.append(line)
+                line = "\n".join(cont_buf)
+                cont_buf = []
+        line = line.rstrip("\r\n")
+        stripped = line.lstrip()
+        first = stripped[:1]
+        if first == "[":
+            mo = section_match(line)
+            if mo:
+                if s is None:
+                    open_section(section)
+                section = mo.group(1)
+                comment = 0
+                if section:
+                    s, seen = open_section(section)
+                else:
+                    # An empty stanza name '[]' is dropped if it's the last line of the file
+                    s = None
+                continue
+        if s is None:
+            s, seen = open_section(section)
+        if first == "#" or first == ";":
+            if keep_comments:
+                comment += 1
+                s[f"#-{comment:06d}"] = line
+        elif "=" in line:
+            key, value = line.split("=", 1)
+            key = key.rstrip()
             if keys_lower:
                 key = key.lower()
-            if key in local_stanza:
-                if dup_key in (DUP_OVERWRITE, DUP_MERGE):
-                    s[key] = value
-                    local_stanza[key] = value
-                elif dup_key == DUP_EXCEPTION:
+            if key in seen:
+                if dup_key_exception:
                     raise DuplicateKeyException(
                         f"Stanza [{_format_stanza(section)}] has duplicate "
                         f"key '{key}' in file {stream_name}")
-            else:
-                local_stanza[key] = value
-                s[key] = value
-        del s
+                elif dup_key_skip:
+                    continue
+            value = value.lstrip()
+            s[key] = value
+            if seen is not s:
+                seen[key] = value
+        elif not stripped:
+            continue
+        elif dangling_search(line):
+            # ToDo:  There should be a 'loose' mode that allows this to be ignored...
+            raise ConfParserException(f"Dangling stanza header:  {line}")
+        elif strict:
+            # Silently ignore (drop) UTF-8 BOM as we assume UTF-8 anyway
+            # This should only happen when parsing a stream (for files BOM is handled earlier)
+            if line == "\ufeff":
+                continue
+            raise ConfParserException(f"Unexpected entry:  {line!r}")
+
     # If the global entry is just a blank line, drop it
-    if GLOBAL_STANZA in sections:
-        g = sections[GLOBAL_STANZA]
-        if not g:
-            # if len(g) == 1 and not g[0]:
-            del sections[GLOBAL_STANZA]
+    if not sections[GLOBAL_STANZA]:
+        del sections[GLOBAL_STANZA]
+    if compact:
+        for section, s in sections.items():
+            sections[section] = CompactStanza(s)
     return sections
 
 
@@ -85,6 +85,9 @@ RegexType = type(re.compile(r'.'))
 
 KSCONF_DEBUG = "KSCONF_DEBUG"
 
+# Root directory for persistent caches.  Caching is disabled unless this is set.
+KSCONF_CACHE_DIR = "KSCONF_CACHE_DIR"
+
 
 def is_debug():
     return KSCONF_DEBUG in os.environ
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import json
+import marshal
+import os
 import re
 from collections import defaultdict
-from dataclasses import dataclass, field
+from copy import copy
+from dataclasses import dataclass, field, replace
 from enum import Enum
 from fnmatch import fnmatch
+from hashlib import sha1, sha256
 from os import PathLike, stat_result
 from pathlib import Path, PurePath
 from tempfile import NamedTemporaryFile
@@ -13,8 +18,9 @@ from warnings import warn
 
 from ksconf.compat import Dict, List, Set, Tuple
 from ksconf.hook import plugin_manager
-from ksconf.util.file import file_hash, relwalk, secure_delete
-from ksconf.version import version_info
+from ksconf.util import process_pool
+from ksconf.util.file import get_cache_dir, relwalk, secure_delete
+from ksconf.version import version, version_info
 
 try:
     # Fallback for Python 3.7
@@ -58,6 +64,13 @@ This must work with an explicitly given list of layers
 no_path = PurePath()
 
 
+def _get_slots_state(obj) -> Dict[str, Any]:
+    """ Return the values of all ``__slots__`` attributes of ``obj``, for pickling. """
+    return {slot: getattr(obj, slot)
+            for cls in type(obj).__mro__ for slot in getattr(cls, "__slots__", ())
+            if hasattr(obj, slot)}
+
+
 # Exceptions
 
 class LayerException(Exception):
@@ -178,10 +191,16 @@ class LayerFile(PathLike):
         * ``physical_path``: default.d/30-my-org/indexes.conf.j2
         * ``resource_path``: /tmp/<RANDOM>-indexes.conf (temporary with automatic cleanup; see subclasses)
 
+    Consumers that only need the content should use :py:meth:`read_bytes` or :py:meth:`read_text`
+    instead of ``resource_path``.  Rendered files keep their content in memory, and only write a
+    temporary file if ``resource_path`` is requested.
     '''
     # Are slots helpful here?  (parent class already has __dict__), need that for cached_properties
     __slots__ = ["layer", "relative_path", "_stat"]
 
+    # True if content is held in memory; using resource_path requires writing a temporary file
+    resource_in_memory = False
+
     def __init__(self,
                  layer: Layer,
                  relative_path: PurePath,
@@ -213,6 +232,14 @@ class LayerFile(PathLike):
         # For "normal" files, the resource_path is the physical_path (not true for rendered files)
         return self.physical_path
 
+    def read_bytes(self) -> bytes:
+        """ Return the (possibly rendered) content of the file. """
+        return self.resource_path.read_bytes()
+
+    def read_text(self, encoding: Optional[str] = None) -> str:
+        """ Return the (possibly rendered) content of the file as a string. """
+        return self.resource_path.read_text(encoding)
+
     @property
     def stat(self) -> stat_result:
         if self._stat is None:
@@ -251,7 +278,9 @@ class LayerRenderedFile(LayerFile):
     Abstract LayerFile for rendered scenarios, such as template scenarios.
     A subclass really only needs to implement ``match()`` ``render()``
     """
-    __slots__ = ["_rendered_resource"]
+    __slots__ = ["_rendered_resource", "_rendered_content"]
+
+    resource_in_memory = True
 
     use_secure_delete = False
 
@@ -261,6 +290,7 @@ class LayerRenderedFile(LayerFile):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._rendered_resource: Path = None  # type: ignore
+        self._rendered_content: Optional[bytes] = None
 
     def __del__(self):
         if getattr(self, "_rendered_resource", None) and self._rendered_resource.is_file():
@@ -272,6 +302,12 @@ class LayerRenderedFile(LayerFile):
             else:
                 self._rendered_resource.unlink()
 
+    def __getstate__(self):
+        # Never share the temporary file;  it's removed when the original object is deleted
+        state = _get_slots_state(self)
+        state["_rendered_resource"] = None
+        return (self.__dict__, state)
+
     def render(self, template_path: Path) -> str:
         raise NotImplementedError
 
@@ -289,14 +325,24 @@ class LayerRenderedFile(LayerFile):
     def physical_path(self) -> Path:
         return Path(self.layer.root, self.layer.physical_path, self.relative_path)
 
+    def read_bytes(self) -> bytes:
+        """ Return the rendered content.  Rendering happens only once. """
+        if self._rendered_content is None:
+            self._rendered_content = self.render(self.physical_path).encode("utf-8")
+        return self._rendered_content
+
+    def read_text(self, encoding: Optional[str] = None) -> str:
+        return self.read_bytes().decode("utf-8")
+
     @property
     def resource_path(self) -> Path:
+        """ Path to a temporary file containing the rendered content.  Only created on first use;
+        prefer :py:meth:`read_bytes` whenever a physical file isn't required. """
         if not self._rendered_resource:
             # Temporary file will be removed in instance destructor.  Multiple opens expected.
-            tf = NamedTemporaryFile(delete=False)
+            with NamedTemporaryFile(delete=False) as tf:
+                tf.write(self.read_bytes())
             self._rendered_resource = Path(tf.name)
-            content = self.render(self.physical_path)
-            self._rendered_resource.write_text(content)
         return self._rendered_resource
 
     def calculate_signature(self) -> Dict[str, Union[str, int]]:
@@ -308,18 +354,59 @@ class LayerRenderedFile(LayerFile):
         """
         if self.signature_requires_resource_hash:
             return {
-                "hash": file_hash(self.resource_path)
+                "hash": sha256(self.read_bytes()).hexdigest()
             }
         else:
             return super().calculate_signature()
 
 
+# Process-wide jinja2 environments;  (layer root, template variables, cache dir) -> Environment
+_jinja2_environments: Dict[Tuple[str, str, str], Any] = {}
+_JINJA2_ENVIRONMENTS_MAX = 16
+
+
+def _get_jinja2_bytecode_cache():
+    """
+    Return a persistent cache of compiled templates stored in the ``jinja`` subdirectory of
+    ``KSCONF_CACHE_DIR``, or None if caching is not enabled.
+
+    Entries are keyed by the template's name and source content, as well as the ksconf and jinja2
+    versions, so a changed template is simply compiled again.
+    """
+    cache_dir = get_cache_dir("jinja")
+    if cache_dir is None:
+        return None
+    from jinja2 import __version__ as jinja2_version
+    from jinja2.bccache import Bucket, FileSystemBytecodeCache
+
+    class KsconfBytecodeCache(FileSystemBytecodeCache):
+        def get_bucket(self, environment, name, filename, source):
+            # Include the syntax settings, as plugins may customize the environment
+            syntax = (environment.block_start_string, environment.variable_start_string,
+                      environment.comment_start_string, sorted(environment.extensions))
+            key = sha1(repr((version, jinja2_version, syntax, name, source))
+                       .encode("utf-8")).hexdigest()
+            bucket = Bucket(environment, key, self.get_source_checksum(source))
+            self.load_bytecode(bucket)
+            return bucket
+
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    return KsconfBytecodeCache(os.fspath(cache_dir))
+
+
 @register_file_handler("jinja", priority=50, enabled=False)
 class LayerFile_Jinja2(LayerRenderedFile):
 
     signature_requires_resource_hash = True     # Changes in 'template_vars' can vary rendered output
     use_secure_delete = False
 
+    # True: Signature based on the template source, referenced templates, and variables.
+    # Set to False if plugins add non-deterministic filters or tests (forcing a full render)
+    signature_uses_dependencies = True
+
     @staticmethod
     def match(path: PurePath):
         return path.suffix == ".j2"
@@ -336,24 +423,121 @@ class LayerFile_Jinja2(LayerRenderedFile):
         return self.layer.context.jinja2_environment  # type: ignore
 
     def _build_jinja2_env(self):
+        # Environments are shared process-wide by any layers with the same root and variables, so
+        # compiled templates are reused across layer collections and combine targets.  Templates
+        # are reloaded if their source changes (auto_reload).
+        template_variables = self.layer.context.template_variables
+        key = (os.fspath(self.layer.root),
+               json.dumps(template_variables, sort_keys=True, default=repr),
+               str(get_cache_dir("jinja")))
+        try:
+            return _jinja2_environments[key]
+        except KeyError:
+            pass
+
         from jinja2 import Environment, FileSystemLoader, StrictUndefined
         environment = Environment(
             undefined=StrictUndefined,
             loader=FileSystemLoader(self.layer.root),
-            auto_reload=False)
+            bytecode_cache=_get_jinja2_bytecode_cache(),
+            auto_reload=True)
 
         # Call plugin for jinja environment tweaking
         plugin_manager.hook.modify_jinja_env(env=environment)
 
-        environment.globals.update(self.layer.context.template_variables)
+        environment.globals.update(template_variables)
+        if len(_jinja2_environments) >= _JINJA2_ENVIRONMENTS_MAX:
+            # Drop the oldest environment
+            del _jinja2_environments[next(iter(_jinja2_environments))]
+        _jinja2_environments[key] = environment
         return environment
 
+    @property
+    def template_name(self) -> str:
+        return "/".join(self.physical_path.relative_to(self.layer.root).parts)
+
     def render(self, template_path: Path) -> str:
         rel_template_path = template_path.relative_to(self.layer.root)
         template = self.jinja2_env.get_template("/".join(rel_template_path.parts))
         value = template.render()
         return value
 
+    def _get_template_dependencies(self, name: str) -> Optional[Tuple[str, List[str], List[str]]]:
+        """ Return the source hash, referenced templates, and referenced variable names of the
+        template ``name``.  None is returned if the dependencies can't be determined statically. """
+        from jinja2 import TemplateNotFound, TemplateSyntaxError, meta, nodes
+        env = self.jinja2_env
+        try:
+            source, filename, _ = env.loader.get_source(env, name)
+        except TemplateNotFound:
+            return None
+        # Use context object to 'cache' parsed dependencies;  shared templates are parsed once
+        if not hasattr(self.layer.context, "jinja2_dependencies"):
+            self.layer.context.jinja2_dependencies = {}  # type: ignore
+        cache = self.layer.context.jinja2_dependencies  # type: ignore
+        key = (filename, source)
+        if key not in cache:
+            try:
+                ast = env.parse(source, name, filename)
+            except TemplateSyntaxError:
+                return None
+            templates = list(meta.find_referenced_templates(ast))
+            if None in templates:
+                # Dynamic include/import/extends
+                cache[key] = None
+            else:
+                cache[key] = (sha256(source.encode("utf-8")).hexdigest(),
+                              sorted(set(templates)),
+                              # Can't use find_undeclared_variables();  globals count as declared
+                              sorted({node.name for node in ast.find_all(nodes.Name)
+                                      if node.ctx == "load"}))
+        return cache[key]
+
+    def _calculate_dependency_hash(self) -> Optional[str]:
+        """ Hash all inputs of the template:  The source of this and all referenced templates, and
+        the values of all referenced variables.  None if rendering is required instead. """
+        from jinja2.defaults import DEFAULT_NAMESPACE
+        env = self.jinja2_env
+        template_variables = self.layer.context.template_variables
+        sources = {}
+        variables = set()
+        pending = [self.template_name]
+        while pending:
+            name = pending.pop()
+            if name in sources:
+                continue
+            deps = self._get_template_dependencies(name)
+            if deps is None:
+                return None
+            sources[name], templates, names = deps
+            pending.extend(templates)
+            variables.update(names)
+
+        values = {}
+        for name in variables:
+            if name in template_variables:
+                values[name] = template_variables[name]
+            elif name in env.globals and name not in DEFAULT_NAMESPACE:
+                # Global added by a plugin.  No way of knowing if output is deterministic.
+                return None
+        h = sha256()
+        h.update(json.dumps([sorted(sources.items()), sorted(variables)]).encode("utf-8"))
+        h.update(json.dumps(values, sort_keys=True, default=repr).encode("utf-8"))
+        return h.hexdigest()
+
+    def calculate_signature(self) -> Dict[str, Union[str, int]]:
+        """
+        Calculate a content signature from the template's dependencies, without rendering it.
+        Dependencies include the source of any included, imported, or extended templates and the
+        values of referenced template variables.  If these can't be determined statically, (for
+        example, when a template name is given by a variable) the rendered output is hashed.
+        """
+        if self.signature_uses_dependencies:
+            deps_hash = self._calculate_dependency_hash()
+            if deps_hash is not None:
+                return {"deps_hash": deps_hash}
+        return super().calculate_signature()
+
 
 class LayerFilter:
     """
@@ -448,6 +632,14 @@ class Layer:
     def __repr__(self):
         return f"<{self.__class__.__name__} [{self.name}] {len(self)} files root={self.root}>"
 
+    def __getstate__(self):
+        # Support for sending files to worker processes.  The file cache is not included, and the
+        # context is copied without dynamic attributes (e.g. the jinja2 environment)
+        state = _get_slots_state(self)
+        state["_cache_files"] = None
+        state["context"] = replace(self.context)
+        return (None, state)
+
     def walk(self) -> R_walk:
         """
         Low-level walk over the file system, blocking unwanted file patterns
@@ -509,12 +701,26 @@ class LayerCollectionBase:
         self._layers: List[Layer] = []
         self._layers_blocked: List[Layer] = []
         self._files_blocked: List[LayerFile] = []
+        # Inverted index:  logical path -> files in layer order.  Built on demand.
+        self._index: Optional[Dict[PurePath, List[LayerFile]]] = None
         self.context = context or LayerContext()
 
     def __len__(self):
         """ Determine total number of active layers (implicit + explicit).  Blocked layers are not counted. """
         return len(self._layers)
 
+    def copy(self) -> LayerCollectionBase:
+        """ Return a copy of this collection which can be layer filtered independently, for
+        example to build multiple targets from a single scan.  Layer objects (and therefore
+        cached file listings and rendered content) are shared with the original collection.
+        Note that file blocking (:py:meth:`block_file`) also impacts the shared layers. """
+        new = copy(self)
+        new._layers = list(self._layers)
+        new._layers_blocked = list(self._layers_blocked)
+        new._files_blocked = list(self._files_blocked)
+        new._index = None
+        return new
+
     def apply_layer_filter(self, layer_filter: LayerFilter) -> bool:
         """
         Apply a destructive filter to all explicit layers.  ``layer_filter(layer)`` is called
@@ -536,18 +742,10 @@ class LayerCollectionBase:
         Apply a path filter to all logical paths.  After file filtering, any
         layers no longer containing files are also blocked.
         """
-        logical_to_layer: Dict[PurePath, List[Layer]] = defaultdict(list)
-        for layer in self._layers:
-            for lf in layer.list_files():
-                logical_to_layer[lf.logical_path].append(layer)
-
-        discard = []
-        for logical_path, layers in logical_to_layer.items():
-            if not path_filter(logical_path):
-                discard.append(logical_path)
-                for layer in layers:
-                    layer.block_file(logical_path)
-        self._files_blocked.extend(discard)
+        discard = [logical_path for logical_path in self._get_index()
+                   if not path_filter(logical_path)]
+        for logical_path in discard:
+            self.block_file(logical_path)
 
         if discard:
             # Remove explicit layers that are now empty
@@ -569,10 +767,28 @@ class LayerCollectionBase:
         Otherwise layer order is preserved. """
         return sorted(layers, key=lambda layer: layer.type.value)
 
+    def _get_index(self) -> Dict[PurePath, List[LayerFile]]:
+        """ Return the inverted index of logical path to files (ordered by layer).
+
+        File existence is checked once, as the index is built, rather than on every lookup. """
+        if self._index is None:
+            index: Dict[PurePath, List[LayerFile]] = {}
+            for layer in self._layers:
+                for lf in layer.list_files():
+                    if not lf.physical_path.is_file():
+                        continue
+                    try:
+                        index[lf.logical_path].append(lf)
+                    except KeyError:
+                        index[lf.logical_path] = [lf]
+            self._index = index
+        return self._index
+
     def add_layer(self, layer: Layer, do_sort=True):
         self._layers.append(layer)
         if do_sort:
             self._layers = self.order_layers(self._layers)
+        self._index = None
 
     def block_layer(self, layer: Layer):
         """
@@ -584,6 +800,22 @@ class LayerCollectionBase:
             assert layer.type != LayerType.IMPLICIT, "Unable to block an implicit layer"
             self._layers.remove(layer)
             self._layers_blocked.append(layer)
+            self._index = None
+
+    def block_file(self, path: PurePath) -> bool:
+        """
+        Block a logical path across all layers.  Returns True if any files were blocked.
+
+        Use this instead of calling :py:meth:`Layer.block_file` directly, so that the collection
+        remains aware of the change.
+        """
+        files = self._get_index().pop(path, None)
+        if not files:
+            return False
+        for lf in files:
+            lf.layer.block_file(path)
+        self._files_blocked.append(path)
+        return True
 
     def list_layers(self) -> List[Layer]:
         return self._layers
@@ -620,17 +852,11 @@ class LayerCollectionBase:
 
     def list_logical_files(self) -> List[Path]:
         """ Return a list of logical paths. """
-        files = set(f.logical_path for l in self._layers for f in l.list_files())
-        return list(files)
+        return list(self._get_index())
 
     def get_files(self, path: PurePath) -> List[LayerFile]:
         """ return all layers associated with the given relative path. """
-        files = []
-        for layer in self._layers:
-            file_ = layer.get_file(path)
-            if file_:
-                files.append(file_)
-        return files
+        return list(self._get_index().get(path, ()))
 
     def get_file(self, path: PurePath) -> Iterator[LayerFile]:
         """ Confusingly named.  For backwards compatibility.
@@ -746,6 +972,84 @@ class DotdLayer(Layer):
                 yield (root, dirs, files)
 
 
+class _DirScanIndex:
+    """
+    Directory structure scanner with an optional persistent index.
+
+    Only directories are recorded, along with their modification times.  When the index is
+    persisted (the ``KSCONF_CACHE_DIR`` environmental variable is set), directories with an
+    unchanged mtime are not listed again; their subdirectories are taken from the index.  Every
+    directory is still stat'ed, as a change deep within the tree does not update the mtime of its
+    ancestors.  For trees with many files (think vendored ``lib/`` or ``bin/`` folders) this is
+    much cheaper than a full walk.
+    """
+    _FORMAT = 1
+
+    def __init__(self, root: Path, follow_symlinks: bool = False):
+        self.root = root
+        self.follow_symlinks = follow_symlinks
+        # relative dir: (mtime_ns, [(subdir, is_symlink), ...])
+        self._entries: Dict[str, Tuple[int, List[Tuple[str, bool]]]] = {}
+        self._cache_file: Optional[Path] = None
+        cache_dir = get_cache_dir("layers")
+        if cache_dir:
+            key = f"{os.path.abspath(root)}|{follow_symlinks}"
+            self._cache_file = cache_dir / f"{sha1(key.encode('utf-8')).hexdigest()}.bin"
+            self._load()
+
+    def _load(self):
+        try:
+            fmt, entries = marshal.loads(self._cache_file.read_bytes())
+            if fmt == self._FORMAT:
+                self._entries = entries
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    def _save(self):
+        temp = self._cache_file.with_name(f"{self._cache_file.name}.{os.getpid()}.tmp")
+        try:
+            self._cache_file.parent.mkdir(parents=True, exist_ok=True)
+            temp.write_bytes(marshal.dumps((self._FORMAT, self._entries)))
+            os.replace(temp, self._cache_file)
+        except OSError:
+            # Best effort only
+            if temp.is_file():
+                temp.unlink()
+
+    def _scan_dir(self, rel: str,
+                  out: List[Tuple[str, List[str]]],
+                  entries: Dict[str, Tuple[int, List[Tuple[str, bool]]]]):
+        path = os.path.join(self.root, rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            cached = self._entries.get(rel)
+            if cached and cached[0] == mtime:
+                subdirs = cached[1]
+            else:
+                with os.scandir(path) as it:
+                    subdirs = [(e.name, e.is_symlink()) for e in it if e.is_dir()]
+        except OSError:
+            # Like os.walk(), silently skip unreadable directories
+            return
+        entries[rel] = (mtime, subdirs)
+        for (name, is_symlink) in subdirs:
+            if self.follow_symlinks or not is_symlink:
+                self._scan_dir(os.path.join(rel, name), out, entries)
+        out.append((rel, [name for (name, _) in subdirs]))
+
+    def scan(self) -> List[Tuple[str, List[str]]]:
+        """ Return a list of (relative directory, subdirectory names) in bottom-up order, like
+        ``relwalk(root, topdown=False)`` without the files. """
+        out: List[Tuple[str, List[str]]] = []
+        entries: Dict[str, Tuple[int, List[Tuple[str, bool]]]] = {}
+        self._scan_dir("", out, entries)
+        changed = entries != self._entries
+        self._entries = entries
+        if self._cache_file and changed:
+            self._save()
+        return out
+
+
 # Q:  How do we mark "mount-points" in the directory structure to keep multiple layers
 #     from claiming the same files?????
 class DotDLayerCollection(LayerCollectionBase):
@@ -771,6 +1075,11 @@ class DotDLayerCollection(LayerCollectionBase):
         super().__init__(context)
         self._mount_points: Dict[Path, List[str]] = defaultdict(list)
 
+    def copy(self) -> DotDLayerCollection:
+        new = super().copy()
+        new._mount_points = defaultdict(list, {k: list(v) for k, v in self._mount_points.items()})
+        return new
+
     def set_root(self, root: Path, follow_symlinks=None):
         # XXX:  Rename this to "discover()"  "add_path",  "from_dir", ...?
         #       (Ideally this should be the same for all LayerCollection classes)
@@ -785,8 +1094,8 @@ class DotDLayerCollection(LayerCollectionBase):
         if follow_symlinks is None:
             follow_symlinks = self.context.follow_symlink
 
-        for (top, dirs, files) in relwalk(root, topdown=False, followlinks=follow_symlinks):
-            del files
+        # Only directory names matter here.  Use the (optionally persistent) scan index
+        for (top, dirs) in _DirScanIndex(root, follow_symlinks).scan():
             top = Path(top)
             mount_mo = self.mount_regex.match(top.name)
             if mount_mo:
@@ -841,6 +1150,30 @@ class DotDLayerCollection(LayerCollectionBase):
         return super().order_layers(layers)
 
 
+def _render_layer_file(lf: LayerRenderedFile) -> bytes:
+    """ Render a single file in a worker process. """
+    return lf.read_bytes()
+
+
+def render_layer_files(files: Sequence[LayerFile], jobs: int = 1):
+    """
+    Render all :py:class:`LayerRenderedFile` objects in :py:obj:`files` using up to
+    :py:obj:`jobs` worker processes.  Rendered content is stored in each object, so later calls
+    to :py:meth:`~LayerFile.read_bytes` are free.  Other file types are ignored.
+
+    If rendering fails, the exception for the first failed file (in the order given) is raised.
+    """
+    pending = [lf for lf in files
+               if isinstance(lf, LayerRenderedFile) and lf._rendered_content is None]
+    if jobs <= 1 or len(pending) <= 1:
+        for lf in pending:
+            lf.read_bytes()
+        return
+    with process_pool(min(jobs, len(pending))) as executor:
+        for lf, content in zip(pending, executor.map(_render_layer_file, pending, chunksize=4)):
+            lf._rendered_content = content
+
+
 def build_layer_collection(source: Path,
                            layer_method: str,
                            context: Optional[LayerContext] = None,
@@ -1,27 +1,35 @@
 from __future__ import absolute_import, annotations, unicode_literals
 
+import fnmatch
 import hashlib
+import json
 import os
 import re
 import shutil
+import stat
 import tarfile
 import tempfile
+from dataclasses import dataclass
 from functools import wraps
 from os import fspath
-from pathlib import Path
-from typing import Optional, TextIO, Union
+from pathlib import Path, PurePath, PurePosixPath
+from typing import BinaryIO, Callable, Dict, List, Mapping, Optional, TextIO, Union
 
-from ksconf.app.manifest import AppManifest
+from ksconf.app.manifest import (AppManifest, AppManifestFile,
+                                 AppManifestStorageError, StoredArchiveManifest,
+                                 create_manifest_from_archive)
 from ksconf.combine import LayerCombiner
-from ksconf.conf.merge import merge_app_local, merge_conf_dicts
+from ksconf.conf.merge import MergedConfView, merge_app_local, merge_conf_dicts
 from ksconf.conf.parser import conf_attr_boolean, parse_conf, update_conf
 from ksconf.consts import is_debug
 from ksconf.hook import plugin_manager
-from ksconf.layer import LayerCollectionBase
+from ksconf.layer import LayerCollectionBase, LayerFile
 from ksconf.types import StrPath
 from ksconf.util import decorator_with_opt_kwargs
-from ksconf.util.file import atomic_writer
+from ksconf.util.compress import ParallelGzipWriter
+from ksconf.util.file import atomic_writer, file_hash, get_cache_dir
 from ksconf.vc.git import git_cmd
+from ksconf.version import version
 
 
 def find_conf_in_layers(app_dir, conf, *layers):
@@ -42,25 +50,234 @@ def get_merged_conf(app_dir, conf, *layers):
     return merge_conf_dicts(*confs)
 
 
-def normalize_directory_mtime(path):
+def get_merged_conf_view(app_dir, conf, *layers) -> MergedConfView:
+    """ Same as :py:func:`get_merged_conf`, but stanzas are only merged when accessed. """
+    if not layers:
+        # Last layer wins
+        layers = ("default", "local")
+    files = [os.path.join(app_dir, layer, conf) for layer in layers]
+    return MergedConfView(*[parse_conf(path) for path in files if os.path.isfile(path)])
+
+
+def normalize_directory_mtime(path, references: Optional[Mapping[str, StrPath]] = None):
     """ Walk a tree and update the directory modification times to match the
     newest time of the children.  This results in a more predictable behavior
     over multiple executions.
+
+    Files that are not present in the tree can be included via ``references``, a mapping of a
+    path within the tree to the file that would be located there.
     """
+    references = references or {}
     for (root, dirs, files) in os.walk(path, topdown=False):
-        nodes = dirs + files
+        nodes = [os.path.join(root, n) for n in dirs + files]
+        nodes.extend(ref for ref in references if os.path.dirname(ref) == root)
         if not nodes:
             # Empty directories are somewhat unlikely.  We'll see
             continue
-        mtime = max(os.stat(os.path.join(root, n)).st_mtime for n in nodes)
+        mtime = max(os.stat(references.get(n, n)).st_mtime for n in nodes)
         os.utime(root, (mtime, mtime))
 
 
+def _is_conf_file(name: str) -> bool:
+    return name.endswith((".conf", ".meta"))
+
+
+class _Blocklist:
+    """ Blocklist patterns compiled into a single regular expression.
+
+    A pattern without a wildcard matches a file or directory name exactly.  A wildcard pattern
+    is matched against the end of the path, starting at a directory boundary, so ``*.pyc``
+    matches ``bin/lib/util.pyc``.  Paths are matched with a leading ``/``, so ``*/tests/*``
+    also matches ``tests/test_app.py`` at the top of the app.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = list(patterns)
+        regexes = []
+        for i, pattern in enumerate(self.patterns):
+            if "*" in pattern:
+                regex = fnmatch.translate(pattern)
+            else:
+                regex = re.escape(pattern) + r"\Z"
+            regexes.append(f"(?P<p{i}>(?:.*/)?{regex})")
+        self._regex = re.compile("|".join(regexes)) if regexes else None
+
+    def match(self, path: str) -> Optional[str]:
+        """ Return the first pattern that matches ``path`` (a unix-style path), or None. """
+        if self._regex is None:
+            return None
+        match = self._regex.match("/" + path)
+        if match:
+            return self.patterns[int(match.lastgroup[1:])]  # type: ignore
+        return None
+
+
+class _PackageCombiner(LayerCombiner):
+    """ Combiner used for packaging.  Files that would be copied as-is into the build directory
+    are recorded in :py:attr:`references` instead, and are read directly from the source when the
+    archive is created.  Conf files are always written, since they may be modified during
+    packaging.
+
+    Any :py:attr:`path_filter` is applied to the layer collection before combining, so rejected
+    files are never read.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.references: Dict[PurePosixPath, Path] = {}
+        self.path_filter: Optional[Callable[[PurePath], bool]] = None
+        self._target: Path = None   # type: ignore
+
+    def prepare(self, target: Path):
+        super().prepare(target)
+        if self.path_filter:
+            self.collection.apply_path_filter(self.path_filter)
+
+    def prepare_target_dir(self, target: Path):
+        super().prepare_target_dir(target)
+        self._target = target
+
+    def combine_file(self, dest_path: Path, sources: List[LayerFile],
+                     handler: Optional[Callable]):
+        source = sources[-1]
+        if handler or self.dry_run or source.resource_in_memory or _is_conf_file(dest_path.name):
+            return super().combine_file(dest_path, sources, handler)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        rel_path = PurePosixPath(dest_path.relative_to(self._target).as_posix())
+        self.references[rel_path] = source.resource_path
+
+    def post_combine(self, target: Path):
+        super().post_combine(target)
+        # Any post_combine plugin will expect to find all files in the target directory
+        if self.references and plugin_manager.hook.post_combine.get_hookimpls():
+            for rel_path, source in self.references.items():
+                shutil.copy2(source, target.joinpath(*rel_path.parts))
+            self.references.clear()
+
+
 class PackagingException(Exception):
     pass
 
 
+class _HashingReader:
+    """ Read-only stream wrapper that hashes content as it's read. """
+
+    def __init__(self, stream: BinaryIO, algorithm: str):
+        self._stream = stream
+        self.hash = hashlib.new(algorithm)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.hash.update(data)
+        return data
+
+
+@dataclass
+class _TreeNode:
+    name: str
+    path: str
+    stat: os.stat_result
+    mtime: float
+    # Location of the content, for referenced files
+    source: Optional[Path] = None
+    # Entries of a directory (sorted by name);  None for everything else
+    children: Optional[List[_TreeNode]] = None
+
+
+class _ArchiveWriter:
+    """
+    Write a directory tree to a tarball in a single pass.  Each file is read exactly once; while
+    being written to the archive, its content is hashed to build an :py:class:`AppManifest`.
+    Entries are added in the same order as ``TarFile.add()`` would.
+
+    Directory modification times are normalized in the archive (without changing the filesystem)
+    to match the behavior of :py:func:`normalize_directory_mtime`.  Files listed in
+    ``references`` are read from their source location, but are otherwise stored exactly as a
+    copy (made with ``shutil.copy2``) within the tree would have been.
+    """
+
+    def __init__(self, path: str, references: Mapping[str, Path], predictable_mtime: bool = True,
+                 hash_algorithm: str = AppManifest.hash_algorithm):
+        self.path = path
+        self.references = references
+        self.predictable_mtime = predictable_mtime
+        self.hash_algorithm = hash_algorithm
+        self._refs_by_dir: Dict[str, List[str]] = {}
+        for ref in references:
+            self._refs_by_dir.setdefault(os.path.dirname(ref), []).append(os.path.basename(ref))
+
+    def _scan(self, name: str, path: str) -> _TreeNode:
+        st = os.lstat(path)
+        node = _TreeNode(name, path, st, st.st_mtime)
+        if not stat.S_ISDIR(st.st_mode):
+            if stat.S_ISLNK(st.st_mode):
+                # Like normalize_directory_mtime(), use the time of the symlink target
+                node.mtime = os.stat(path).st_mtime
+            return node
+        node.children = []
+        for child in sorted(os.listdir(path) + self._refs_by_dir.get(path, [])):
+            child_path = os.path.join(path, child)
+            source = self.references.get(child_path)
+            if source:
+                child_st = os.stat(source)
+                node.children.append(_TreeNode(child, child_path, child_st, child_st.st_mtime,
+                                               source=source))
+            else:
+                node.children.append(self._scan(child, child_path))
+        if self.predictable_mtime and node.children:
+            node.mtime = max(child.mtime for child in node.children)
+        return node
+
+    def write(self, tar: tarfile.TarFile, arcname: str) -> List[AppManifestFile]:
+        """ Add the tree to ``tar`` as ``arcname`` and return the manifest entries of all
+        files. """
+        files: List[AppManifestFile] = []
+        owner = tar.gettarinfo(self.path, arcname)
+
+        def add(node: _TreeNode, arcname: str, rel_path: PurePosixPath):
+            if node.children is not None:
+                tarinfo = tar.gettarinfo(node.path, arcname)
+                tarinfo.mtime = node.mtime
+                tar.addfile(tarinfo)
+                for child in node.children:
+                    add(child, f"{arcname}/{child.name}", rel_path / child.name)
+            elif node.source or stat.S_ISREG(node.stat.st_mode):
+                with open(node.source or node.path, "rb") as stream:
+                    tarinfo = tar.gettarinfo(arcname=arcname, fileobj=stream)
+                    if node.source:
+                        # Ownership of the copy that would have been made
+                        tarinfo.uid, tarinfo.gid = owner.uid, owner.gid
+                        tarinfo.uname, tarinfo.gname = owner.uname, owner.gname
+                    reader = _HashingReader(stream, self.hash_algorithm)
+                    tar.addfile(tarinfo, reader)
+                files.append(AppManifestFile(rel_path, tarinfo.mode & 0o777, tarinfo.size,
+                                             reader.hash.hexdigest()))
+            else:
+                tar.add(node.path, arcname=arcname, recursive=False)
+                if os.path.isfile(node.path):
+                    # Symlink to a file
+                    st = os.stat(node.path)
+                    files.append(AppManifestFile(rel_path, st.st_mode & 0o777, st.st_size,
+                                                 file_hash(node.path, self.hash_algorithm)))
+
+        add(self._scan("", self.path), arcname, PurePosixPath())
+        return files
+
+
 class AppPackager:
+    """
+    Build a Splunk app archive from a source directory or layer collection.
+
+    Files that are copied unchanged from a single layer are not written to the build directory.
+    They are tracked as references to the original file, and are streamed directly into the
+    archive (or manifest) at the end.  Conf files, and anything under ``local`` when local files
+    are merged, are always written to the build directory.  References are written out (and
+    therefore behave like any other file) whenever a ``package_pre_archive`` or
+    ``post_combine`` plugin is present.
+    """
+
+    # Bump if the layout of build cache entries changes in an incompatible way
+    _CACHE_FORMAT = 1
 
     def __init__(self, src_path: StrPath,
                  app_name: str,
@@ -75,6 +292,11 @@ class AppPackager:
         self.app_dir: str = None                # type: ignore
         self._var_magic: AppVarMagic = None     # type: ignore
         self._mutable: bool = None              # type: ignore
+        # Files within app_dir that are read directly from their source location
+        self._references: Dict[PurePosixPath, Path] = {}
+        self._manifest: Optional[AppManifest] = None
+        # Combiner prepared by build_cache_key(), reused by combine() for the same arguments
+        self._prepared_combiner: Optional[tuple] = None
 
         self._frozen_by = ""
         self.template_variables = template_variables
@@ -129,17 +351,30 @@ class AppPackager:
         Combine an existing layer collection into the build directory.  Any desired layer filtering
         or template variable assignment must be performed against :py:obj:`collection` first.
         """
-        combiner = LayerCombiner.from_layer_collection(collection, quiet=True)
+        combiner = _PackageCombiner.from_layer_collection(collection, quiet=True)
         self._execute_combiner(combiner)
 
     @require_active_context
-    def combine(self, src: Path, filters: list, layer_method="dir.d", allow_symlink=False):
+    def combine(self, src: Path, filters: list, layer_method="dir.d", allow_symlink=False,
+                blocklist: Optional[List[str]] = None):
         """
         Combine a source directory into the build directory.  The source directory may contain
-        layers which can be filtered based on the :py:obj:`filters`.
+        layers which can be filtered based on the :py:obj:`filters`.  Files matching any
+        ``blocklist`` pattern (or within a matching directory) are excluded from the layers, and
+        are therefore never read or rendered.
         """
         # XXX: It feels like a design flaw to have to pass in 'src' here; already given to init
-        combiner = LayerCombiner(follow_symlink=allow_symlink, quiet=True)
+        args = (fspath(src), filters, layer_method, allow_symlink, blocklist)
+        if self._prepared_combiner and self._prepared_combiner[0] == args:
+            combiner = self._prepared_combiner[1]
+        else:
+            combiner = self._create_combiner(*args)
+        self._prepared_combiner = None
+        self._execute_combiner(combiner)
+
+    def _create_combiner(self, src: StrPath, filters: list, layer_method: str,
+                         allow_symlink: bool, blocklist: Optional[List[str]]) -> _PackageCombiner:
+        combiner = _PackageCombiner(follow_symlink=allow_symlink, quiet=True)
         if self.template_variables:
             combiner.context.template_variables = self.template_variables
         if layer_method == "dir.d":
@@ -151,35 +386,219 @@ class AppPackager:
                                       "Please use 'dir.d' or 'disable'.")
         for action, path in filters:
             combiner.add_layer_filter(action, path)
-        self._execute_combiner(combiner)
+        if blocklist:
+            combiner.path_filter = self._blocklist_filter(blocklist)
+        return combiner
+
+    @require_active_context
+    def build_cache_key(self, src: StrPath, filters: list, layer_method="dir.d",
+                        allow_symlink=False, blocklist: Optional[List[str]] = None,
+                        options: Optional[dict] = None) -> Optional[str]:
+        """
+        Calculate a key that identifies the archive that would be built from ``src``, given the
+        same arguments as :py:meth:`combine`.  Any other options that influence the build (local
+        file handling, version, archive name, ...) must be given in ``options``.
+
+        The key is formed from the signature and nanosecond timestamps of each source file (see
+        :py:meth:`~ksconf.layer.LayerFile.calculate_signature`) and the options.
+        Variables referenced by the options, like ``{{git_tag}}``, are resolved so that a new tag
+        results in a new key.  Variables derived from the app content itself are already covered
+        by the signature.
+
+        Returns None if the build cache is disabled; it's enabled by setting ``KSCONF_CACHE_DIR``.
+        Caching is also disabled whenever ``post_combine`` or ``package_pre_archive`` plugins
+        are present, as their effect on the output can't be determined ahead of time.
+        """
+        if get_cache_dir() is None:
+            return None
+        if plugin_manager.hook.post_combine.get_hookimpls() or \
+                plugin_manager.hook.package_pre_archive.get_hookimpls():
+            return None
+        args = (fspath(src), filters, layer_method, allow_symlink, blocklist)
+        combiner = self._create_combiner(*args)
+        collection = combiner.collection
+        collection.apply_layer_filter(combiner.layer_filter)
+        if combiner.path_filter:
+            collection.apply_path_filter(combiner.path_filter)
+        signature = {}
+        for lf in collection.iter_all_files():
+            # Layer signatures only have 1 second resolution;  add nanosecond timestamps so that a
+            # same-size edit within the same second still results in a new key
+            st = lf.stat
+            signature[os.path.relpath(lf.physical_path, src)] = [
+                lf.calculate_signature(), st.st_mtime_ns, st.st_ctime_ns, st.st_size]
+        self._prepared_combiner = (args, combiner)
+
+        options = dict(options or {})
+        referenced = set()
+        for value in [self.app_name] + list(options.values()):
+            if isinstance(value, str):
+                referenced.update(AppVarMagic.var_regex.findall(value))
+        variables = {var: self._var_magic[var]
+                     for var in sorted(referenced - AppVarMagic.content_vars)
+                     if hasattr(self._var_magic, "get_" + var)}
+        data = {
+            "format": self._CACHE_FORMAT,
+            "ksconf": version,
+            "app_name": self.app_name,
+            "layer_method": layer_method,
+            "allow_symlink": allow_symlink,
+            "filters": filters,
+            "blocklist": blocklist,
+            "layers": collection.list_layer_names(),
+            "template_variables": self.template_variables,
+            "predictable_mtime": self.predictable_mtime,
+            "options": options,
+            "variables": variables,
+            "signature": signature,
+        }
+        payload = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _cache_entry_dir(self) -> Path:
+        # One entry per source app; a new build replaces the previous one
+        slot = hashlib.sha256(f"{os.path.abspath(self.src_path)}\0{self.app_name}"
+                              .encode("utf-8")).hexdigest()[:32]
+        return get_cache_dir("package", slot)  # type: ignore
+
+    @require_active_context
+    def load_cached_archive(self, cache_key: str) -> Optional[str]:
+        """
+        Restore a previously built archive matching ``cache_key`` from the build cache.  The
+        archive is written to the same filename it was originally built as, and its manifest is
+        returned by any subsequent call to :py:meth:`make_manifest`.  On success, the content is
+        frozen and the path of the archive is returned.  Otherwise None is returned, and the
+        app should be built as usual.
+        """
+        entry = self._cache_entry_dir()
+        try:
+            with open(entry / "build.json") as fp:
+                build = json.load(fp)
+            if build["key"] != cache_key:
+                return None
+            cached_archive = entry / "archive.tgz"
+            stored = StoredArchiveManifest.from_json_manifest(
+                cached_archive, entry / "manifest.json", permanent_archive=cached_archive)
+            manifest = stored.manifest
+            filename = build["filename"]
+        except (OSError, ValueError, KeyError, AppManifestStorageError):
+            return None
+        self.output.write(f"Reusing cached archive:  {filename}\n")
+        with atomic_writer(filename, temp_name=".tmp") as tmp_filename:
+            shutil.copyfile(cached_archive, tmp_filename)
+        self._manifest = manifest
+        self._prepared_combiner = None
+        self._mutable = False
+        self._frozen_by = "load_cached_archive"
+        return filename
 
-    def _execute_combiner(self, combiner: LayerCombiner):
+    @require_active_context(mutable=False)
+    def store_cached_archive(self, cache_key: str, filename: str):
+        """ Save the archive created by :py:meth:`make_archive` and its manifest in the build
+        cache, using a key from :py:meth:`build_cache_key`. """
+        entry = self._cache_entry_dir()
+        entry.mkdir(parents=True, exist_ok=True)
+        cached_archive = entry / "archive.tgz"
+        # Invalidate the previous entry first, in case we're interrupted
+        if (entry / "build.json").exists():
+            (entry / "build.json").unlink()
+        with atomic_writer(cached_archive, temp_name=".tmp") as tmp_filename:
+            shutil.copyfile(filename, tmp_filename)
+        create_manifest_from_archive(cached_archive, entry / "manifest.json",
+                                     self.make_manifest())
+        with atomic_writer(entry / "build.json", temp_name=".tmp") as tmp_filename:
+            with open(tmp_filename, "w") as fp:
+                json.dump({"key": cache_key, "filename": filename}, fp)
+
+    def _execute_combiner(self, combiner: _PackageCombiner):
         combiner.combine(self.app_dir, hook_label="package")
+        self._references.update(combiner.references)
         self._var_magic.meta["layers"] = combiner.layer_names_used
+        self._var_magic.invalidate()
+
+    def _reference_paths(self) -> Dict[str, Path]:
+        """ Return references as a mapping of full path within the build directory to source. """
+        return {os.path.join(self.app_dir, *rel_path.parts): source
+                for rel_path, source in self._references.items()}
+
+    def _drop_references(self, path: str):
+        """ Forget any references at or below ``path`` (a full path within the build directory). """
+        for rel_path in list(self._references):
+            ref_path = os.path.join(self.app_dir, *rel_path.parts)
+            if ref_path == path or ref_path.startswith(path + os.path.sep):
+                del self._references[rel_path]
+
+    def materialize(self, prefix: Optional[str] = None):
+        """ Copy referenced files into the build directory.  This is only necessary when the full
+        content of the app must be present on the filesystem.  Use ``prefix`` to limit the files
+        to a specific subdirectory, like ``local``. """
+        for rel_path, source in list(self._references.items()):
+            if prefix is None or rel_path.parts[0] == prefix:
+                shutil.copy2(source, os.path.join(self.app_dir, *rel_path.parts))
+                del self._references[rel_path]
+
+    def _blocklist_filter(self, patterns: List[str]) -> Callable[[PurePath], bool]:
+        """ Return a path filter (for use with
+        :py:meth:`~ksconf.layer.LayerCollectionBase.apply_path_filter`) that rejects any path
+        matching the blocklist ``patterns``, or located within a matching directory. """
+        blocklist = _Blocklist(patterns)
+        blocked_dirs: Dict[str, Optional[str]] = {}
+
+        def check_dir(path: str) -> Optional[str]:
+            if path not in blocked_dirs:
+                parent = os.path.dirname(path)
+                pattern = check_dir(parent) if parent else None
+                if pattern is None:
+                    pattern = blocklist.match(path)
+                    if pattern:
+                        self.output.write(f"Blocked dir:  {path}  (pattern: {pattern})\n")
+                blocked_dirs[path] = pattern
+            return blocked_dirs[path]
+
+        def path_filter(path: PurePath) -> bool:
+            rel_path = path.as_posix()
+            parent = os.path.dirname(rel_path)
+            if parent and check_dir(parent):
+                return False
+            pattern = blocklist.match(rel_path)
+            if pattern:
+                self.output.write(f"Blocked file: {rel_path}  (pattern: {pattern})\n")
+                return False
+            return True
+
+        return path_filter
 
     @require_active_context
     def blocklist(self, patterns):
-        # XXX: Rewrite explicitly blocklist '.git' dir, because '.git*' wasn't working here. :=(
+        """ Remove any files or directories matching ``patterns`` from the build directory.
 
-        # For now we just delete files out the build directory.  Not sophisticated, but it works
-        # Do we need relwalker here?  relwalk
-        from fnmatch import fnmatch
-        for (root, dirs, files) in os.walk(self.build_dir, topdown=True):
+        Prefer passing ``blocklist`` to :py:meth:`combine`, which prevents blocked files from
+        being processed at all.  This method remains useful for content added to the build
+        directory by other means.
+        """
+        blocklist = _Blocklist(patterns)
+        references = self._reference_paths()
+        for (root, dirs, files) in os.walk(self.app_dir, topdown=True):
+            files = files + [os.path.basename(ref) for ref in references
+                             if os.path.dirname(ref) == root]
             for fn in files:
                 path = os.path.join(root, fn)
-                for pattern in patterns:
-                    if ("*" in pattern and fnmatch(path, pattern)) or fn == pattern:
-                        self.output.write(f"Blocked file: {path}  (pattern: {pattern})\n")
+                pattern = blocklist.match(os.path.relpath(path, self.app_dir).replace(os.sep, "/"))
+                if pattern:
+                    self.output.write(f"Blocked file: {path}  (pattern: {pattern})\n")
+                    if path in references:
+                        self._drop_references(path)
+                    else:
                         os.unlink(path)
-                        break
             for d in list(dirs):
                 path = os.path.join(root, d)
-                for pattern in patterns:
-                    if ("*" in pattern and fnmatch(path, pattern)) or d == pattern:
-                        self.output.write(f"Blocked dir:  {path}  (pattern: {pattern})\n")
-                        dirs.remove(d)
-                        shutil.rmtree(path)
-                        break
+                pattern = blocklist.match(os.path.relpath(path, self.app_dir).replace(os.sep, "/"))
+                if pattern:
+                    self.output.write(f"Blocked dir:  {path}  (pattern: {pattern})\n")
+                    dirs.remove(d)
+                    shutil.rmtree(path)
+                    self._drop_references(path)
+        self._var_magic.invalidate()
 
     @require_active_context
     def merge_local(self):
@@ -188,9 +607,12 @@ class AppPackager:
         Find everything in local, if it has a corresponding file in default, merge.
         """
         # XXX: No logging/reporting done here :-(
+        # Non-conf files in local are moved into default
+        self.materialize("local")
         merge_app_local(self.app_dir)
         # Cleanup anything remaining in local
         self.block_local(report=False)
+        self._var_magic.invalidate()
 
     @require_active_context
     def block_local(self, report=True):
@@ -199,11 +621,13 @@ class AppPackager:
             if report:
                 self.output.write("Removing local directory.\n")
             shutil.rmtree(local_dir)
+            self._drop_references(local_dir)
         local_meta = os.path.join(self.app_dir, "metadata", "local.meta")
         if os.path.isfile(local_meta):
             if report:
                 self.output.write("Removing local.meta\n")
             os.unlink(local_meta)
+        self._var_magic.invalidate()
 
     @require_active_context
     def update_app_conf(self,
@@ -233,6 +657,7 @@ class AppPackager:
                         self.output.write(f"\tUpdate app.conf:  [{stanza}] "
                                           f"{attr} = {value}\n")
                     conf[stanza][attr] = value
+        self._var_magic.invalidate()
 
     @require_active_context(mutable=False)
     def check(self):
@@ -244,7 +669,7 @@ class AppPackager:
         """
         # Should this force a freeze?  (Disable if this breaks anything...)
         self.freeze("check")
-        app_conf = get_merged_conf(self.app_dir, "app.conf")
+        app_conf = get_merged_conf_view(self.app_dir, "app.conf")
         try:
             package_id = app_conf["package"]["id"]
             target_splunkbase = conf_attr_boolean(app_conf["package"]
@@ -268,15 +693,21 @@ class AppPackager:
                                              "discrepancy for public app:  "
                                              f"{package_id} != {self.app_name}")
 
+        references = self._reference_paths()
         for root, dirs, files in os.walk(self.app_dir):
+            files = files + [os.path.basename(ref) for ref in references
+                             if os.path.dirname(ref) == root]
             for items, t in [(dirs, "directory"), (files, "file")]:
                 for name in items:
                     if name[0] == ".":
                         self.output.write(f"Found hidden {t}:  {root}/{name}\n")
 
     @require_active_context(mutable=False)
-    def make_archive(self, filename: str, temp_suffix: str = ".tmp") -> str:
+    def make_archive(self, filename: str, temp_suffix: str = ".tmp", compress_level: int = 9,
+                     threads: Optional[int] = None) -> str:
         """ Create a compressed tarball of the build directory.
+
+        Compression is done with multiple threads; by default one per CPU.
         """
         self.freeze("make_archive")
         # if os.path.isfile(filename):
@@ -294,23 +725,37 @@ class AppPackager:
         else:
             self.output.write(f"Creating archive:  {filename}\n")
 
-        if self.predictable_mtime:
-            normalize_directory_mtime(self.app_dir)
-
+        writer = _ArchiveWriter(self.app_dir, self._reference_paths(),
+                                predictable_mtime=self.predictable_mtime)
         with atomic_writer(filename, temp_name=temp_suffix) as tmp_filename:
-            with tarfile.open(tmp_filename, mode="w:gz") as spl:
-                spl.add(self.app_dir, arcname=self.app_name)
+            with open(tmp_filename, "wb") as stream, \
+                    ParallelGzipWriter(stream, compress_level, threads) as gz, \
+                    tarfile.open(fileobj=gz, mode="w|") as spl:
+                files = writer.write(spl, self.app_name)
+        # Content is frozen, so the manifest can be reused by make_manifest()
+        manifest = AppManifest(app_name, source=self.src_path, files=files)
+        self._manifest = manifest
         return filename
 
     @require_active_context(mutable=False)
     def make_manifest(self, calculate_hash=True) -> AppManifest:
         """
-        Create a manifest of the app's contents.
+        Create a manifest of the app's contents.  If :py:meth:`make_archive` has already been
+        called, the manifest collected while creating the archive is returned.
         """
         self.freeze("make_manifest")
+        if self._manifest:
+            return self._manifest
         app_name = self.expand_var(self.app_name)
         manifest = AppManifest.from_filesystem(self.app_dir, name=app_name,
                                                calculate_hash=calculate_hash)
+        for rel_path, source in self._references.items():
+            st = os.stat(source)
+            amf = AppManifestFile(rel_path, st.st_mode & 0o777, st.st_size)
+            if calculate_hash:
+                amf.hash = file_hash(source, manifest.hash_algorithm)
+            manifest.files.append(amf)
+        manifest.files.sort()
         manifest.source = self.src_path
         return manifest
 
@@ -325,8 +770,12 @@ class AppPackager:
         label used in an exception message if the programmer screwed up.
         """
         if self._mutable:
+            if plugin_manager.hook.package_pre_archive.get_hookimpls():
+                # Plugins may inspect or modify any file
+                self.materialize()
             plugin_manager.hook.package_pre_archive(app_dir=Path(self.app_dir),
                                                     app_name=self.expand_var(self.app_name))
+            self._var_magic.invalidate()
             # Forbid any additional internal changes to the package
             self._mutable = False
             self._frozen_by = caller_name
@@ -334,6 +783,8 @@ class AppPackager:
     def __enter__(self) -> AppPackager:
         self.build_dir = tempfile.mkdtemp("-ksconf-package-build")
         self._mutable = True
+        self._references = {}
+        self._manifest = None
         if self.app_name == "." or "{{" in self.app_name:
             # Use a placeholder app name, otherwise build_dir == app_dir
             self.app_dir = os.path.join(self.build_dir, "app")
@@ -353,12 +804,33 @@ class AppVarMagicException(KeyError):
 class AppVarMagic:
     """ A lazy loading dict-like object to fetch things like app version and such on demand. """
 
+    var_regex = re.compile(r"\{\{\s*([\w_]+)\s*\}\}")
+
+    # Variables whose value is determined entirely by the content of the app
+    content_vars = frozenset(["version", "build", "app_id", "layers_list", "layers_hash"])
+
     def __init__(self, src_dir, build_dir, meta=None):
         self._cache = {}
+        self._app_conf: Optional[MergedConfView] = None
+        self._git_facts: Optional[Dict[str, str]] = None
         self.src_dir = src_dir
         self.build_dir = build_dir
         self.meta = meta or {}
 
+    def invalidate(self):
+        """ Forget any values derived from the app's content.  Must be called whenever the
+        content of ``build_dir`` changes. """
+        self._app_conf = None
+        for var in self.content_vars:
+            self._cache.pop(var, None)
+
+    @property
+    def app_conf(self) -> MergedConfView:
+        """ Merged ``app.conf`` of the app, parsed only once until :py:meth:`invalidate`. """
+        if self._app_conf is None:
+            self._app_conf = get_merged_conf_view(self.build_dir, "app.conf")
+        return self._app_conf
+
     def expand(self, value: str) -> str:
         """ A simple Jinja2 like ``{{VAR}}`` substitution mechanism. """
         def replace(match_obj):
@@ -366,7 +838,7 @@ class AppVarMagic:
             return self[var]
         if value:
             value = str(value)
-            return re.sub(r"\{\{\s*([\w_]+)\s*\}\}", replace, value)
+            return self.var_regex.sub(replace, value)
         return value
 
     def git_single_line(self, *args):
@@ -375,11 +847,41 @@ class AppVarMagic:
             return f"git-errorcode-{out.returncode}"
         return out.stdout.strip()
 
+    def git_describe(self) -> Dict[str, str]:
+        """
+        Return the repository-wide facts ``tag`` and ``head`` gathered from a single
+        ``git describe`` call.  Results are kept for the life of this object (one packaging
+        session), so each session sees the current state of the repository.
+        """
+        facts = self._git_facts
+        if facts is None:
+            out = git_cmd(["describe", "--tags", "--always", "--dirty", "--long"],
+                          cwd=self.src_dir)
+            if out.returncode != 0:
+                error = f"git-errorcode-{out.returncode}"
+                facts = {"tag": error, "head": error}
+            else:
+                description = out.stdout.strip()
+                dirty = ""
+                if description.endswith("-dirty"):
+                    description, dirty = description[:-6], "-dirty"
+                # With --long, output is always <tag>-<distance>-g<rev> unless no tag exists
+                match = re.match(r"^(.*)-(\d+)-g([0-9a-f]+)$", description)
+                if match:
+                    tag, distance, head = match.groups()
+                    if distance != "0":
+                        tag = description
+                else:
+                    tag = head = description
+                facts = {"tag": tag + dirty, "head": head}
+            self._git_facts = facts
+        return facts
+
     # START Variable fetching functions.  Be sure to add a docstring
 
     def get_version(self):
         """ Splunk app version fetched from app.conf """
-        app_conf = get_merged_conf(self.build_dir, "app.conf")
+        app_conf = self.app_conf
         try:
             return app_conf["launcher"]["version"]
         except KeyError as e:
@@ -387,7 +889,7 @@ class AppVarMagic:
 
     def get_build(self):
         """ Splunk app build fetched from app.conf """
-        app_conf = get_merged_conf(self.build_dir, "app.conf")
+        app_conf = self.app_conf
         try:
             return app_conf["install"]["build"]
         except KeyError as e:
@@ -395,7 +897,7 @@ class AppVarMagic:
 
     def get_app_id(self):
         """ Splunk app package id from app.conf """
-        app_conf = get_merged_conf(self.build_dir, "app.conf")
+        app_conf = self.app_conf
         try:
             return app_conf["package"]["id"]
         except KeyError as e:
@@ -403,7 +905,7 @@ class AppVarMagic:
 
     def get_git_tag(self):
         """ Git version tag using the ``git describe --tags`` command """
-        tag = self.git_single_line("describe", "--tags", "--always", "--dirty")
+        tag = self.git_describe()["tag"]
         return re.sub(r'^(v|release|version)-?', "", tag)
 
     def get_git_last_rev(self):
@@ -412,7 +914,7 @@ class AppVarMagic:
 
     def get_git_head(self):
         """ Git HEAD rev abbreviated """
-        return self.git_single_line("rev-parse", "--short", "HEAD")
+        return self.git_describe()["head"]
 
     def get_layers_list(self):
         """ List of ksconf layers used. """
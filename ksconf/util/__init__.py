@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial, wraps
 from typing import Callable
 
@@ -40,6 +42,21 @@ def decorator_with_opt_kwargs(decorator: Callable) -> Callable:
     return decorator_wrapper
 
 
+def process_pool(max_workers: int, **kwargs) -> ProcessPoolExecutor:
+    """
+    Return a :py:class:`~concurrent.futures.ProcessPoolExecutor` whose workers are started fresh
+    (using ``forkserver`` or ``spawn``) instead of being forked from the current process.  Forked
+    workers inherit a copy of every object in memory, including any (possibly running) threads, and
+    may run cleanup code (like removing temporary files) for objects that are garbage collected.
+    Additional keyword arguments are passed to the executor.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, **kwargs)
+
+
 def debug_traceback():  # pragma: no cover
     """ If the 'KSCONF_DEBUG' environmental variable is set, then show a stack trace. """
     level = 10
@@ -10,9 +10,9 @@ from glob import glob
 from io import open
 from pathlib import Path
 from random import randint
-from typing import IO, Callable, Generator, Iterable, List, Tuple, Union
+from typing import IO, Callable, Dict, Generator, Iterable, List, Optional, Tuple, Union
 
-from ksconf.consts import SMART_CREATE, SMART_NOCHANGE, SMART_UPDATE, is_debug
+from ksconf.consts import KSCONF_CACHE_DIR, SMART_CREATE, SMART_NOCHANGE, SMART_UPDATE, is_debug
 from ksconf.types import StrPath
 from ksconf.util.compare import file_compare
 
@@ -38,11 +38,61 @@ def dir_exists(directory):
     _dir_exists_cache.add(directory)
 
 
+# Process-wide memo of file identity (dev, inode, size, mtime) to content hash.  Disabled (None)
+# unless enabled via enable_file_hash_memo()
+_file_hash_memo: Optional[Dict[Tuple[int, int, int, int], str]] = None
+
+
+def enable_file_hash_memo(enabled: bool = True):
+    """ Enable (or disable and clear) the process-wide memo used by :py:func:`file_hash_memo`.
+    Once enabled, the content of an unchanged file is only read once, no matter how many times
+    it's compared.  A file is considered unchanged if its device, inode, size, and modification
+    time are unchanged. """
+    global _file_hash_memo
+    if enabled:
+        if _file_hash_memo is None:
+            _file_hash_memo = {}
+    else:
+        _file_hash_memo = None
+
+
+def file_hash_memo(path: StrPath, st: Optional[os.stat_result] = None) -> str:
+    """ Like :py:func:`file_hash`, but use the process-wide memo, if enabled. """
+    if _file_hash_memo is None:
+        return file_hash(path)
+    if st is None:
+        st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    try:
+        return _file_hash_memo[key]
+    except KeyError:
+        h = _file_hash_memo[key] = file_hash(path)
+        return h
+
+
+def file_fast_compare(src: StrPath, dest: StrPath) -> bool:
+    """ Determine if ``dest`` has the same content as ``src``, avoiding reading either file when
+    possible.  Files of different sizes never match.  Files with the same size and modification
+    time are assumed to match, as is the case for a prior copy made by :py:func:`smart_copy`
+    (which preserves modification times).  Otherwise, content is compared, using content hashes
+    from the file hash memo if :py:func:`enable_file_hash_memo` has been called. """
+    src_st = os.stat(src)
+    dest_st = os.stat(dest)
+    if src_st.st_size != dest_st.st_size:
+        return False
+    if src_st.st_mtime_ns == dest_st.st_mtime_ns:
+        return True
+    if _file_hash_memo is not None:
+        return file_hash_memo(src, src_st) == file_hash_memo(dest, dest_st)
+    return file_compare(src, dest)
+
+
 def smart_copy(src, dest):
-    """ Copy (overwrite) file only if the contents have changed. """
+    """ Copy (overwrite) file only if the contents have changed.
+    See :py:func:`file_fast_compare` for how changes are detected. """
     ret = SMART_CREATE
     if os.path.isfile(dest):
-        if file_compare(src, dest):
+        if file_fast_compare(src, dest):
             # Files already match.  Nothing to do.
             return SMART_NOCHANGE
         else:
@@ -52,6 +102,95 @@ def smart_copy(src, dest):
     return ret
 
 
+LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+
+# Linux ioctl to share the data blocks of another file (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _reflink(src: StrPath, dest: StrPath):
+    """ Create ``dest`` as a copy-on-write clone of ``src``.  Raises OSError if unsupported. """
+    import fcntl
+    with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+        try:
+            fcntl.ioctl(dest_f.fileno(), _FICLONE, src_f.fileno())
+        except OSError:
+            dest_f.close()
+            os.unlink(dest)
+            raise
+    shutil.copystat(src, dest)
+
+
+def smart_link(src: StrPath, dest: StrPath, mode: str = "copy"):
+    """ Materialize ``src`` at ``dest`` using the given link ``mode``, if not already current.
+
+    Supported modes are listed in :py:data:`LINK_MODES`.  ``hardlink`` and ``symlink`` make
+    ``dest`` refer to ``src`` directly, and ``reflink`` creates a copy-on-write clone which shares
+    data blocks with ``src`` on supporting filesystems.  Whenever the requested mode is unavailable
+    (different filesystems, unsupported OS, ...) a regular copy is made.  Like
+    :py:func:`smart_copy`, the return value indicates if ``dest`` was created, updated, or unchanged.
+    """
+    if mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode {mode!r}.  Expected one of {', '.join(LINK_MODES)}")
+    ret = SMART_CREATE
+    if os.path.islink(dest):
+        if mode == "symlink" and os.readlink(dest) == os.path.abspath(src):
+            return SMART_NOCHANGE
+        os.unlink(dest)
+        ret = SMART_UPDATE
+    elif os.path.isfile(dest):
+        if _samefile(src, dest):
+            if mode == "hardlink":
+                return SMART_NOCHANGE
+            # Break the link from a previous run, so that dest no longer shares src's inode
+        elif mode != "symlink" and file_fast_compare(src, dest):
+            return SMART_NOCHANGE
+        os.unlink(dest)
+        ret = SMART_UPDATE
+
+    try:
+        if mode == "hardlink":
+            os.link(src, dest)
+            return ret
+        elif mode == "symlink":
+            os.symlink(os.path.abspath(src), dest)
+            return ret
+        elif mode == "reflink":
+            _reflink(src, dest)
+            return ret
+    except (OSError, ImportError, NotImplementedError):
+        # Fallback to a regular copy
+        pass
+    shutil.copy2(src, dest)
+    return ret
+
+
+def smart_write_bytes(content: bytes, dest: StrPath):
+    """ Write ``content`` to ``dest`` only if it differs from the existing file.  Like
+    :py:func:`smart_copy`, but for content that's already in memory. """
+    ret = SMART_CREATE
+    if os.path.isfile(dest):
+        if os.path.getsize(dest) == len(content):
+            with open(dest, "rb") as f:
+                if f.read() == content:
+                    return SMART_NOCHANGE
+        ret = SMART_UPDATE
+        os.unlink(dest)
+    with open(dest, "wb") as f:
+        f.write(content)
+    return ret
+
+
+def get_cache_dir(*parts: str) -> Optional[Path]:
+    """ Return a subdirectory of the persistent cache location given by the ``KSCONF_CACHE_DIR``
+    environmental variable, or None if caching has not been enabled.  The directory is not created.
+    """
+    cache_root = os.environ.get(KSCONF_CACHE_DIR)
+    if not cache_root:
+        return None
+    return Path(cache_root).joinpath(*parts)
+
+
 def _stdin_iter(stream=None):
     if stream is None:
         stream = sys.stdin
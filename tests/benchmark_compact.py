@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Measure memory used by parsed conf files with and without compact stanzas.
+
+Not run as part of the unit test suite.  Usage:
+
+    python tests/benchmark_compact.py [--files N] [--stanzas N] [file.conf ...]
+
+When no files are given, a set of synthetic inputs.conf-like files is generated, similar to
+parsing the same app deployed across many layers or many apps sharing common settings.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from io import StringIO
+
+# Allow interactive execution from CLI,  cd tests; ./benchmark_compact.py
+if __package__ is None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ksconf.conf.parser import PARSECONF_MID_NC, parse_conf_stream
+
+
+def make_synthetic_conf(file_num: int, stanzas: int) -> str:
+    out = StringIO()
+    for i in range(stanzas):
+        out.write(f"[monitor:///var/log/app{file_num}/service{i}.log]\n")
+        out.write("disabled = 0\n")
+        out.write(f"index = app{file_num % 10}\n")
+        out.write(f"sourcetype = service:{i % 20}\n")
+        out.write("crcSalt = <SOURCE>\n")
+        out.write("ignoreOlderThan = 7d\n")
+        out.write("whitelist = \\.log$\n")
+        out.write("\n")
+    return out.getvalue()
+
+
+def measure(texts, profile):
+    gc.collect()
+    start = time.perf_counter()
+    confs = [parse_conf_stream(StringIO(text), **profile) for text in texts]
+    elapsed = time.perf_counter() - start
+    del confs
+    # Timing is done separately because tracing slows down allocations considerably
+    gc.collect()
+    tracemalloc.start()
+    confs = [parse_conf_stream(StringIO(text), **profile) for text in texts]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del confs
+    return current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("conf", nargs="*", help="Conf file(s) to parse.  Default:  synthetic")
+    parser.add_argument("--files", type=int, default=200,
+                        help="Number of synthetic files.  Default: %(default)s")
+    parser.add_argument("--stanzas", type=int, default=200,
+                        help="Number of stanzas per synthetic file.  Default: %(default)s")
+    args = parser.parse_args()
+
+    if args.conf:
+        texts = []
+        for path in args.conf:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+    else:
+        texts = [make_synthetic_conf(i, args.stanzas) for i in range(args.files)]
+
+    print(f"{len(texts)} files  ({sum(len(t) for t in texts) / 1024 / 1024:.1f} MB of text)")
+    dict_mem, dict_time = measure(texts, PARSECONF_MID_NC)
+    compact_mem, compact_time = measure(texts, dict(PARSECONF_MID_NC, compact=True))
+    print(f"  dict     {dict_mem / 1024 / 1024:8.1f} MB  {dict_time:.3f}s")
+    print(f"  compact  {compact_mem / 1024 / 1024:8.1f} MB  {compact_time:.3f}s  "
+          f"reduction={100 * (1 - compact_mem / dict_mem):.0f}%")
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
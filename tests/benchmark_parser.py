@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Benchmark the single-pass conf tokenizer against the original generator-based parser.
+
+Not run as part of the unit test suite.  Usage:
+
+    python tests/benchmark_parser.py [--stanzas N] [--repeat N] [file.conf ...]
+
+When no files are given, a synthetic savedsearches-like file is generated.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from io import StringIO
+
+# Allow interactive execution from CLI,  cd tests; ./benchmark_parser.py
+if __package__ is None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ksconf.conf.parser import (DUP_EXCEPTION, DUP_MERGE, DUP_OVERWRITE,
+                                GLOBAL_STANZA, PARSECONF_LOOSE, PARSECONF_MID,
+                                PARSECONF_STRICT, DuplicateEnum,
+                                DuplicateKeyException, DuplicateStanzaException,
+                                _format_stanza, cont_handler, parse_conf_stream,
+                                section_reader, splitup_kvpairs)
+
+
+def parse_conf_stream_legacy(stream,
+                             keys_lower: bool = False,
+                             handle_conts: bool = True,
+                             keep_comments: bool = False,
+                             dup_stanza: DuplicateEnum = DUP_EXCEPTION,
+                             dup_key: DuplicateEnum = DUP_OVERWRITE,
+                             strict: bool = False) -> dict:
+    """
+    Original generator-based implementation of :func:`parse_conf_stream`.
+
+    Retained as a reference implementation for unit testing and benchmarking the single-pass
+    tokenizer.
+    """
+    if hasattr(stream, "name"):
+        stream_name = stream.name
+    else:
+        stream_name = repr(stream)
+
+    sections = {}
+    # Q: What's the value of allowing line continuations to be disabled?
+    if handle_conts:
+        stream = cont_handler(stream)
+    for section, entry in section_reader(stream):
+        if section is None:
+            section = GLOBAL_STANZA
+        if section in sections:
+            if dup_stanza == DUP_OVERWRITE:
+                s = sections[section] = {}
+            elif dup_stanza == DUP_EXCEPTION:
+                raise DuplicateStanzaException(
+                    f"Stanza [{_format_stanza(section)}] found more than once "
+                    f"in config file {stream_name}")
+            elif dup_stanza == DUP_MERGE:
+                s = sections[section]
+            else:
+                raise TypeError(f"Unknown value '{dup_stanza}' for dup_stanza")
+        else:
+            s = sections[section] = {}
+        local_stanza = {}
+        for key, value in splitup_kvpairs(entry, keep_comments=keep_comments, strict=strict):
+            if keys_lower:
+                key = key.lower()
+            if key in local_stanza:
+                if dup_key in (DUP_OVERWRITE, DUP_MERGE):
+                    s[key] = value
+                    local_stanza[key] = value
+                elif dup_key == DUP_EXCEPTION:
+                    raise DuplicateKeyException(
+                        f"Stanza [{_format_stanza(section)}] has duplicate "
+                        f"key '{key}' in file {stream_name}")
+            else:
+                local_stanza[key] = value
+                s[key] = value
+        del s
+    # If the global entry is just a blank line, drop it
+    if GLOBAL_STANZA in sections:
+        g = sections[GLOBAL_STANZA]
+        if not g:
+            # if len(g) == 1 and not g[0]:
+            del sections[GLOBAL_STANZA]
+    return sections
+
+
+def make_synthetic_conf(stanzas: int) -> str:
+    out = StringIO()
+    out.write("# Synthetic benchmark data\n")
+    for i in range(stanzas):
+        out.write(f"[Search number {i}]\n")
+        out.write("# Generated by benchmark_parser\n")
+        out.write(f"description = Saved search {i}\n")
+        out.write("dispatch.earliest_time = -24h\n")
+        out.write("dispatch.latest_time = now\n")
+        out.write(f"cron_schedule = {i % 60} * * * *\n")
+        out.write("disabled = 0\n")
+        out.write(f"search = index=main sourcetype=st{i} \\\n")
+        out.write("| stats count by host \\\n")
+        out.write("| where count > 10\n")
+        out.write("\n")
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("conf", nargs="*", help="Conf file(s) to parse.  Default:  synthetic")
+    parser.add_argument("--stanzas", type=int, default=20000,
+                        help="Number of stanzas in the synthetic input.  Default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed runs (best is reported).  Default: %(default)s")
+    args = parser.parse_args()
+
+    if args.conf:
+        inputs = []
+        for path in args.conf:
+            with open(path, encoding="utf-8") as f:
+                inputs.append((path, f.read()))
+    else:
+        inputs = [(f"<synthetic {args.stanzas} stanzas>", make_synthetic_conf(args.stanzas))]
+
+    profiles = [("MID", PARSECONF_MID), ("STRICT", PARSECONF_STRICT), ("LOOSE", PARSECONF_LOOSE)]
+    for name, text in inputs:
+        print(f"{name}  ({len(text) / 1024 / 1024:.1f} MB)")
+        for profile_name, profile in profiles:
+            legacy = min(timeit.repeat(lambda: parse_conf_stream_legacy(StringIO(text), **profile),
+                                       number=1, repeat=args.repeat))
+            current = min(timeit.repeat(lambda: parse_conf_stream(StringIO(text), **profile),
+                                        number=1, repeat=args.repeat))
+            print(f"  {profile_name:8} legacy={legacy:.3f}s  tokenizer={current:.3f}s  "
+                  f"speedup={legacy / current:.2f}x")
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import unittest
+
+# Allow interactive execution from CLI,  cd tests; ./test_cli.py
+if __package__ is None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ksconf.consts import EXIT_CODE_BAD_CONF_FILE, EXIT_CODE_CONF_NO_DATA_MATCH, EXIT_CODE_SUCCESS
+from tests.cli_helper import TestWorkDir, ksconf_cli
+
+
+class CliAttrGetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.twd = twd = TestWorkDir()
+        self.conf = twd.write_file("app.conf", r"""
+        [launcher]
+        version = 1.2.3
+        description = Multi-line \
+        description
+
+        [install]
+        build = 7
+        """)
+
+    def test_get_value(self):
+        with ksconf_cli:
+            ko = ksconf_cli("attr-get", self.conf, "--stanza", "launcher", "--attribute", "version")
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            self.assertEqual(ko.stdout, "1.2.3\n")
+            ko = ksconf_cli("attr-get", self.conf, "-s", "launcher", "-a", "description")
+            self.assertEqual(ko.stdout, "Multi-line \ndescription\n")
+
+    def test_missing(self):
+        with ksconf_cli:
+            ko = ksconf_cli("attr-get", self.conf, "-s", "nope", "-a", "version")
+            self.assertEqual(ko.returncode, EXIT_CODE_CONF_NO_DATA_MATCH)
+            ko = ksconf_cli("attr-get", self.conf, "-s", "install", "-a", "version")
+            self.assertEqual(ko.returncode, EXIT_CODE_CONF_NO_DATA_MATCH)
+            ko = ksconf_cli("attr-get", self.conf, "-s", "nope", "-a", "version", "--missing-okay")
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+
+    def test_bad_stanza(self):
+        bad = self.twd.write_file("bad.conf", """
+        [good]
+        a = 1
+        [bad]
+        [dangling
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("attr-get", bad, "-s", "bad", "-a", "a")
+            self.assertEqual(ko.returncode, EXIT_CODE_BAD_CONF_FILE)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
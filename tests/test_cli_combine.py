@@ -4,15 +4,19 @@ from __future__ import absolute_import, print_function, unicode_literals
 import os
 import sys
 import unittest
+from unittest import mock
 
-from ksconf.layer import layer_file_factory
+import ksconf.util.file
+from ksconf.layer import LayerFilter, layer_file_factory
 
 # Allow interactive execution from CLI,  cd tests; ./test_cli.py
 if __package__ is None:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from ksconf.combine import LayerCombiner, MergeCache
+from ksconf.conf.merge import merge_conf_dicts
 from ksconf.conf.parser import PARSECONF_LOOSE, parse_conf
-from ksconf.consts import EXIT_CODE_COMBINE_MARKER_MISSING, EXIT_CODE_SUCCESS
+from ksconf.consts import EXIT_CODE_BAD_ARGS, EXIT_CODE_COMBINE_MARKER_MISSING, EXIT_CODE_SUCCESS
 from tests.cli_helper import TestWorkDir, ksconf_cli
 
 try:
@@ -21,6 +25,23 @@ except ImportError:
     jinja2 = None
 
 
+class _TaggingCombiner(LayerCombiner):
+    """ Tag merged files and record copied files;  must work the same with any number of jobs. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tag = "untagged"
+        self.copied = []
+
+    def combine_file(self, dest_path, sources, handler):
+        super().combine_file(dest_path, sources, handler)
+        if handler:
+            with open(dest_path, "a") as f:
+                f.write(f"# {self.tag}\n")
+        else:
+            self.copied.append(dest_path.name)
+
+
 class CliKsconfCombineTestCase(unittest.TestCase):
 
     def build_test01(self, twd):
@@ -202,6 +223,302 @@ class CliKsconfCombineTestCase(unittest.TestCase):
             self.assertIn("aws:config", cfg)
             self.assertEqual(cfg["aws:config"]["TRUNCATE"], '8383')
 
+    @unittest.skipIf(jinja2 is None, "Test requires 'jinja2'")
+    def test_combine_JINJA_in_memory(self):
+        """ Rendered templates are merged and copied without writing temporary files. """
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        twd.write_file("etc/apps/Splunk_TA_aws/default.d/99-dynamic-magic/props.conf.j2", """
+        [aws:config]
+        TRUNCATE = {{ big_ole_number }}
+        """)
+        twd.write_file("etc/apps/Splunk_TA_aws/default.d/99-dynamic-magic/README.spec.j2", """
+        Number {{ big_ole_number }}
+        """)
+        default = twd.get_path("etc/apps/Splunk_TA_aws")
+        target = twd.get_path("etc/apps/Splunk_TA_aws-OUTPUT")
+        with ksconf_cli, layer_file_factory, \
+                mock.patch("ksconf.layer.NamedTemporaryFile") as named_temp_file:
+            ko = ksconf_cli("combine", "--layer-method", "dir.d",
+                            "--template-vars", '{"big_ole_number": 8383}',
+                            "--enable-handler", "jinja",
+                            "--target", target, default)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            named_temp_file.assert_not_called()
+        cfg = parse_conf(target + "/default/props.conf")
+        self.assertEqual(cfg["aws:config"]["TRUNCATE"], '8383')
+        self.assertEqual(twd.read_file("etc/apps/Splunk_TA_aws-OUTPUT/default/README.spec").strip(),
+                         "Number 8383")
+
+    @unittest.skipIf(jinja2 is None, "Test requires 'jinja2'")
+    def test_combine_JINJA_jobs(self):
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        for i in range(6):
+            twd.write_file(f"etc/apps/Splunk_TA_aws/default.d/{i + 70}-dynamic/props.conf.j2", f"""
+            [aws:config]
+            TRUNCATE = {{{{ big_ole_number + {i} }}}}
+            [layer{i}]
+            EVAL-x = "{{{{ big_ole_number }}}}"
+            """)
+        default = twd.get_path("etc/apps/Splunk_TA_aws")
+        outputs = []
+        for jobs in ("1", "3"):
+            target = twd.get_path(f"etc/apps/Splunk_TA_aws-OUTPUT{jobs}")
+            with ksconf_cli, layer_file_factory:
+                ko = ksconf_cli("combine", "--layer-method", "dir.d",
+                                "--template-vars", '{"big_ole_number": 8383}',
+                                "--enable-handler", "jinja", "--jobs", jobs,
+                                "--banner", "",
+                                "--target", target, default)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            outputs.append(twd.read_file(f"etc/apps/Splunk_TA_aws-OUTPUT{jobs}/default/props.conf"))
+        self.assertEqual(outputs[0], outputs[1])
+        cfg = parse_conf(target + "/default/props.conf")
+        self.assertEqual(cfg["aws:config"]["TRUNCATE"], "8388")
+        self.assertEqual(cfg["layer3"]["EVAL-x"], '"8383"')
+
+    def test_combine_incremental(self):
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        src = twd.get_path("etc/apps/Splunk_TA_aws")
+        target = twd.get_path("etc/apps/Splunk_TA_aws-OUTPUT")
+
+        def combine(*args):
+            with ksconf_cli:
+                ko = ksconf_cli("combine", "--layer-method", "dir.d", "--target", target, src, *args)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            return ko
+
+        combine()
+        self.assertTrue(os.path.isfile(os.path.join(target, ".ksconf_state.json")))
+        # The file hash memo is only used during the run
+        self.assertIsNone(ksconf.util.file._file_hash_memo)
+        props = os.path.join(target, "default", "props.conf")
+        combine()
+        state_stat = os.stat(os.path.join(target, ".ksconf_state.json"))
+
+        # Nothing changed; no files are rebuilt and the state file is not rewritten
+        with mock.patch("ksconf.combine.merge_conf_files") as merge, \
+                mock.patch("ksconf.combine.smart_link") as copy:
+            combine()
+            merge.assert_not_called()
+            copy.assert_not_called()
+        self.assertEqual(os.stat(os.path.join(target, ".ksconf_state.json")), state_stat)
+
+        # Source updated
+        twd.write_file("etc/apps/Splunk_TA_aws/default.d/60-dept/props.conf", """
+        [aws:config]
+        TZ = UTC
+        """)
+        combine()
+        self.assertEqual(parse_conf(props)["aws:config"]["TZ"], "UTC")
+
+        # Output modified by hand is rebuilt
+        twd.write_file("etc/apps/Splunk_TA_aws-OUTPUT/default/props.conf", "[x]\n")
+        combine()
+        self.assertIn("aws:config", parse_conf(props))
+
+        # Outputs with missing sources and unwanted files are removed
+        twd.write_file("etc/apps/Splunk_TA_aws/default.d/60-dept/extra.conf", "[x]\n")
+        combine()
+        self.assertTrue(os.path.isfile(os.path.join(target, "default/extra.conf")))
+        os.unlink(twd.get_path("etc/apps/Splunk_TA_aws/default.d/60-dept/extra.conf"))
+        twd.write_file("etc/apps/Splunk_TA_aws-OUTPUT/default/data/ui/views/junk.xml", "<junk/>")
+        combine()
+        self.assertFalse(os.path.exists(os.path.join(target, "default/extra.conf")))
+        self.assertFalse(os.path.exists(os.path.join(target, "default/data/ui/views/junk.xml")))
+
+        # Without state, everything is rebuilt
+        with mock.patch("ksconf.combine.merge_conf_files") as merge:
+            combine("--disable-state")
+            merge.assert_called()
+
+    @unittest.skipIf(sys.platform == "win32", "Requires symlink support")
+    def test_combine_target_symlink_dir(self):
+        """ Symlinked directories in the target are never removed as unwanted files. """
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        src = twd.get_path("etc/apps/Splunk_TA_aws")
+        target = twd.get_path("etc/apps/Splunk_TA_aws-OUTPUT")
+        twd.write_file("external/keep.txt", "keep")
+
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--layer-method", "dir.d", "--target", target, src)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+        link = os.path.join(target, "linked")
+        os.symlink(twd.get_path("external"), link)
+
+        for args in ([], ["--disable-state"]):
+            with ksconf_cli:
+                ko = ksconf_cli("combine", "--layer-method", "dir.d", "--target", target, src,
+                                *args)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            self.assertTrue(os.path.islink(link))
+            self.assertTrue(os.path.isfile(twd.get_path("external/keep.txt")))
+
+    def test_combine_parallel(self):
+        """ Parallel output (files, log, and dry-run diffs) match a serial run. """
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        for i in range(20):
+            twd.write_file(f"etc/apps/Splunk_TA_aws/default.d/10-upstream/lookups/lookup{i}.csv",
+                           f"a,b\n{i},{i}\n")
+        src = twd.get_path("etc/apps/Splunk_TA_aws")
+
+        def combine(target, jobs, *args):
+            with ksconf_cli:
+                ko = ksconf_cli("combine", "--layer-method", "dir.d", "--jobs", jobs,
+                                "--target", twd.get_path(target), src, *args)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            return ko
+
+        def read_tree(target):
+            root = twd.get_path(target)
+            return {os.path.relpath(os.path.join(dirpath, fn), root):
+                    open(os.path.join(dirpath, fn)).read()
+                    for dirpath, _, files in os.walk(root) for fn in files
+                    if not fn.startswith(".ksconf")}
+
+        ko1 = combine("serial", "1", "--disable-state")
+        ko3 = combine("parallel", "3", "--disable-state")
+        self.assertEqual(read_tree("serial"), read_tree("parallel"))
+        self.assertEqual(ko1.stderr.replace("serial", "parallel"), ko3.stderr)
+
+        twd.write_file("etc/apps/Splunk_TA_aws/default.d/60-dept/props.conf", """
+        [aws:config]
+        TZ = UTC
+        """)
+        twd.write_file("etc/apps/Splunk_TA_aws/default.d/60-dept/lookups/lookup3.csv", "a,b\n3,4\n")
+        ko1 = combine("serial", "1", "--dry-run")
+        ko3 = combine("parallel", "3", "--dry-run")
+        self.assertIn("TZ", ko1.stdout)
+        self.assertIn("lookup3.csv", ko1.stdout)
+        self.assertEqual(ko1.stdout.replace("serial", "parallel"), ko3.stdout)
+
+    def test_combine_parallel_subclass(self):
+        """ Parallel combine uses the subclass's combine_file() and settings. """
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        for jobs in (1, 3):
+            combiner = _TaggingCombiner(jobs=jobs)
+            combiner.set_layer_root(twd.get_path("etc/apps/Splunk_TA_aws"))
+            combiner.tag = "custom"
+            target = twd.get_path(f"output{jobs}")
+            combiner.combine(target)
+            self.assertTrue(twd.read_file(f"output{jobs}/default/props.conf").endswith("# custom\n"))
+            self.assertEqual(combiner.copied, ["default.xml"])
+
+    def test_combine_link_mode(self):
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        src = twd.get_path("etc/apps/Splunk_TA_aws")
+        target = twd.get_path("etc/apps/Splunk_TA_aws-OUTPUT")
+        nav = os.path.join(target, "default", "data", "ui", "nav", "default.xml")
+        nav_src = os.path.join(src, "default.d", "60-dept", "data", "ui", "nav", "default.xml")
+        props = os.path.join(target, "default", "props.conf")
+
+        def combine(link_mode):
+            with ksconf_cli:
+                ko = ksconf_cli("combine", "--layer-method", "dir.d", "--link-mode", link_mode,
+                                "--target", target, src)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+
+        combine("hardlink")
+        self.assertTrue(os.path.samefile(nav, nav_src))
+        # Merged files are always written
+        self.assertEqual(os.stat(props).st_nlink, 1)
+
+        combine("symlink")
+        self.assertTrue(os.path.islink(nav))
+        self.assertFalse(os.path.islink(props))
+
+        combine("copy")
+        self.assertFalse(os.path.islink(nav))
+        self.assertFalse(os.path.samefile(nav, nav_src))
+
+    def test_combine_link_mode_new_layer(self):
+        """ Handlers never write through links left by a previous run. """
+        for link_mode in ("copy", "hardlink", "reflink", "symlink"):
+            twd = TestWorkDir()
+            twd.write_file("app/default.d/10-upstream/props.conf", "[x]\na = 1\n")
+            twd.write_file("app/README.d/10-upstream/inputs.conf.spec", "a = <x>\n")
+            src = twd.get_path("app")
+            target = twd.get_path("app-OUTPUT")
+
+            def combine():
+                with ksconf_cli:
+                    ko = ksconf_cli("combine", "--layer-method", "dir.d", "--link-mode", link_mode,
+                                    "--target", target, src)
+                    self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+
+            combine()
+            twd.write_file("app/default.d/20-custom/props.conf", "[x]\nb = 2\n")
+            twd.write_file("app/README.d/20-custom/inputs.conf.spec", "b = <y>\n")
+            combine()
+            # Sources are unchanged
+            self.assertEqual(twd.read_file("app/default.d/10-upstream/props.conf"), "[x]\na = 1\n")
+            self.assertEqual(twd.read_file("app/README.d/10-upstream/inputs.conf.spec"), "a = <x>\n")
+            self.assertEqual(twd.read_file("app-OUTPUT/README/inputs.conf.spec"),
+                             "a = <x>\nb = <y>\n")
+            self.assertEqual(parse_conf(twd.get_path("app-OUTPUT/default/props.conf"))["x"],
+                             {"a": "1", "b": "2"})
+
+    def test_combine_target_spec(self):
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        src = twd.get_path("etc/apps/Splunk_TA_aws")
+        twd.write_file("build/targets.json", """
+        {"targets": [
+            {"target": "all"},
+            {"target": "no-corp", "exclude": ["20-corp"]},
+            {"target": "upstream", "include": ["10-*"]}
+        ]}
+        """)
+        with ksconf_cli, mock.patch("ksconf.combine.merge_conf_dicts",
+                                    side_effect=merge_conf_dicts) as merge:
+            ko = ksconf_cli("combine", "--layer-method", "dir.d", "--target-spec",
+                            twd.get_path("build/targets.json"), "--exclude", "60-dept", src)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            # props.conf (all) and alert_actions.conf (none) are merged only once
+            self.assertEqual(merge.call_count, 1)
+
+        def props(target):
+            return parse_conf(twd.get_path(f"build/{target}/default/props.conf"))["aws:config"]
+
+        self.assertEqual(props("all")["TZ"], "UTC")
+        self.assertEqual(props("all")["TRUNCATE"], "8388608")
+        self.assertEqual(props("no-corp")["TZ"], "GMT")
+        self.assertEqual(props("upstream")["TZ"], "GMT")
+        self.assertTrue(os.path.isfile(twd.get_path("build/all/.ksconf_controlled")))
+
+        # Targets match an individual run
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--layer-method", "dir.d", "--target", twd.get_path("single"),
+                            "--exclude", "60-dept", "--exclude", "20-corp", src)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+        self.assertEqual(twd.read_file("single/default/props.conf"),
+                         twd.read_file("build/no-corp/default/props.conf"))
+
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--target-spec", twd.get_path("missing.json"), src)
+            self.assertEqual(ko.returncode, EXIT_CODE_BAD_ARGS)
+
+    def test_combine_targets_parallel(self):
+        """ Merges done by worker processes are shared with later targets. """
+        twd = TestWorkDir()
+        self.build_test01(twd)
+        targets = [(twd.get_path(name), LayerFilter()) for name in ("t1", "t2")]
+        combiner = LayerCombiner(jobs=2)
+        combiner.set_layer_root(twd.get_path("etc/apps/Splunk_TA_aws"))
+        with mock.patch("ksconf.combine.MergeCache.merge", autospec=True,
+                        side_effect=MergeCache.merge) as merge:
+            combiner.combine_targets(targets)
+        # The first target is merged by workers;  the second is written from the shared merges
+        self.assertEqual(merge.call_count, 2)
+        for fn in ("default/props.conf", "default/alert_actions.conf"):
+            self.assertEqual(twd.read_file(f"t1/{fn}"), twd.read_file(f"t2/{fn}"))
+
     def test_keep_existing_ds_local_app(self):
         twd = TestWorkDir()
         src = twd.get_path("repo/apps/Splunk_TA_nix")
@@ -5,13 +5,14 @@ import json
 import os
 import re
 import sys
+import tarfile
 import unittest
 
 # Allow interactive execution from CLI,  cd tests; ./test_cli.py
 if __package__ is None:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from ksconf.consts import EXIT_CODE_DIFF_CHANGE, EXIT_CODE_DIFF_EQUAL
+from ksconf.consts import EXIT_CODE_BAD_ARGS, EXIT_CODE_DIFF_CHANGE, EXIT_CODE_DIFF_EQUAL
 from tests.cli_helper import TestWorkDir, ksconf_cli, static_data
 
 
@@ -198,6 +199,66 @@ class CliDiffTest(unittest.TestCase):
             for line in expect_lines:
                 self.assertIn(line, diff_lines)
 
+    def make_app_tree(self, twd, name, props_value, extra_file=None):
+        twd.write_file(f"{name}/default/app.conf", """
+        [launcher]
+        version = 1.0
+        """)
+        # Same settings, different order:  Not reported
+        twd.write_file(f"{name}/default/inputs.conf", """
+        [monitor:///var/log/messages]
+        {}
+        """.format("index = os\n        disabled = 0" if name == "app1" else
+                   "disabled = 0\n        index = os"))
+        twd.write_file(f"{name}/default/props.conf", f"""
+        [syslog]
+        TRUNCATE = {props_value}
+        """)
+        twd.write_file(f"{name}/README.txt", f"{name} readme")
+        if extra_file:
+            twd.write_file(f"{name}/{extra_file}", "extra")
+        return twd.get_path(name)
+
+    def test_diff_directories(self):
+        twd = TestWorkDir()
+        app1 = self.make_app_tree(twd, "app1", "1000")
+        app2 = self.make_app_tree(twd, "app2", "2000", extra_file="default/transforms.conf")
+        for jobs in ("1", "2"):
+            with ksconf_cli:
+                ko = ksconf_cli("diff", "--jobs", jobs, app1, app2)
+                self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+                self.assertRegex(ko.stdout, r"[\r\n]-TRUNCATE = 1000")
+                self.assertRegex(ko.stdout, r"[\r\n]\+TRUNCATE = 2000")
+                self.assertRegex(ko.stdout, r"app1/README.txt and \S+app2/README.txt differ")
+                self.assertRegex(ko.stdout, r"Only in \S+app2: default/transforms.conf")
+                self.assertNotIn("inputs.conf", ko.stdout)
+                self.assertIn("Compared 5 files:  2 same, 2 changed, 0 only in", ko.stderr)
+
+        with ksconf_cli:
+            ko = ksconf_cli("diff", app1, app1)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_EQUAL)
+            self.assertEqual(ko.stdout, "")
+
+        with ksconf_cli:
+            ko = ksconf_cli("diff", app1, twd.get_path("app2/default/props.conf"))
+            self.assertEqual(ko.returncode, EXIT_CODE_BAD_ARGS)
+
+    def test_diff_archives(self):
+        twd = TestWorkDir()
+        archives = []
+        for name, value in [("app1", "1000"), ("app2", "2000")]:
+            path = self.make_app_tree(twd, name, value)
+            archive = twd.get_path(f"{name}.spl")
+            with tarfile.open(archive, "w:gz") as tar:
+                tar.add(path, arcname="my_app")
+            archives.append(archive)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", *archives)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            self.assertRegex(ko.stdout, r"[\r\n]--- \S+app1.spl/default/props.conf")
+            self.assertRegex(ko.stdout, r"[\r\n]\+TRUNCATE = 2000")
+            self.assertNotIn("inputs.conf", ko.stdout)
+
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
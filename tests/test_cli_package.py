@@ -5,12 +5,14 @@ import os
 import sys
 import tarfile
 import unittest
+from unittest import mock
 
 # Allow interactive execution from CLI,  cd tests; ./test_cli.py
 if __package__ is None:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from ksconf.consts import EXIT_CODE_SUCCESS
+from ksconf.package import AppPackager
 from tests.cli_helper import TestWorkDir, ksconf_cli
 
 
@@ -70,6 +72,76 @@ class CliPackageCmdTest(unittest.TestCase):
             self.assertIn("my_app_on_splunkbase/default/app.conf", names)
             self.assertNotIn("my_app_on_splunkbase/local/app.conf", names)
 
+    def test_package_compress_level(self):
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "default")
+        sizes = {}
+        for level in ("0", "9"):
+            with ksconf_cli:
+                ko = ksconf_cli("package", twd.get_path("."),
+                                "-f", twd.get_path(f"my_app_on_splunkbase-{level}.tgz"),
+                                "--layer-method", "disable",
+                                "--app-name", "my_app_on_splunkbase",
+                                "--compress-level", level)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            tarball = twd.get_path(f"my_app_on_splunkbase-{level}.tgz")
+            with tarfile.open(tarball, "r:gz") as tf:
+                self.assertIn("my_app_on_splunkbase/default/app.conf", tf.getnames())
+            sizes[level] = os.stat(tarball).st_size
+        self.assertLess(sizes["9"], sizes["0"])
+
+    def test_package_build_cache(self):
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "my_app/default")
+        release_file = twd.get_path("release_file")
+        outputs = []
+
+        def package(*extra):
+            with ksconf_cli:
+                ko = ksconf_cli("package", twd.get_path("my_app"),
+                                "-f", twd.get_path("my_app_on_splunkbase-{{version}}.tgz"),
+                                "--layer-method", "disable",
+                                "--app-name", "my_app_on_splunkbase",
+                                "--blocklist", "*.bak",
+                                "--release-file", release_file, *extra)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            outputs.append(ko.stderr)
+            return twd.read_file("release_file")
+
+        make_archive = AppPackager.make_archive
+        with mock.patch.dict(os.environ, {"KSCONF_CACHE_DIR": twd.get_path("cache")}), \
+                mock.patch.object(AppPackager, "make_archive", autospec=True,
+                                  side_effect=make_archive) as builds:
+            tarball = package()
+            self.assertTrue(tarball.endswith("my_app_on_splunkbase-0.0.1.tgz"))
+            os.unlink(tarball)
+            # Nothing changed; archive is restored from the cache
+            self.assertEqual(package(), tarball)
+            self.assertEqual(builds.call_count, 1)
+            self.assertIn("Applying blocklist", outputs[0])
+            self.assertNotIn("Applying blocklist", outputs[1])
+            with tarfile.open(tarball, "r:gz") as tf:
+                self.assertIn("my_app_on_splunkbase/default/app.conf", tf.getnames())
+
+            # Changed options or content require a new build
+            self.assertTrue(package("--set-version", "1.0.0").endswith("-1.0.0.tgz"))
+            self.assertEqual(builds.call_count, 2)
+            self.assertTrue(package("--set-version", "1.0.0").endswith("-1.0.0.tgz"))
+            self.assertEqual(builds.call_count, 2)
+            twd.write_file("my_app/default/props.conf", "[mysourcetype]\nSHOULD_LINEMERGE = false\n")
+            package("--set-version", "1.0.0")
+            self.assertEqual(builds.call_count, 3)
+            with tarfile.open(twd.read_file("release_file"), "r:gz") as tf:
+                self.assertIn("my_app_on_splunkbase/default/props.conf", tf.getnames())
+
+            # Same size edit within the same second
+            props = twd.get_path("my_app/default/props.conf")
+            st = os.stat(props)
+            twd.write_file("my_app/default/props.conf", "[mysourcetype]\nSHOULD_LINEMERGE = FALSE\n")
+            os.utime(props, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+            package("--set-version", "1.0.0")
+            self.assertEqual(builds.call_count, 4)
+
     def test_package_simple_local(self):
         twd = TestWorkDir()
         self.build_basic_app_01(twd, "local", metadata="local")
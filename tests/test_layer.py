@@ -11,6 +11,7 @@ import unittest
 from glob import glob
 from os import fspath
 from pathlib import Path, PurePath
+from unittest import mock
 
 # Allow interactive execution from CLI,  cd tests; ./test_layer.py
 if __package__ is None:
@@ -25,7 +26,8 @@ except ImportError:
 
 # Stuff for testing
 from ksconf.layer import (DotDLayerCollection, Layer, LayerFilter,
-                          MultiDirLayerCollection, layer_file_factory)
+                          MultiDirLayerCollection, layer_file_factory,
+                          render_layer_files)
 from tests.cli_helper import TestWorkDir
 
 
@@ -123,6 +125,119 @@ class LayerTemplateTestCase(unittest.TestCase):
             conf = twd.read_conf(f.resource_path)
             self.assertEqual(conf["yoursourcetype"]["TRUNCATE"], "83830")
 
+    @unittest.skipIf(jinja2 is None, "Test requires 'jinja2'")
+    def test_bytecode_cache(self):
+        with TestWorkDir() as twd, layer_file_factory:
+            layer_file_factory.enable("jinja")
+            app_dir = twd.makedir("app01")
+            template = "app01/default.d/10-upstream/props.conf.j2"
+            twd.write_file(template, """\
+                [yoursourcetype]
+                TRUNCATE = {{ max_size }}
+                """)
+            cache_dir = twd.get_path("cache")
+
+            def render(max_size):
+                collection = DotDLayerCollection()
+                collection.set_root(Path(app_dir))
+                collection.context.template_variables = {"max_size": max_size}
+                f, = collection.get_files(PurePath("default/props.conf"))
+                renders.append(f)
+                return f.read_text()
+
+            renders = []
+            with mock.patch.dict(os.environ, {"KSCONF_CACHE_DIR": cache_dir}):
+                self.assertIn("TRUNCATE = 10", render(10))
+                self.assertTrue(os.listdir(os.path.join(cache_dir, "jinja")))
+
+                # The environment is shared by other collections with the same root and variables
+                self.assertIn("TRUNCATE = 10", render(10))
+                self.assertIs(renders[0].jinja2_env, renders[1].jinja2_env)
+
+                # New environment, but the compiled template is reused from disk
+                with mock.patch.object(jinja2.Environment, "compile",
+                                       side_effect=jinja2.Environment.compile,
+                                       autospec=True) as compile:
+                    self.assertIn("TRUNCATE = 20", render(20))
+                    compile.assert_not_called()
+
+                # Changes to the template are picked up within the same process
+                twd.write_file(template, """\
+                    [yoursourcetype]
+                    TRUNCATE = {{ max_size * 2 }}
+                    """)
+                st = os.stat(twd.get_path(template))
+                os.utime(twd.get_path(template), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+                self.assertIn("TRUNCATE = 20", render(10))
+                self.assertIs(renders[-1].jinja2_env, renders[0].jinja2_env)
+
+    @unittest.skipIf(jinja2 is None, "Test requires 'jinja2'")
+    def test_dependency_signature(self):
+        from ksconf.layer import LayerFile_Jinja2
+        with TestWorkDir() as twd, layer_file_factory:
+            layer_file_factory.enable("jinja")
+            app_dir = twd.makedir("app01")
+            twd.write_file("app01/default.d/10-upstream/props.conf.j2", """\
+                {% import "macros.j2" as m %}
+                [yoursourcetype]
+                TRUNCATE = {{ m.size(max_size) }}
+                """)
+            twd.write_file("app01/default.d/10-upstream/dynamic.conf.j2", """\
+                {% include template_name %}
+                """)
+            twd.write_file("app01/macros.j2", """\
+                {% macro size(x) %}{{ x * 2 }}{% endmacro %}
+                """)
+
+            def signature(path, **template_variables):
+                collection = DotDLayerCollection()
+                collection.set_root(Path(app_dir))
+                collection.context.template_variables = template_variables
+                f, = collection.get_files(PurePath(path))
+                return f.calculate_signature()
+
+            with mock.patch.object(LayerFile_Jinja2, "render", side_effect=AssertionError):
+                sig = signature("default/props.conf", max_size=10)
+                self.assertIn("deps_hash", sig)
+                # Unreferenced variables have no impact
+                self.assertEqual(signature("default/props.conf", max_size=10, other=1), sig)
+                self.assertNotEqual(signature("default/props.conf", max_size=11), sig)
+                # Changes to an imported template are detected
+                twd.write_file("app01/macros.j2", """\
+                    {% macro size(x) %}{{ x * 3 }}{% endmacro %}
+                    """)
+                self.assertNotEqual(signature("default/props.conf", max_size=10), sig)
+
+            # Dynamic includes can only be handled by rendering
+            sig = signature("default/dynamic.conf", template_name="macros.j2")
+            self.assertIn("hash", sig)
+
+    @unittest.skipIf(jinja2 is None, "Test requires 'jinja2'")
+    def test_render_layer_files(self):
+        with TestWorkDir() as twd, layer_file_factory:
+            layer_file_factory.enable("jinja")
+            app_dir = twd.makedir("app01")
+            for i in range(4):
+                twd.write_file(f"app01/default.d/{i + 10}-layer/file{i}.txt.j2", f"{i} {{{{ x }}}}")
+            collection = DotDLayerCollection()
+            collection.set_root(Path(app_dir))
+            collection.context.template_variables = {"x": "X"}
+            files = [f for p in sorted(collection.list_logical_files())
+                     for f in collection.get_files(p)]
+            render_layer_files(files, jobs=2)
+            self.assertListEqual([f.read_text() for f in files], ["0 X", "1 X", "2 X", "3 X"])
+
+            # First failure (in order) is reported, regardless of completion order
+            twd.write_file("app01/default.d/11-layer/file1.txt.j2", "{{ missing1 }}")
+            twd.write_file("app01/default.d/13-layer/file3.txt.j2", "{{ missing3 }}")
+            collection = DotDLayerCollection()
+            collection.set_root(Path(app_dir))
+            collection.context.template_variables = {"x": "X"}
+            files = [f for p in sorted(collection.list_logical_files())
+                     for f in collection.get_files(p)]
+            with self.assertRaisesRegex(jinja2.UndefinedError, "missing1"):
+                render_layer_files(files, jobs=2)
+
 
 class DotDLayerTestCase(unittest.TestCase):
 
@@ -191,6 +306,104 @@ class DotDLayerTestCase(unittest.TestCase):
             self.assertEqual(collection.list_all_layer_names(),
                              ["10-upstream", "20-common", "75-custom-magic", "88-single-file"])
 
+    def test_logical_path_index(self):
+        with TestWorkDir() as twd, layer_file_factory:
+            app_dir = twd.makedir("app01")
+            twd.write_file("app01/default.d/10-upstream/props.conf", "[a]\nx = 1\n")
+            twd.write_file("app01/default.d/20-common/props.conf", "[a]\nx = 2\n")
+            twd.write_file("app01/default.d/20-common/macros.conf", "[m]\ndefinition = 1\n")
+            twd.write_file("app01/default.d/30-site/props.conf", "[a]\nx = 3\n")
+
+            collection = DotDLayerCollection()
+            collection.set_root(Path(app_dir))
+            fn_props = PurePath("default/props.conf")
+            fn_macros = PurePath("default/macros.conf")
+
+            # Files are returned in layer order
+            self.assertListEqual([f.layer.name for f in collection.get_files(fn_props)],
+                                 ["10-upstream", "20-common", "30-site"])
+            self.assertListEqual(collection.get_files(PurePath("default/missing.conf")), [])
+
+            # Index is rebuilt after layers are blocked
+            collection.apply_layer_filter(lambda layer: layer.name != "20-common")
+            self.assertListEqual([f.layer.name for f in collection.get_files(fn_props)],
+                                 ["10-upstream", "30-site"])
+            self.assertNotIn(fn_macros, collection.list_logical_files())
+
+            # Blocking via the collection updates both the layers and the index
+            self.assertTrue(collection.block_file(fn_props))
+            self.assertFalse(collection.block_file(fn_props))
+            self.assertListEqual(collection.get_files(fn_props), [])
+            self.assertNotIn(fn_props, collection.list_logical_files())
+            for layer in collection.list_layers():
+                self.assertIsNone(layer.get_file(fn_props))
+
+    def test_logical_path_index_stat_once(self):
+        with TestWorkDir() as twd, layer_file_factory:
+            app_dir = twd.makedir("app01")
+            twd.write_file("app01/default.d/10-upstream/props.conf", "[a]\nx = 1\n")
+            twd.write_file("app01/default.d/20-common/props.conf", "[a]\nx = 2\n")
+
+            collection = DotDLayerCollection()
+            collection.set_root(Path(app_dir))
+            fn_props = PurePath("default/props.conf")
+            collection.list_logical_files()
+
+            # Lookups are served from the index without touching the filesystem
+            with mock.patch.object(Path, "is_file") as is_file:
+                for _ in range(3):
+                    self.assertEqual(len(collection.get_files(fn_props)), 2)
+            is_file.assert_not_called()
+
+            # Removed files are dropped when the index is rebuilt
+            os.unlink(os.path.join(app_dir, "default.d", "20-common", "props.conf"))
+            collection._index = None
+            self.assertListEqual([f.layer.name for f in collection.get_files(fn_props)],
+                                 ["10-upstream"])
+
+
+class DotDScanIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.twd = TestWorkDir()
+        self.app_dir = Path(self.twd.makedir("app01"))
+        self.twd.write_file("app01/default.d/10-upstream/props.conf", "[a]\nx = 1\n")
+        self.twd.write_file("app01/default.d/20-common/props.conf", "[a]\nx = 2\n")
+        self.twd.write_file("app01/lib/vendor/module/__init__.py", "")
+        env = mock.patch.dict(os.environ, {"KSCONF_CACHE_DIR": self.twd.get_path("cache")})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        self.twd.clean()
+        del self.twd
+
+    def layer_names(self):
+        collection = DotDLayerCollection()
+        collection.set_root(self.app_dir)
+        return collection.list_layer_names()
+
+    def test_cached_rescan(self):
+        expect = ["10-upstream", "20-common"]
+        self.assertListEqual(self.layer_names(), expect)
+        with mock.patch("os.scandir", side_effect=os.scandir) as scandir:
+            self.assertListEqual(self.layer_names(), expect)
+            # Nothing changed; no directory listing is necessary
+            scandir.assert_not_called()
+
+        # New layer, and a new mount point deep within an unchanged directory
+        self.twd.write_file("app01/default.d/30-new/props.conf", "[a]\nx = 3\n")
+        self.twd.write_file("app01/lib/vendor/module/data.d/10-extra/x.txt", "")
+        with mock.patch("os.scandir", side_effect=os.scandir) as scandir:
+            self.assertListEqual(self.layer_names(), ["10-extra", "10-upstream", "20-common", "30-new"])
+            self.assertLess(scandir.call_count, 8)
+
+    def test_same_as_uncached(self):
+        cached = self.layer_names()
+        with mock.patch.dict(os.environ):
+            del os.environ["KSCONF_CACHE_DIR"]
+            self.assertListEqual(self.layer_names(), cached)
+
 
 class MultiDirLayerTestCase(unittest.TestCase):
     """ Test the MultiDirLayerCollection class """
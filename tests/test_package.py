@@ -7,9 +7,13 @@ import tarfile
 import unittest
 from io import StringIO
 from pathlib import Path
+from unittest import mock
 
+import ksconf.package
+from ksconf.app.manifest import AppManifest
 from ksconf.layer import DotDLayerCollection, LayerFilter, MultiDirLayerCollection
-from ksconf.package import AppPackager
+from ksconf.package import AppPackager, AppVarMagic
+from ksconf.vc.git import git_cmd
 
 # Allow interactive execution from CLI,  cd tests; ./test_cli.py
 if __package__ is None:
@@ -201,6 +205,165 @@ class PackageTest(unittest.TestCase):
             self.assertIn("Splunk_TA_aws/default/alert_actions.conf", names)
             self.assertIn("Splunk_TA_aws/default/data/ui/views/my_dept_view.xml", names)
 
+    def test_package_streams_unmodified_files(self):
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "my_app", "default")
+        twd.write_file("my_app/lookups/big.csv", "a,b\n" * 1000)
+        twd.write_file("my_app/bin/run.sh", "#!/bin/sh\n")
+        twd.write_file("my_app/bin/junk.pyc", "")
+        twd.write_file("my_app/local/data/ui/views/local_view.xml", "<dashboard/>")
+        os.chmod(twd.get_path("my_app/bin/run.sh"), 0o755)
+        log_out = StringIO()
+
+        with AppPackager(twd.get_path("my_app"), "my_app_on_splunkbase", log_out) as packager:
+            packager.combine(twd.get_path("my_app"), [], layer_method="disable")
+            # Files copied as-is are not written to the build directory
+            self.assertFalse(os.path.exists(os.path.join(packager.app_dir, "lookups", "big.csv")))
+            packager.merge_local()
+            packager.blocklist(["*.pyc"])
+            packager.check()
+            manifest = packager.make_manifest()
+            tarball = packager.make_archive(twd.get_path("my_app_on_splunkbase.tgz"))
+
+        self.assertIn("Blocked file:", log_out.getvalue())
+        with tarfile.open(tarball, "r:gz") as tf:
+            names = tf.getnames()
+            self.assertNotIn("my_app_on_splunkbase/bin/junk.pyc", names)
+            self.assertIn("my_app_on_splunkbase/default/data/ui/views/local_view.xml", names)
+            self.assertEqual(names, sorted(names, key=lambda n: n.split("/")))
+            csv = tf.getmember("my_app_on_splunkbase/lookups/big.csv")
+            self.assertAlmostEqual(csv.mtime, os.stat(twd.get_path("my_app/lookups/big.csv")).st_mtime)
+            self.assertEqual(tf.extractfile(csv).read(), b"a,b\n" * 1000)
+            self.assertEqual(tf.getmember("my_app_on_splunkbase/bin/run.sh").mode, 0o755)
+        self.assertEqual(manifest, AppManifest.from_archive(Path(tarball)))
+
+    def test_package_manifest_from_archive(self):
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "my_app", "default")
+        twd.write_file("my_app/lookups/big.csv", "a,b\n" * 1000)
+        twd.write_file("my_app/local/app.conf", "[ui]\nlabel = Local\n")
+
+        with AppPackager(twd.get_path("my_app"), "my_app", StringIO()) as packager:
+            packager.combine(twd.get_path("my_app"), [], layer_method="disable")
+            packager.merge_local()
+            tarball = packager.make_archive(twd.get_path("my_app.tgz"))
+            # The manifest is collected while writing the archive; files are not read again
+            with mock.patch.object(AppManifest, "from_filesystem") as from_filesystem:
+                manifest = packager.make_manifest()
+            from_filesystem.assert_not_called()
+
+        self.assertEqual(manifest, AppManifest.from_archive(Path(tarball)))
+        self.assertIn(Path("lookups/big.csv"), [f.path for f in manifest.files])
+
+    def test_package_blocklist_at_combine(self):
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "my_app", "default")
+        twd.write_file("my_app/bin/lib/util.py", "")
+        twd.write_file("my_app/bin/lib/util.pyc", "")
+        twd.write_file("my_app/bin/__pycache__/util.cpython-311.pyc", "")
+        twd.write_file("my_app/bin/__pycache__/notes.txt", "")
+        twd.write_file("my_app/default/.gitignore", "*.pyc")
+        twd.write_file("my_app/default/data/ui/views/.DS_Store", "")
+        log_out = StringIO()
+
+        with AppPackager(twd.get_path("my_app"), "my_app", log_out) as packager:
+            packager.combine(twd.get_path("my_app"), [], layer_method="disable",
+                             blocklist=[".git*", "*.py[co]", "__pycache__", ".DS_Store",
+                                        "default/data/ui/views/mrs_dash.xml"])
+            # Blocked files never make it into the build
+            self.assertEqual(sorted(p.as_posix() for p in packager._references),
+                             ["bin/lib/util.py"])
+            manifest = packager.make_manifest()
+
+        # Referenced (unmodified) files are listed in order with files from the build directory
+        self.assertEqual([f.path.as_posix() for f in manifest.files],
+                         ["bin/lib/util.py", "default/app.conf", "default/savedsearches.conf"])
+        log = log_out.getvalue()
+        self.assertIn("Blocked dir:  bin/__pycache__  (pattern: __pycache__)", log)
+        self.assertIn("Blocked file: bin/lib/util.pyc  (pattern: *.py[co])", log)
+        self.assertIn("Blocked file: default/.gitignore  (pattern: .git*)", log)
+        self.assertNotIn("notes.txt", log)
+
+    def test_package_blocklist_app_root(self):
+        """ Patterns starting with '*/' also match at the top level of the app. """
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "my_app", "default")
+        twd.write_file("my_app/tests/test_x.py", "")
+        twd.write_file("my_app/docs/index.md", "")
+        twd.write_file("my_app/bin/tests/test_y.py", "")
+        twd.write_file("my_app/bin/mydocs/notes.md", "")
+        twd.write_file("my_app/bin/my.gitkeep", "")
+        patterns = ["*/tests/*", "*/docs", ".git*"]
+        expected = ["bin/my.gitkeep", "bin/mydocs/notes.md",
+                    "default/app.conf", "default/data/ui/views/mrs_dash.xml",
+                    "default/savedsearches.conf"]
+
+        with AppPackager(twd.get_path("my_app"), "my_app", StringIO()) as packager:
+            packager.combine(twd.get_path("my_app"), [], layer_method="disable",
+                             blocklist=patterns)
+            manifest = packager.make_manifest()
+        self.assertEqual([f.path.as_posix() for f in manifest.files], expected)
+
+        with AppPackager(twd.get_path("my_app"), "my_app", StringIO()) as packager:
+            packager.combine(twd.get_path("my_app"), [], layer_method="disable")
+            packager.blocklist(patterns)
+            manifest = packager.make_manifest()
+        self.assertEqual([f.path.as_posix() for f in manifest.files], expected)
+
+    def test_var_magic_app_conf_cache(self):
+        twd = TestWorkDir()
+        self.build_basic_app_01(twd, "my_app_on_splunkbase", "default")
+        with AppPackager(twd.get_path("my_app_on_splunkbase"), "my_app_on_splunkbase",
+                         StringIO()) as packager:
+            packager.combine(twd.get_path("my_app_on_splunkbase"), [], layer_method="disable")
+            with mock.patch("ksconf.package.get_merged_conf_view",
+                            wraps=ksconf.package.get_merged_conf_view) as get_conf:
+                self.assertEqual(packager.expand_var("{{app_id}}-{{version}}"),
+                                 "my_app_on_splunkbase-0.0.1")
+                self.assertEqual(packager.expand_var("{{version}}"), "0.0.1")
+                self.assertEqual(get_conf.call_count, 1)
+                # Changes to app.conf are picked up
+                packager.update_app_conf(version="1.0.0", build="7")
+                self.assertEqual(packager.expand_var("{{version}}.{{build}}"), "1.0.0.7")
+                self.assertEqual(get_conf.call_count, 2)
+
+    def test_var_magic_git_describe(self):
+        env = {"GIT_AUTHOR_NAME": "Ksconf Unit Tests", "GIT_COMMITTER_NAME": "Ksconf Unit Tests",
+               "GIT_AUTHOR_EMAIL": "automated-tests@bogus.kintyre.co",
+               "GIT_COMMITTER_EMAIL": "automated-tests@bogus.kintyre.co"}
+        twd = TestWorkDir(git_repo=True)
+        self.build_basic_app_01(twd, "app_a", "default")
+        self.build_basic_app_01(twd, "app_b", "default")
+
+        def head():
+            return git_cmd(["rev-parse", "--short", "HEAD"], cwd=twd.get_path(".")).stdout.strip()
+
+        def describe(app, magic=None):
+            magic = magic or AppVarMagic(twd.get_path(app), twd.get_path("build"))
+            return magic["git_tag"], magic["git_head"]
+
+        with mock.patch.dict(os.environ, env):
+            twd.git("add", ".")
+            twd.git("commit", "-m", "Initial apps")
+            self.assertEqual(describe("app_a"), (head(), head()))
+            twd.git("tag", "v1.2")
+            twd.git("commit", "--allow-empty", "-m", "Tagged")
+            twd.git("tag", "v1.3")
+            magic = AppVarMagic(twd.get_path("app_a"), twd.get_path("build"))
+            with mock.patch("ksconf.package.git_cmd", wraps=git_cmd) as git:
+                self.assertEqual(describe("app_a", magic), ("1.3", head()))
+                # Both variables come from a single git call, which is kept for the session
+                magic.invalidate()
+                self.assertEqual(describe("app_a", magic), ("1.3", head()))
+                self.assertEqual(git.call_count, 1)
+            # Each session sees the current state of the repository
+            twd.git("commit", "--allow-empty", "-m", "After tag")
+            self.assertEqual(describe("app_b"), (f"1.3-1-g{head()}", head()))
+            twd.git("tag", "ns/1.4")
+            self.assertEqual(describe("app_b"), ("ns/1.4", head()))
+            twd.write_file("app_a/default/savedsearches.conf", "[changed]\n")
+            self.assertEqual(describe("app_a"), ("ns/1.4-dirty", head()))
+
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
@@ -5,30 +5,43 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import gc
 import os
+import pickle
 import sys
 import time
 import unittest
+import warnings
+import weakref
 from collections import OrderedDict
 from copy import deepcopy
 from functools import partial
 from io import StringIO
+from unittest import mock
 
 # Allow interactive execution from CLI,  cd tests; ./test_cli.py
 if __package__ is None:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from ksconf.command import ConfFileType
+from ksconf.conf.cache import ParseCache, get_parse_cache
+from ksconf.conf.compact import CompactStanza
 from ksconf.conf.delta import (DIFF_OP_DELETE, DIFF_OP_EQUAL, DIFF_OP_INSERT,
                                DIFF_OP_REPLACE, DiffLevel, compare_cfgs,
-                               reduce_stanza, show_diff, summarize_cfg_diffs)
+                               conf_digests, reduce_stanza, show_diff,
+                               stanza_digest, summarize_cfg_diffs)
+from ksconf.conf.lazy import LazyConf
+from ksconf.conf.merge import MergedConfView, merge_conf_dicts
 from ksconf.conf.parser import (DUP_EXCEPTION, DUP_MERGE, DUP_OVERWRITE,
-                                GLOBAL_STANZA, PARSECONF_MID,
-                                ConfParserException, DuplicateKeyException,
-                                DuplicateStanzaException,
+                                GLOBAL_STANZA, PARSECONF_LOOSE, PARSECONF_MID,
+                                PARSECONF_MID_NC, PARSECONF_STRICT,
+                                PARSECONF_STRICT_NC, ConfParserException,
+                                DuplicateKeyException, DuplicateStanzaException,
                                 inject_section_comments, parse_conf,
-                                section_reader, write_conf, write_conf_stream,
-                                write_conf_string)
-from tests.cli_helper import TestWorkDir, parse_string
+                                parse_conf_stream, section_reader, write_conf,
+                                write_conf_stream, write_conf_string)
+from tests.benchmark_parser import parse_conf_stream_legacy
+from tests.cli_helper import TestWorkDir, parse_string, static_data
 
 
 class ParserTestCase(unittest.TestCase):
@@ -331,6 +344,42 @@ class ParserTestCase(unittest.TestCase):
         self.assertEqual(len(c), 1, "Should only have 1 stanza")
         self.assertEqual(len(c["Knowledge Object backup to CSV"]["search"].splitlines()), 7)
 
+    def test_tokenizer_matches_legacy(self):
+        """ Single-pass tokenizer must produce the same output as the generator pipeline """
+        samples = [
+            static_data("inputs-ta-nix-default.conf"),
+            static_data("savedsearches-sysdefault70.conf"),
+        ]
+        for path in samples:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            for profile in (PARSECONF_MID, PARSECONF_MID_NC, PARSECONF_LOOSE):
+                expect = parse_conf_stream_legacy(StringIO(text), **profile)
+                # Both file-like and line iterable streams are supported
+                self.assertEqual(parse_conf_stream(StringIO(text), **profile), expect)
+                self.assertEqual(parse_conf_stream(text.splitlines(True), **profile), expect)
+
+    def test_tokenizer_edge_cases(self):
+        t = "\n".join([
+            "; global comment",
+            "a = 1",
+            "[]",
+            "[s1]",
+            "k = v\\",
+            "",
+            "\\",
+            "[s2]",
+            "  x  =  y  ",
+            "ends = \\"])
+        for profile in (PARSECONF_MID, PARSECONF_LOOSE, PARSECONF_STRICT):
+            self.assertEqual(parse_conf_stream(StringIO(t), **profile),
+                             parse_conf_stream_legacy(StringIO(t), **profile))
+        c = parse_conf_stream(StringIO(t), **PARSECONF_MID)
+        self.assertEqual(c[""], {})
+        self.assertEqual(c["s1"]["k"], "v")
+        self.assertEqual(c["s2"]["  x"], "y  ")
+        self.assertEqual(c["s2"]["ends"], "")
+
     def test_splksysdfltjunk(self):
         # This is copied from Splunk's system/default/props.conf file.  (We are CERTAINLY more
         # picky than splunk when it comes to parsing these files.
@@ -458,6 +507,32 @@ class ConfigDiffTestCase(unittest.TestCase):
                 if match:
                     return op
 
+    def test_stanza_digest(self):
+        self.assertEqual(stanza_digest({"a": "1", "b": "2"}), stanza_digest({"b": "2", "a": "1"}))
+        self.assertNotEqual(stanza_digest({"a": "1"}), stanza_digest({"a": "1 "}))
+        self.assertNotEqual(stanza_digest({"a": "1", "b": "2"}), stanza_digest({"a": "1=b 2"}))
+
+    def test_compare_with_digests(self):
+        c1 = parse_string(self.cfg_props_imapsync_1)
+        c2 = parse_string(self.cfg_props_imapsync_2)
+        c2["other1"] = {}
+        for level in ("global", "stanza", "key"):
+            expect = compare_cfgs(c1, c2, replace_level=level)
+            diffs = compare_cfgs(c1, c2, replace_level=level,
+                                 a_digests=conf_digests(c1), b_digests=conf_digests(c2))
+            self.assertEqual(diffs, expect)
+            self.assertEqual(compare_cfgs(c1, deepcopy(c1), replace_level=level,
+                                          a_digests=conf_digests(c1), b_digests=conf_digests(c1)),
+                             compare_cfgs(c1, deepcopy(c1), replace_level=level))
+
+        # Content is trusted to match the digests
+        fake = conf_digests(c1)
+        fake["imapsync"] = conf_digests(c2)["imapsync"]
+        diffs = compare_cfgs(c1, c2, replace_level="stanza",
+                             a_digests=fake, b_digests=conf_digests(c2))
+        op = self.find_op_by_location(diffs, "stanza", stanza="imapsync")
+        self.assertEqual(op.tag, DIFF_OP_EQUAL)
+
     def test_compare_keys_props(self):
         c1 = parse_string(self.cfg_props_imapsync_1)
         c2 = parse_string(self.cfg_props_imapsync_2)
@@ -607,5 +682,376 @@ class ConfigDiffTestCase(unittest.TestCase):
         self.assertEqual(reduce_stanza(start, ["x"]), {})
 
 
+class ParseCacheTestCase(unittest.TestCase):
+
+    conf_text = "global = 1\n[stanza1]\nkey1 = value1\n\n[stanza2]\n# comment\nkey2 = value2\n"
+
+    def setUp(self):
+        self.twd = TestWorkDir()
+        self.cache_root = self.twd.get_path("cache")
+        self.conf = self.twd.write_file("input.conf", self.conf_text)
+        env = mock.patch.dict(os.environ, {"KSCONF_CACHE_DIR": self.cache_root})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        self.twd.clean()
+        del self.twd
+
+    def test_disabled_by_default(self):
+        with mock.patch.dict(os.environ):
+            del os.environ["KSCONF_CACHE_DIR"]
+            self.assertIsNone(get_parse_cache())
+
+    def test_cache_setup_errors(self):
+        blocker = self.twd.write_file("not_a_dir", "")
+        for env in ({"KSCONF_CACHE_DIR": self.twd.get_path("cache2"), "KSCONF_PARSE_CACHE_MB": "abc"},
+                    {"KSCONF_CACHE_DIR": os.path.join(blocker, "cache")}):
+            with mock.patch.dict(os.environ, env):
+                with self.assertWarns(RuntimeWarning):
+                    self.assertIsNone(get_parse_cache())
+                # Parsing works without the cache, and the warning isn't repeated
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    self.assertEqual(parse_conf(self.conf)["stanza1"], {"key1": "value1"})
+                self.assertEqual(caught, [])
+
+    def test_cache_hit(self):
+        cache = get_parse_cache()
+        self.assertIsInstance(cache, ParseCache)
+        c1 = parse_conf(self.conf)
+        c2 = parse_conf(self.conf)
+        self.assertEqual(c1, c2)
+        self.assertEqual(cache.hits, 1)
+        self.assertIn(GLOBAL_STANZA, c2)
+        # Callers are free to modify the returned data
+        self.assertIsNot(c1["stanza1"], c2["stanza1"])
+
+    def test_profile_in_key(self):
+        cache = get_parse_cache()
+        c1 = parse_conf(self.conf, profile=PARSECONF_MID)
+        c2 = parse_conf(self.conf, profile=PARSECONF_STRICT_NC)
+        self.assertEqual(cache.hits, 0)
+        self.assertIn("#-000001", c1["stanza2"])
+        self.assertNotIn("#-000001", c2["stanza2"])
+
+    def test_file_change_invalidates(self):
+        parse_conf(self.conf)
+        self.twd.write_file("input.conf", self.conf_text + "key3 = value3\n")
+        c = parse_conf(self.conf)
+        self.assertEqual(c["stanza2"]["key3"], "value3")
+
+    def test_corrupt_entry_is_miss(self):
+        cache = get_parse_cache()
+        parse_conf(self.conf)
+        for entry in cache.cache_dir.glob("*/*.bin"):
+            entry.write_bytes(b"junk")
+        c = parse_conf(self.conf)
+        self.assertEqual(c["stanza1"]["key1"], "value1")
+        self.assertEqual(cache.hits, 0)
+
+    def test_parse_errors_not_cached(self):
+        cache = get_parse_cache()
+        bad = self.twd.write_file("bad.conf", "[stanza\nkey = value\n")
+        for _ in range(2):
+            with self.assertRaises(ConfParserException):
+                parse_conf(bad)
+        self.assertEqual(list(cache.cache_dir.glob("*/*.bin")), [])
+
+    def test_digests(self):
+        cache = get_parse_cache()
+        d1 = cache.digests(self.conf, PARSECONF_MID, None, parse_conf)
+        self.assertEqual(d1, conf_digests(parse_conf(self.conf)))
+        hits = cache.hits
+        d2 = cache.digests(self.conf, PARSECONF_MID, None, parse_conf)
+        self.assertEqual(d1, d2)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertIn(GLOBAL_STANZA, d2)
+
+    def test_cli_file_uses_cache(self):
+        cache = get_parse_cache()
+        parse_conf(self.conf)
+        # Files given on the command line are already open
+        cfp = ConfFileType("r", "open", parse_profile=PARSECONF_MID)(self.conf)
+        try:
+            self.assertEqual(cfp.data["stanza1"], {"key1": "value1"})
+            self.assertEqual(cache.hits, 1)
+        finally:
+            cfp.close()
+
+    def test_digests_from_loaded_data(self):
+        cache = get_parse_cache()
+        cfp = ConfFileType("r", "open", parse_profile=PARSECONF_MID)(self.conf)
+        try:
+            with mock.patch("ksconf.conf.parser.parse_conf_stream",
+                            wraps=parse_conf_stream) as parse:
+                data = cfp.data
+                digests = cfp.digests
+            # Digests come from the same parse that loaded the data
+            self.assertEqual(parse.call_count, 1)
+            self.assertEqual(cache.hits, 0)
+            self.assertEqual(digests, conf_digests(data))
+        finally:
+            cfp.close()
+
+    def test_lru_prune(self):
+        cache = ParseCache(self.twd.get_path("cache2"))
+        confs = [self.twd.write_file(f"file{i}.conf", f"[s]\nkey = {i}\n") for i in range(5)]
+        for conf in confs:
+            cache.parse_conf(conf, PARSECONF_MID, None, parse_conf)
+        entries = sorted(cache.cache_dir.glob("*/*.bin"))
+        # Give each entry a distinct last-access time
+        for i, entry in enumerate(entries):
+            os.utime(entry, (1000 + i, 1000 + i))
+        cache.max_size = sum(e.stat().st_size for e in entries[-2:])
+        cache.prune()
+        self.assertEqual(sorted(cache.cache_dir.glob("*/*.bin")), entries[-2:])
+
+
+class LazyConfTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.twd = TestWorkDir()
+
+    def tearDown(self):
+        self.twd.clean()
+        del self.twd
+
+    def assertSameAsParseConf(self, path, profile=PARSECONF_MID):
+        expect = parse_conf(path, profile)
+        with LazyConf(path, profile) as lazy:
+            self.assertEqual(list(lazy), list(expect))
+            self.assertEqual({name: dict(stanza) for name, stanza in lazy.items()}, expect)
+
+    def test_matches_parse_conf(self):
+        for path in (static_data("inputs-ta-nix-default.conf"),
+                     static_data("savedsearches-sysdefault70.conf")):
+            self.assertSameAsParseConf(path)
+
+    def test_continuation_headers(self):
+        """ Stanza-like lines within continued values are not headers """
+        path = self.twd.write_file("savedsearches.conf", r"""
+        # Comment
+        [search1]
+        search = | makeresults \
+        [ search index=main ] \
+        | stats count
+        [search2]
+        a = 1
+        """)
+        self.assertSameAsParseConf(path)
+        self.assertSameAsParseConf(path, PARSECONF_LOOSE)
+        with LazyConf(path) as lazy:
+            self.assertEqual(len(lazy), 3)
+            self.assertIn("[ search index=main ]", lazy["search1"]["search"])
+            self.assertNotIn(" search index=main ", lazy)
+
+    def test_bom_and_crlf(self):
+        path = self.twd.write_file("bom.conf", b"\xef\xbb\xbf[s1]\r\na = 1 \\\r\nb\r\n[s2]\r\n")
+        self.assertSameAsParseConf(path)
+
+    def test_empty_file(self):
+        path = self.twd.write_file("empty.conf", b"")
+        with LazyConf(path) as lazy:
+            self.assertEqual(len(lazy), 0)
+            self.assertNotIn(GLOBAL_STANZA, lazy)
+
+    def test_empty_global_stanza(self):
+        path = self.twd.write_file("blank.conf", "\n\n[s]\na = 1\n")
+        with LazyConf(path) as lazy:
+            # Repeated lookups agree with each other
+            for _ in range(2):
+                with self.assertRaises(KeyError):
+                    lazy[GLOBAL_STANZA]
+            self.assertNotIn(GLOBAL_STANZA, lazy)
+            self.assertIsNone(lazy.get(GLOBAL_STANZA))
+            self.assertEqual(list(lazy.keys()), ["s"])
+
+    def test_read_only(self):
+        path = self.twd.write_file("a.conf", "[s]\na = 1\n")
+        with LazyConf(path) as lazy:
+            with self.assertRaises(TypeError):
+                lazy["s"]["a"] = 2
+
+    def test_errors(self):
+        path = self.twd.write_file("dup.conf", "[s]\na = 1\n[s]\nb = 2\n")
+        with self.assertRaises(DuplicateStanzaException):
+            LazyConf(path)
+        with LazyConf(path, PARSECONF_LOOSE) as lazy:
+            self.assertEqual(dict(lazy["s"]), {"a": "1", "b": "2"})
+
+        path = self.twd.write_file("junk.conf", "[good]\na = 1\n[bad]\njunk\n")
+        with LazyConf(path, PARSECONF_STRICT) as lazy:
+            # Errors are only reported when the stanza is accessed
+            self.assertEqual(lazy["good"]["a"], "1")
+            with self.assertRaises(ConfParserException):
+                lazy["bad"]
+
+
+class MergeConfDictsTestCase(unittest.TestCase):
+
+    def test_inputs_unmodified(self):
+        c1 = parse_string("""
+        [s1]
+        a = 1
+        [s2]
+        b = 2
+        [s3]
+        c = 3
+        """)
+        c2 = parse_string("""
+        [s1]
+        # Comment from c2
+        a = 10
+        [s3]
+        _stanza = <<DROP>>
+        [s4]
+        d = 4
+        """, profile=PARSECONF_MID)
+        before = deepcopy((c1, c2))
+        merged = merge_conf_dicts(c1, c2)
+        self.assertEqual((c1, c2), before)
+        self.assertEqual(merged["s1"], {"#-000001": "# Comment from c2", "a": "10"})
+        self.assertNotIn("s3", merged)
+        # Unmodified stanzas are shared, not copied
+        self.assertIs(merged["s2"], c1["s2"])
+        self.assertIs(merged["s4"], c2["s4"])
+
+    def test_copy_once(self):
+        c1 = parse_string("[s]\na = 1\n")
+        c2 = parse_string("[s]\nb = 2\n")
+        c3 = parse_string("[s]\nc = 3\n")
+        merged = merge_conf_dicts(c1, c2, c3)
+        self.assertEqual(merged["s"], {"a": "1", "b": "2", "c": "3"})
+        self.assertEqual(c1["s"], {"a": "1"})
+        self.assertEqual(c2["s"], {"b": "2"})
+
+    def test_drop_and_readd(self):
+        c1 = parse_string("[s]\na = 1\n")
+        c2 = parse_string("[s]\n_stanza = <<DROP>>\n")
+        c3 = parse_string("[s]\nb = 2\n")
+        c4 = parse_string("[s]\nc = 3\n")
+        merged = merge_conf_dicts(c1, c2, c3, c4)
+        self.assertEqual(merged["s"], {"b": "2", "c": "3"})
+        self.assertEqual(c3["s"], {"b": "2"})
+
+    def test_view_matches_merge(self):
+        c1 = parse_string("""
+        [s1]
+        a = 1
+        [s2]
+        _stanza = <<DROP>>
+        [s3]
+        c = 3
+        """)
+        c2 = parse_string("""
+        [s1]
+        # Comment from c2
+        a = 10
+        [s3]
+        _stanza = <<DROP>>
+        [s4]
+        d = 4
+        """, profile=PARSECONF_MID)
+        c3 = parse_string("[s3]\nc = 30\n[s0]\n")
+        for layers in [(), ({},), (c1,), ({}, c1, c2), (c1, c2, c3), (c3, c2, c1), (c2, {}, c1)]:
+            expect = merge_conf_dicts(*deepcopy(layers))
+            view = MergedConfView(*layers)
+            self.assertEqual(list(view), list(expect))
+            self.assertEqual(len(view), len(expect))
+            self.assertEqual(view.materialize(), expect)
+            self.assertEqual(view, expect)
+
+    def test_view_all_dropped(self):
+        # Documented difference:  merge_conf_dicts() keeps DROP markers from the layer after
+        # everything was dropped, the view does not
+        c1 = {"s1": {"a": "1"}}
+        c2 = {"s1": {"_stanza": "<<DROP>>"}}
+        c3 = {"s2": {"_stanza": "<<DROP>>"}, "s3": {"c": "3"}}
+        self.assertEqual(merge_conf_dicts(c1, c2, c3),
+                         {"s2": {"_stanza": "<<DROP>>"}, "s3": {"c": "3"}})
+        view = MergedConfView(c1, c2, c3)
+        self.assertNotIn("s2", view)
+        self.assertEqual(view.materialize(), {"s3": {"c": "3"}})
+
+    def test_view_lazy(self):
+        c1 = parse_string("[s1]\na = 1\n[s2]\nb = 2\n")
+        c2 = parse_string("[s1]\na = 10\n[s3]\n_stanza = <<DROP>>\n")
+        view = MergedConfView(c1, c2)
+        self.assertEqual(view["s1"]["a"], "10")
+        self.assertIs(view["s1"], view["s1"])
+        self.assertEqual(list(view._cache), ["s1"])
+        self.assertNotIn("s3", view)
+        with self.assertRaises(KeyError):
+            view["s3"]
+        self.assertEqual(c1["s1"], {"a": "1"})
+
+
+class CompactStanzaTestCase(unittest.TestCase):
+
+    compact_mid = dict(PARSECONF_MID, compact=True)
+
+    def test_parse_matches_dict(self):
+        for path in (static_data("inputs-ta-nix-default.conf"),
+                     static_data("savedsearches-sysdefault70.conf")):
+            expect = parse_conf(path)
+            c = parse_conf(path, profile=self.compact_mid)
+            self.assertEqual(list(c), list(expect))
+            self.assertEqual(c, expect)
+            for name, stanza in c.items():
+                self.assertIsInstance(stanza, CompactStanza)
+                self.assertEqual(list(stanza.items()), list(expect[name].items()))
+
+    def test_shared_layout(self):
+        c = parse_string("""
+        [a]
+        disabled = 0
+        interval = 60
+        [b]
+        disabled = 0
+        interval = 60
+        """, profile=self.compact_mid)
+        self.assertIs(c["a"]._layout, c["b"]._layout)
+        self.assertIs(c["a"]["disabled"], c["b"]["disabled"])
+        self.assertIs(list(c["a"])[0], list(c["b"])[0])
+
+    def test_unused_layouts_freed(self):
+        s = CompactStanza({"unique_key_1": "1", "unique_key_2": "2"})
+        layout = weakref.ref(s._layout)
+        self.assertIsNotNone(layout())
+        del s
+        gc.collect()
+        self.assertIsNone(layout())
+        # Shared layouts still work afterwards
+        self.assertIs(CompactStanza({"unique_key_1": "1"})._layout,
+                      CompactStanza({"unique_key_1": "2"})._layout)
+
+    def test_mutation(self):
+        s = CompactStanza({"a": "1", "b": "2", "c": "3"})
+        s["b"] = "two"
+        s["d"] = "4"
+        del s["a"]
+        self.assertEqual(list(s.items()), [("b", "two"), ("c", "3"), ("d", "4")])
+        self.assertEqual(s, {"b": "two", "c": "3", "d": "4"})
+        self.assertNotIn("a", s)
+        with self.assertRaises(KeyError):
+            s["a"]
+        self.assertEqual(s.get("a", "default"), "default")
+
+    def test_copies(self):
+        s = CompactStanza({"a": "1"})
+        for other in (s.copy(), deepcopy(s), pickle.loads(pickle.dumps(s))):
+            self.assertEqual(other, s)
+            other["a"] = "changed"
+            self.assertEqual(s["a"], "1")
+
+    def test_merge_and_write(self):
+        text = "[s]\na = 1\nb = 2\n"
+        c1 = parse_string(text, profile=self.compact_mid)
+        c2 = parse_string("[s]\nb = 3\n", profile=self.compact_mid)
+        self.assertEqual(merge_conf_dicts(c1, c2), {"s": {"a": "1", "b": "3"}})
+        self.assertEqual(write_conf_string(c1), write_conf_string(parse_string(text)))
+
+
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
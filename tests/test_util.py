@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, print_function, unicode_literals
 
+import gzip
+import io
 import os
 import sys
 from pathlib import Path
@@ -10,8 +12,14 @@ if __package__ is None:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import unittest
+from unittest import mock
 
+from ksconf.consts import SMART_CREATE, SMART_NOCHANGE, SMART_UPDATE
 from ksconf.filter import FilteredListSplunkGlob
+from ksconf.util.compress import ParallelGzipWriter
+from ksconf.util.file import (enable_file_hash_memo, file_fast_compare,
+                              file_hash_memo, smart_copy, smart_link)
+from tests.cli_helper import TestWorkDir
 
 
 class KsconfUtilsTest(unittest.TestCase):
@@ -73,6 +81,79 @@ class KsconfUtilsTest(unittest.TestCase):
         self.assertTrue(fl.match("prefix3/b/l/a/h/suffix3"))
         self.assertFalse(fl.match("prefix3/suffix3"))
 
+    def test_smart_link(self):
+        twd = TestWorkDir()
+        src = twd.write_file("src/lookup.csv", "a,b\n1,2\n")
+        dest = twd.get_path("dest.csv")
+
+        self.assertEqual(smart_link(src, dest, "hardlink"), SMART_CREATE)
+        self.assertTrue(os.path.samefile(src, dest))
+        self.assertEqual(smart_link(src, dest, "hardlink"), SMART_NOCHANGE)
+
+        self.assertEqual(smart_link(src, dest, "symlink"), SMART_UPDATE)
+        self.assertEqual(os.readlink(dest), os.path.abspath(src))
+        self.assertEqual(smart_link(src, dest, "symlink"), SMART_NOCHANGE)
+
+        # Switching back to copy mode breaks the link
+        self.assertEqual(smart_link(src, dest, "copy"), SMART_UPDATE)
+        self.assertFalse(os.path.islink(dest))
+        self.assertFalse(os.path.samefile(src, dest))
+        self.assertEqual(smart_link(src, dest, "copy"), SMART_NOCHANGE)
+
+        # Fallback to a regular copy when reflinks are unsupported
+        twd.write_file("src/lookup.csv", "a,b\n1,3\n")
+        with mock.patch("ksconf.util.file._reflink", side_effect=OSError("EOPNOTSUPP")):
+            self.assertEqual(smart_link(src, dest, "reflink"), SMART_UPDATE)
+        self.assertEqual(twd.read_file("dest.csv"), "a,b\n1,3\n")
+
+        with self.assertRaises(ValueError):
+            smart_link(src, dest, "teleport")
+
+    def test_file_fast_compare(self):
+        enable_file_hash_memo(False)
+        self.addCleanup(enable_file_hash_memo, False)
+        twd = TestWorkDir()
+        src = twd.write_file("src.csv", "a,b\n1,2\n")
+        dest = twd.get_path("dest.csv")
+        self.assertEqual(smart_copy(src, dest), SMART_CREATE)
+
+        # Copies preserve mtime, so matching size and mtime means no content is read
+        with mock.patch("ksconf.util.file.file_compare") as compare:
+            self.assertEqual(smart_copy(src, dest), SMART_NOCHANGE)
+            # Different sizes never match
+            twd.write_file("src.csv", "a,b\n1,22\n")
+            self.assertFalse(file_fast_compare(src, dest))
+            compare.assert_not_called()
+
+        # Same size, different mtime:  content is compared
+        twd.write_file("src.csv", "a,b\n1,3\n")
+        os.utime(src, ns=(10 ** 18, 10 ** 18))
+        self.assertFalse(file_fast_compare(src, dest))
+        self.assertEqual(smart_copy(src, dest), SMART_UPDATE)
+        self.assertEqual(twd.read_file("dest.csv"), "a,b\n1,3\n")
+
+        # With the memo enabled, a file's content is only hashed once
+        enable_file_hash_memo()
+        os.utime(dest, ns=(0, 0))
+        with mock.patch("ksconf.util.file.file_hash", return_value="x") as hasher:
+            self.assertTrue(file_fast_compare(src, dest))
+            self.assertTrue(file_fast_compare(src, dest))
+            self.assertEqual(file_hash_memo(src), "x")
+            self.assertEqual(hasher.call_count, 2)
+
+    def test_parallel_gzip(self):
+        data = os.urandom(10000) + b"[stanza]\nkey = value\n" * 5000
+        for level in (0, 1, 6, 9):
+            out = io.BytesIO()
+            with ParallelGzipWriter(out, level, threads=3, block_size=4096) as gz:
+                gz.write(data[:100])
+                gz.write(data[100:])
+            self.assertEqual(gzip.decompress(out.getvalue()), data)
+        # Blocks are primed with the previous block, so repeated content compresses well
+        self.assertLess(len(out.getvalue()), len(data) // 2)
+        with self.assertRaises(ValueError):
+            ParallelGzipWriter(io.BytesIO(), 10)
+
 
 class KsconfMiscIternalsTest(unittest.TestCase):
 